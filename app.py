@@ -1,7 +1,11 @@
 # app.py - COMPLETE VERSION WITH OPERATOR LOGIN
+import time
+_run_started = time.perf_counter()
+
+from utils.perf_utils import note_app_run
 import streamlit as st
 from db import init_db, verify_user, create_user
-from auth_utils import safe_rerun, do_logout, set_sidebar_visibility
+from auth_utils import safe_rerun, do_logout, set_sidebar_visibility, record_rerun_ms
 
 # Page config MUST be first
 st.set_page_config(
@@ -159,8 +163,12 @@ with col2:
 
 st.markdown("---")
 
-# Import the combined modules
-from pages import combined_all_part2 as part2
+# Page registry router; section modules load on first navigation
+from pages import router
 
 # CRITICAL: Run the app router
-part2.run_app()
\ No newline at end of file
+router.run_app()
+
+# Full-page rerun time, shown next to fragment timings
+record_rerun_ms("app", _run_started)
+note_app_run()
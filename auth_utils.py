@@ -1,6 +1,10 @@
 # auth_utils.py - SHARED UTILITIES
+import functools
+import time
 import streamlit as st
 
+from db import release_tokens
+
 def safe_rerun():
     """Try modern st.rerun(), fallback to experimental"""
     try:
@@ -11,8 +15,50 @@ def safe_rerun():
         except Exception:
             st.stop()
 
+def fragment(func):
+    """st.fragment (or experimental_fragment on older Streamlit); plain function if neither exists"""
+    deco = getattr(st, "fragment", None) or getattr(st, "experimental_fragment", None)
+    return deco(func) if deco else func
+
+def record_rerun_ms(name, started):
+    """Store how long the last run of `name` took (ms) in session_state["rerun_ms"]"""
+    ms = (time.perf_counter() - started) * 1000
+    st.session_state.setdefault("rerun_ms", {})[name] = ms
+    return ms
+
+def timed_fragment(name):
+    """
+    Decorator: run the function as a fragment, so its widgets only rerun
+    that part of the page, and record how long each run took in
+    session_state["rerun_ms"]. The timing is only shown on the page when
+    the admin turned on "Show render timings" (session_state["show_timings"]).
+    """
+    def wrap(func):
+        @functools.wraps(func)
+        def run(*args, **kwargs):
+            started = time.perf_counter()
+            result = func(*args, **kwargs)
+            ms = record_rerun_ms(name, started)
+            if st.session_state.get("show_timings"):
+                full = st.session_state["rerun_ms"].get("app")
+                st.caption(f"⏱ {ms:.0f} ms" + (f" (full page {full:.0f} ms)" if full else ""))
+            return result
+        return fragment(run)
+    return wrap
+
+def release_reservations():
+    """
+    Give back the challan tokens this session reserved (see the challan page),
+    so other operators see them again without waiting for the TTL.
+    """
+    sid = st.session_state.get("session_uid")
+    if sid and st.session_state.get("challan_reserved"):
+        release_tokens(sid)
+    st.session_state["challan_reserved"] = set()
+
 def do_logout():
     """Logout handler - sets session state only, NO rerun"""
+    release_reservations()
     st.session_state.logged_in = False
     st.session_state.username = None
     st.session_state.role = None
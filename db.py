@@ -1,21 +1,487 @@
 # db.py
 import sqlite3
+import gc
 import hashlib
-from datetime import datetime
+import threading
+import time
+import weakref
+from contextlib import contextmanager
+from datetime import date, datetime, timedelta, timezone
 import os
+from collections import OrderedDict
 
 # Store DB next to this file so it's consistent regardless of current working dir
-DB_PATH = os.path.join(os.path.dirname(__file__), "tms.db")
+# (TMS_DB_PATH lets a CLI job or a second server point at another file).
+DB_PATH = os.environ.get("TMS_DB_PATH") or os.path.join(os.path.dirname(__file__), "tms.db")
+
+
+# =========================================================
+# CONNECTION POOL
+# =========================================================
+# PRAGMA profiles applied to every pooled connection. Pick one with the
+# TMS_DB_PROFILE env var; "default" suits a single Streamlit server.
+DB_PROFILES = {
+    "default": {
+        "pool_size": 8,
+        "busy_timeout_ms": 5000,
+        "cache_size_kb": 16384,
+        "mmap_size": 64 * 1024 * 1024,
+        "max_retries": 5,
+        "retry_backoff_s": 0.05,
+        "checkout_timeout_s": 10.0,
+    },
+    "low_memory": {
+        "pool_size": 4,
+        "busy_timeout_ms": 5000,
+        "cache_size_kb": 2048,
+        "mmap_size": 0,
+        "max_retries": 5,
+        "retry_backoff_s": 0.05,
+        "checkout_timeout_s": 10.0,
+    },
+    "server": {
+        "pool_size": 16,
+        "busy_timeout_ms": 10000,
+        "cache_size_kb": 65536,
+        "mmap_size": 256 * 1024 * 1024,
+        "max_retries": 8,
+        "retry_backoff_s": 0.05,
+        "checkout_timeout_s": 20.0,
+    },
+}
+DB_PROFILE = os.environ.get("TMS_DB_PROFILE", "default")
+
+# How long a checkout waits on a full pool before running the cycle collector
+# once, in case a connection was dropped without close() (see _reclaim).
+RECLAIM_GC_AFTER_S = 0.1
+
+
+class PooledConnection(sqlite3.Connection):
+    """
+    sqlite3 connection handed out by the pool.
+    close() returns it to the pool instead of closing the file handle, so
+    existing `conn = get_conn() ... conn.close()` code keeps working.
+    Used as a context manager it commits (or rolls back) and then releases.
+    A checked-out connection that is garbage-collected without close() gives
+    its pool slot back through a weakref finalizer.
+    """
+    _pool = None
+    _checked_out = False
+    _finalizer = None
+
+    def close(self):
+        if self._pool is None:
+            super().close()
+        elif self._checked_out:
+            self._pool.release(self)
+
+    def __exit__(self, exc_type, exc, tb):
+        try:
+            super().__exit__(exc_type, exc, tb)
+        finally:
+            self.close()
+        return False
+
+
+class ConnectionPool:
+    """
+    Small LIFO pool of tuned SQLite connections shared by all sessions.
+    Connections are opened lazily up to `pool_size`; when all of them are
+    checked out, callers wait for one to be released.
+    """
+
+    def __init__(self, path: str, profile: dict):
+        self.path = path
+        self.profile = profile
+        self._idle = []
+        self._open = 0
+        self._cond = threading.Condition()
+        self.stats = {"checkouts": 0, "waits": 0, "wait_ms": 0.0, "opened": 0, "busy_retries": 0, "reclaimed": 0}
+
+    def _connect(self):
+        p = self.profile
+        conn = sqlite3.connect(self.path, check_same_thread=False,
+                               timeout=p["busy_timeout_ms"] / 1000.0,
+                               factory=PooledConnection)
+        conn.execute(f"PRAGMA busy_timeout = {int(p['busy_timeout_ms'])}")
+        retry_on_busy(lambda: conn.execute("PRAGMA journal_mode = WAL"), self)
+        conn.execute("PRAGMA synchronous = NORMAL")
+        conn.execute(f"PRAGMA cache_size = -{int(p['cache_size_kb'])}")
+        conn.execute(f"PRAGMA mmap_size = {int(p['mmap_size'])}")
+        conn.execute("PRAGMA temp_store = MEMORY")
+        conn._pool = self
+        self.stats["opened"] += 1
+        return conn
+
+    def acquire(self):
+        with self._cond:
+            self.stats["checkouts"] += 1
+            if not self._idle and self._open >= self.profile["pool_size"]:
+                self.stats["waits"] += 1
+                started = time.perf_counter()
+                deadline = started + self.profile["checkout_timeout_s"]
+                collected = False
+                while not self._idle and self._open >= self.profile["pool_size"]:
+                    remaining = deadline - time.perf_counter()
+                    if remaining <= 0:
+                        raise sqlite3.OperationalError("Timed out waiting for a database connection")
+                    if collected:
+                        self._cond.wait(remaining)
+                    elif not self._cond.wait(min(remaining, RECLAIM_GC_AFTER_S)):
+                        # Nothing came back in time: maybe a connection was
+                        # dropped without close(). sqlite3 connections sit in
+                        # reference cycles, so only the cycle collector reaches
+                        # _reclaim(); run it once, without holding the lock.
+                        collected = True
+                        self._cond.release()
+                        try:
+                            gc.collect()
+                        finally:
+                            self._cond.acquire()
+                self.stats["wait_ms"] += (time.perf_counter() - started) * 1000.0
+            if self._idle:
+                return self._check_out(self._idle.pop())
+            self._open += 1
+        try:
+            return self._check_out(self._connect())
+        except Exception:
+            with self._cond:
+                self._open -= 1
+                self._cond.notify()
+            raise
+
+    def _check_out(self, conn):
+        conn._checked_out = True
+        # Must not reference conn, or the connection could never be collected
+        conn._finalizer = weakref.finalize(conn, self._reclaim)
+        return conn
+
+    def _reclaim(self):
+        """A checked-out connection was collected without close(); free its slot."""
+        with self._cond:
+            self._open -= 1
+            self.stats["reclaimed"] += 1
+            self._cond.notify()
+
+    def release(self, conn):
+        conn._finalizer.detach()
+        conn._checked_out = False
+        # Never hand a connection with half-finished work to the next caller.
+        try:
+            if conn.in_transaction:
+                conn.rollback()
+            healthy = True
+        except sqlite3.Error:
+            healthy = False
+        with self._cond:
+            if healthy:
+                self._idle.append(conn)
+            else:
+                self._open -= 1
+            self._cond.notify()
+        if not healthy:
+            sqlite3.Connection.close(conn)
+
+    def close_all(self):
+        with self._cond:
+            idle, self._idle = self._idle, []
+            self._open -= len(idle)
+        for conn in idle:
+            sqlite3.Connection.close(conn)
+
+
+_pool = None
+_pool_lock = threading.Lock()
+
+
+def _get_pool():
+    global _pool
+    if _pool is None or _pool.path != DB_PATH:
+        with _pool_lock:
+            if _pool is None or _pool.path != DB_PATH:
+                if _pool is not None:
+                    _pool.close_all()
+                _pool = ConnectionPool(DB_PATH, DB_PROFILES.get(DB_PROFILE, DB_PROFILES["default"]))
+    return _pool
+
+
+def _is_busy_error(e: Exception):
+    msg = str(e).lower()
+    return "locked" in msg or "busy" in msg
+
+
+def retry_on_busy(fn, pool=None):
+    """
+    Run fn(), retrying with exponential backoff while SQLite reports
+    "database is locked" / "busy" beyond the busy_timeout.
+    """
+    pool = pool or _get_pool()
+    attempts = pool.profile["max_retries"]
+    delay = pool.profile["retry_backoff_s"]
+    for attempt in range(attempts + 1):
+        try:
+            return fn()
+        except sqlite3.OperationalError as e:
+            if not _is_busy_error(e) or attempt == attempts:
+                raise
+            pool.stats["busy_retries"] += 1
+            time.sleep(delay * (2 ** attempt))
 
 
 def get_conn():
-    return sqlite3.connect(DB_PATH, check_same_thread=False)
+    """
+    Check out a pooled connection. Call conn.close() when done (it goes back
+    to the pool), or use it as `with get_conn() as conn:` to commit/rollback
+    and release automatically.
+    """
+    return _get_pool().acquire()
 
 
-def init_db():
+@contextmanager
+def transaction():
+    """
+    Yield a pooled connection inside an explicit BEGIN IMMEDIATE write
+    transaction. Commits on success, rolls back on error.
+    """
     conn = get_conn()
-    cur = conn.cursor()
+    try:
+        retry_on_busy(lambda: conn.execute("BEGIN IMMEDIATE"))
+        yield conn
+        conn.commit()
+    except BaseException:
+        if conn.in_transaction:
+            conn.rollback()
+        raise
+    finally:
+        conn.close()
+
+
+def get_pool_stats():
+    """Return pool counters (checkouts, waits, opened, busy retries, reclaimed) for diagnostics."""
+    pool = _get_pool()
+    with pool._cond:
+        out = dict(pool.stats)
+        out["open"] = pool._open
+        out["idle"] = len(pool._idle)
+    out["profile"] = DB_PROFILE
+    return out
+
+
+# Max ids bound into one "IN (...)" list; stays under SQLite's variable limit
+SQL_IN_CHUNK = 500
+
+
+def _chunks(seq, size=SQL_IN_CHUNK):
+    for i in range(0, len(seq), size):
+        yield seq[i:i + size]
+
+
+# ---------------------------------------------------------
+# READ CACHE (validated by PRAGMA data_version)
+# ---------------------------------------------------------
+# Hot reads (pending tokens, party list, balances, report aggregates) are
+# served from an in-process LRU. Before every lookup a dedicated "watch"
+# connection reads PRAGMA data_version, which changes whenever any *other*
+# connection — a pool connection, another Streamlit process or a CLI job —
+# commits to the file. When it moves, the watch connection reads the
+# per-table generations (migration 13) and only entries that read a changed
+# table are dropped, so a token booking does not throw away the party list.
+# An entry registered without `tables` is dropped on any commit.
+READ_CACHE_SIZE = int(os.environ.get("TMS_READ_CACHE_SIZE", "256"))
+
+
+class ReadCache:
+    def __init__(self, maxsize: int = READ_CACHE_SIZE):
+        self.maxsize = maxsize
+        self._entries = OrderedDict()   # key -> (value, expires_at, tables or None)
+        self._lock = threading.Lock()
+        self._watch = None
+        self._watch_path = None
+        self._version = None
+        self._generations = {}
+        self.stats = {"hits": 0, "misses": 0, "invalidations": 0, "evictions": 0}
+
+    def _read_generations(self):
+        try:
+            return dict(self._watch.execute("SELECT name, generation FROM table_generation"))
+        except sqlite3.OperationalError:
+            return None     # schema older than migration 13: every table counts as changed
+
+    def _check_version(self):
+        """
+        Read data_version on the watch connection; if it moved, drop the
+        entries that read a table whose generation changed. Caller holds _lock.
+        """
+        if self._watch_path != DB_PATH:
+            if self._watch is not None:
+                self._watch.close()
+            self._watch = sqlite3.connect(DB_PATH, check_same_thread=False, isolation_level=None)
+            self._watch_path = DB_PATH
+            self._version = None
+            self._generations = {}
+            self._entries.clear()
+        version = self._watch.execute("PRAGMA data_version").fetchone()[0]
+        if version != self._version:
+            generations = self._read_generations()
+            if generations is None:
+                stale = list(self._entries)
+                generations = {}
+            else:
+                changed = {name for name in set(generations) | set(self._generations)
+                           if generations.get(name) != self._generations.get(name)}
+                stale = [key for key, (_, _, tables) in self._entries.items()
+                         if tables is None or not changed.isdisjoint(tables)]
+            for key in stale:
+                del self._entries[key]
+            self.stats["invalidations"] += len(stale)
+            self._version = version
+            self._generations = generations
+        return version
+
+    def get(self, key, loader, expires_at=None, tables=None):
+        """
+        Cached loader() for key. tables lists the tables loader() reads (None:
+        any). expires_at(value) may return an epoch after which the entry is
+        reloaded even without a write (time-based filters).
+        """
+        with self._lock:
+            version = self._check_version()
+            hit = self._entries.get(key)
+            if hit is not None and (hit[1] is None or hit[1] > time.time()):
+                self._entries.move_to_end(key)
+                self.stats["hits"] += 1
+                return hit[0]
+            self.stats["misses"] += 1
+
+        value = loader()
+
+        with self._lock:
+            # a commit during the load leaves the version moved; don't store a possibly stale value
+            if self._version == version and self.maxsize > 0:
+                self._entries[key] = (value, expires_at(value) if expires_at else None,
+                                      frozenset(tables) if tables is not None else None)
+                self._entries.move_to_end(key)
+                while len(self._entries) > self.maxsize:
+                    self._entries.popitem(last=False)
+                    self.stats["evictions"] += 1
+        return value
+
+    def generations(self, tables):
+        """Current generation of each of `tables` (after re-checking data_version)."""
+        with self._lock:
+            self._check_version()
+            return tuple(self._generations.get(t, self._version) for t in tables)
+
+    def discard(self, key):
+        with self._lock:
+            self._entries.pop(key, None)
+
+    def clear(self):
+        with self._lock:
+            self._entries.clear()
+
+    def snapshot(self):
+        with self._lock:
+            out = dict(self.stats)
+            out.update(size=len(self._entries), maxsize=self.maxsize, data_version=self._version)
+        lookups = out["hits"] + out["misses"]
+        out["hit_rate"] = out["hits"] / lookups if lookups else 0.0
+        return out
+
+
+_read_cache = ReadCache()
+
+
+def table_generations(*tables):
+    """
+    Change counters of `tables` as a tuple; it only changes after a commit
+    that wrote one of them. Use it as a cache key for data read from them.
+    """
+    return _read_cache.generations(tables)
+
+
+def _touch_tables(cur, *tables):
+    """Bump the generation of tables rewritten outside the triggers (repair jobs)."""
+    cur.executemany("UPDATE table_generation SET generation = generation + 1 WHERE name = ?",
+                    [(t,) for t in tables])
+
+
+def cached_query(sql: str, params=(), tables=None):
+    """
+    Read-only query through the read cache. Returns (column_names, rows).
+    params is a sequence for ? placeholders or a dict for :name placeholders;
+    tables names the tables the query reads (None: dropped on any commit).
+    """
+    named = isinstance(params, dict)
+    params = dict(params) if named else tuple(params)
+
+    def load():
+        with get_conn() as conn:
+            cur = conn.execute(sql, params)
+            return [d[0] for d in cur.description], cur.fetchall()
+    return _read_cache.get(("sql", sql, tuple(sorted(params.items())) if named else params), load,
+                           tables=tables)
+
+
+def get_read_cache_stats():
+    """Hits, misses, invalidations, evictions, size and hit_rate of the read cache."""
+    return _read_cache.snapshot()
+
+
+# ---------------------------------------------------------
+# DATE HELPERS
+# ---------------------------------------------------------
+# Typed date columns (migration 7) store UTC epoch seconds; each table also
+# has a generated `business_day` column holding the IST calendar date as
+# 'YYYY-MM-DD', which is what date-range filters and indexes use.
+IST_OFFSET = timedelta(hours=5, minutes=30)
+IST = timezone(IST_OFFSET)
+BUSINESS_DAY_SQL = "date({col}, 'unixepoch', '+330 minutes')"
+
+_DAY_FORMATS = ("%d/%m/%Y", "%d-%m-%Y", "%Y-%m-%d", "%d/%m/%y", "%d-%m-%y")
+
 
+def day_start_epoch(day: date):
+    """Epoch seconds of 00:00 IST on `day`."""
+    return int(datetime(day.year, day.month, day.day, tzinfo=IST).timestamp())
+
+
+def to_epoch(value):
+    """
+    Epoch seconds for the date/time formats found in this database, or None.
+    - datetime / full ISO timestamps (naive ones are UTC, as written by utcnow())
+    - date objects and day-only text ('dd/mm/YYYY', 'dd-mm-YYYY', 'YYYY-MM-DD'),
+      taken as the start of that IST business day
+    """
+    if value is None:
+        return None
+    if isinstance(value, datetime):
+        dt = value if value.tzinfo else value.replace(tzinfo=timezone.utc)
+        return int(dt.timestamp())
+    if isinstance(value, date):
+        return day_start_epoch(value)
+    text = str(value).strip()
+    if not text:
+        return None
+    for fmt in _DAY_FORMATS:
+        try:
+            return day_start_epoch(datetime.strptime(text, fmt).date())
+        except ValueError:
+            pass
+    try:
+        return to_epoch(datetime.fromisoformat(text))
+    except ValueError:
+        return None
+
+
+# =========================================================
+# SCHEMA MIGRATIONS
+# =========================================================
+# Each migration runs exactly once, inside one write transaction, and the
+# schema version is tracked in PRAGMA user_version. Append new steps to
+# MIGRATIONS; never edit a step that has already shipped.
+def _migration_001_base_tables(cur):
+    """Original ten tables plus the default admin user."""
     # -----------------------------------------------------
     # 1) PARTY MASTER
     # -----------------------------------------------------
@@ -183,8 +649,6 @@ def init_db():
     )
     """)
 
-    conn.commit()
-
     # seed default admin if not exists
     cur.execute("SELECT COUNT(*) FROM users WHERE username = ?", ("admin",))
     if cur.fetchone()[0] == 0:
@@ -193,9 +657,570 @@ def init_db():
             "INSERT INTO users (username, password_hash, role, office_location, created_at) VALUES (?, ?, ?, ?, ?)",
             ("admin", pw_hash, "ADMIN", None, datetime.utcnow().isoformat())
         )
-        conn.commit()
 
-    conn.close()
+
+def _migration_002_indexes(cur):
+    """Indexes for the pending list, billing/ledger, challans and lookups."""
+    # Pending tokens: filter on status + route, already in marka/token_no order
+    cur.execute("""
+        CREATE INDEX IF NOT EXISTS ix_tokens_pending
+        ON tokens (status, from_city, to_city, marka, token_no)
+    """)
+    # Billing / ledger / balance: one party's tokens in date order
+    cur.execute("CREATE INDEX IF NOT EXISTS ix_tokens_party_date ON tokens (party_id, date_time, amount)")
+    cur.execute("CREATE INDEX IF NOT EXISTS ix_tokens_date ON tokens (date_time)")
+    cur.execute("CREATE INDEX IF NOT EXISTS ix_tokens_token_no ON tokens (token_no)")
+    cur.execute("CREATE INDEX IF NOT EXISTS ix_tokens_challan ON tokens (challan_id)")
+    cur.execute("CREATE INDEX IF NOT EXISTS ix_payments_party_date ON payments (party_id, date, amount)")
+    cur.execute("CREATE INDEX IF NOT EXISTS ix_challan_tokens_challan ON challan_tokens (challan_id, token_id)")
+    cur.execute("CREATE INDEX IF NOT EXISTS ix_challan_tokens_token ON challan_tokens (token_id)")
+    cur.execute("CREATE INDEX IF NOT EXISTS ix_challan_no ON challan (challan_no)")
+    cur.execute("CREATE INDEX IF NOT EXISTS ix_bills_party ON bills (party_id, from_date)")
+    cur.execute("CREATE INDEX IF NOT EXISTS ix_bills_no ON bills (bill_no)")
+    cur.execute("CREATE INDEX IF NOT EXISTS ix_delivery_token ON delivery_log (token_id)")
+    cur.execute("CREATE INDEX IF NOT EXISTS ix_rate_route ON rate_master (party_id, from_city, to_city)")
+
+
+def _migration_003_doc_sequence(cur):
+    """Counter table for token / challan / bill numbers, seeded from MAX()."""
+    cur.execute("""
+    CREATE TABLE IF NOT EXISTS doc_sequence (
+        series TEXT PRIMARY KEY,
+        next_value INTEGER NOT NULL
+    ) WITHOUT ROWID
+    """)
+    cur.execute("""
+        INSERT OR IGNORE INTO doc_sequence (series, next_value)
+        SELECT 'TOKEN', COALESCE(MAX(token_no), 0) + 1 FROM tokens
+        UNION ALL SELECT 'CHALLAN', COALESCE(MAX(challan_no), 0) + 1 FROM challan
+        UNION ALL SELECT 'BILL', COALESCE(MAX(bill_no), 0) + 1 FROM bills
+    """)
+
+
+def _migration_004_token_reservation(cur):
+    """Short-lived per-session holds on pending tokens during challan loading."""
+    cur.execute("""
+    CREATE TABLE IF NOT EXISTS token_reservation (
+        token_id INTEGER PRIMARY KEY,
+        session_id TEXT NOT NULL,
+        expires_at REAL NOT NULL
+    )
+    """)
+    cur.execute("CREATE INDEX IF NOT EXISTS ix_token_reservation_session ON token_reservation (session_id)")
+    cur.execute("CREATE INDEX IF NOT EXISTS ix_token_reservation_expiry ON token_reservation (expires_at)")
+
+
+def _migration_005_party_balance(cur):
+    """Running token / payment totals per party, kept current by triggers."""
+    cur.execute("""
+    CREATE TABLE IF NOT EXISTS party_balance (
+        party_id INTEGER PRIMARY KEY,
+        token_total REAL NOT NULL DEFAULT 0,
+        payment_total REAL NOT NULL DEFAULT 0
+    )
+    """)
+    for table, col in (("tokens", "token_total"), ("payments", "payment_total")):
+        cur.execute(f"""
+        CREATE TRIGGER IF NOT EXISTS trg_{table}_balance_ai AFTER INSERT ON {table}
+        WHEN NEW.party_id IS NOT NULL
+        BEGIN
+            INSERT OR IGNORE INTO party_balance (party_id) VALUES (NEW.party_id);
+            UPDATE party_balance SET {col} = {col} + COALESCE(NEW.amount, 0)
+            WHERE party_id = NEW.party_id;
+        END
+        """)
+        cur.execute(f"""
+        CREATE TRIGGER IF NOT EXISTS trg_{table}_balance_ad AFTER DELETE ON {table}
+        WHEN OLD.party_id IS NOT NULL
+        BEGIN
+            UPDATE party_balance SET {col} = {col} - COALESCE(OLD.amount, 0)
+            WHERE party_id = OLD.party_id;
+        END
+        """)
+        cur.execute(f"""
+        CREATE TRIGGER IF NOT EXISTS trg_{table}_balance_au AFTER UPDATE OF party_id, amount ON {table}
+        WHEN OLD.party_id IS NOT NEW.party_id OR OLD.amount IS NOT NEW.amount
+        BEGIN
+            UPDATE party_balance SET {col} = {col} - COALESCE(OLD.amount, 0)
+            WHERE party_id = OLD.party_id;
+            INSERT OR IGNORE INTO party_balance (party_id)
+            SELECT NEW.party_id WHERE NEW.party_id IS NOT NULL;
+            UPDATE party_balance SET {col} = {col} + COALESCE(NEW.amount, 0)
+            WHERE party_id = NEW.party_id;
+        END
+        """)
+    _fill_party_balance(cur)
+
+
+def _migration_006_party_marka(cur):
+    """One row per marka, unique regardless of case; backfilled from party_master.marka."""
+    cur.execute("""
+    CREATE TABLE IF NOT EXISTS party_marka (
+        id INTEGER PRIMARY KEY AUTOINCREMENT,
+        party_id INTEGER NOT NULL,
+        marka TEXT NOT NULL COLLATE NOCASE,
+        FOREIGN KEY(party_id) REFERENCES party_master(id)
+    )
+    """)
+    cur.execute("CREATE UNIQUE INDEX IF NOT EXISTS ux_party_marka ON party_marka (marka)")
+    cur.execute("CREATE INDEX IF NOT EXISTS ix_party_marka_party ON party_marka (party_id)")
+    # Older parties win when the same marka was typed for two parties
+    cur.execute("SELECT id, marka FROM party_master WHERE marka IS NOT NULL ORDER BY id")
+    for party_id, marka_field in cur.fetchall():
+        cur.executemany("INSERT OR IGNORE INTO party_marka (party_id, marka) VALUES (?, ?)",
+                        [(party_id, m) for m in split_markas(marka_field)])
+
+
+# table -> (text date column, epoch column) for migration 7
+_TYPED_DATE_COLUMNS = {
+    "tokens": ("date_time", "booked_at"),
+    "payments": ("date", "paid_at"),
+    "challan": ("date", "challan_at"),
+    "delivery_log": ("delivery_date", "delivered_at"),
+}
+
+
+def _migration_007_typed_dates(cur):
+    """Epoch + IST business_day columns on tokens, payments, challan and delivery_log."""
+    for table, (text_col, epoch_col) in _TYPED_DATE_COLUMNS.items():
+        cur.execute(f"ALTER TABLE {table} ADD COLUMN {epoch_col} INTEGER")
+        # SQLite can only add VIRTUAL generated columns to an existing table;
+        # the indexes below store the computed value, so range scans never
+        # evaluate the expression per row.
+        cur.execute(f"""
+            ALTER TABLE {table} ADD COLUMN business_day TEXT
+            GENERATED ALWAYS AS ({BUSINESS_DAY_SQL.format(col=epoch_col)}) VIRTUAL
+        """)
+        cur.execute(f"SELECT id, {text_col} FROM {table}")
+        cur.executemany(f"UPDATE {table} SET {epoch_col} = ? WHERE id = ?",
+                        [(to_epoch(text), row_id) for row_id, text in cur.fetchall()])
+    cur.execute("CREATE INDEX IF NOT EXISTS ix_tokens_party_day ON tokens (party_id, business_day, amount)")
+    cur.execute("CREATE INDEX IF NOT EXISTS ix_tokens_day ON tokens (business_day)")
+    cur.execute("CREATE INDEX IF NOT EXISTS ix_payments_party_day ON payments (party_id, business_day, amount)")
+    cur.execute("CREATE INDEX IF NOT EXISTS ix_payments_day ON payments (business_day)")
+    cur.execute("CREATE INDEX IF NOT EXISTS ix_challan_day ON challan (business_day)")
+    cur.execute("CREATE INDEX IF NOT EXISTS ix_delivery_day ON delivery_log (business_day)")
+
+
+def _migration_008_city_route(cur):
+    """City / route masters, office route defaults, NOCASE route index on tokens."""
+    cur.execute("""
+    CREATE TABLE IF NOT EXISTS city (
+        id INTEGER PRIMARY KEY AUTOINCREMENT,
+        name TEXT NOT NULL UNIQUE COLLATE NOCASE
+    )
+    """)
+    cur.execute("""
+    CREATE TABLE IF NOT EXISTS route (
+        id INTEGER PRIMARY KEY AUTOINCREMENT,
+        from_city_id INTEGER NOT NULL,
+        to_city_id INTEGER NOT NULL,
+        UNIQUE(from_city_id, to_city_id),
+        FOREIGN KEY(from_city_id) REFERENCES city(id),
+        FOREIGN KEY(to_city_id) REFERENCES city(id)
+    )
+    """)
+    cur.execute("""
+    CREATE TABLE IF NOT EXISTS office_route (
+        office TEXT PRIMARY KEY COLLATE NOCASE,
+        route_id INTEGER NOT NULL,
+        FOREIGN KEY(route_id) REFERENCES route(id)
+    )
+    """)
+
+    # Store city text in one normalized form everywhere
+    for table in ("tokens", "challan", "rate_master"):
+        cur.execute(f"""
+            UPDATE {table}
+            SET from_city = UPPER(TRIM(from_city)), to_city = UPPER(TRIM(to_city))
+            WHERE from_city <> UPPER(TRIM(from_city)) OR to_city <> UPPER(TRIM(to_city))
+        """)
+
+    # Seed from the two original branches plus every route already in use
+    cur.execute("""
+        SELECT DISTINCT from_city, to_city FROM tokens
+        WHERE from_city IS NOT NULL AND from_city <> '' AND to_city IS NOT NULL AND to_city <> ''
+    """)
+    pairs = [("DELHI", "MUMBAI"), ("MUMBAI", "DELHI")] + cur.fetchall()
+    for from_city, to_city in pairs:
+        _ensure_route(cur, from_city, to_city)
+    for office, from_city, to_city in (("DELHI", "DELHI", "MUMBAI"), ("MUMBAI", "MUMBAI", "DELHI")):
+        cur.execute("INSERT OR IGNORE INTO office_route (office, route_id) VALUES (?, ?)",
+                    (office, _ensure_route(cur, from_city, to_city)))
+
+    # Pending list: equality on NOCASE columns can use this index
+    cur.execute("DROP INDEX IF EXISTS ix_tokens_pending")
+    cur.execute("""
+        CREATE INDEX ix_tokens_pending
+        ON tokens (status, from_city COLLATE NOCASE, to_city COLLATE NOCASE, marka, token_no)
+    """)
+
+
+# Office whose default route starts at a given city (bound as {city})
+_OFFICE_FOR_CITY_SQL = """
+    SELECT o.id
+    FROM office_route r
+    JOIN office o ON o.name = r.office
+    JOIN route rt ON rt.id = r.route_id
+    JOIN city c ON c.id = rt.from_city_id
+    WHERE c.name = {city}
+    ORDER BY o.id LIMIT 1
+"""
+
+
+def _migration_009_office_scope(cur):
+    """office table plus office_id on tokens, challan, payments and delivery_log."""
+    cur.execute("""
+    CREATE TABLE IF NOT EXISTS office (
+        id INTEGER PRIMARY KEY AUTOINCREMENT,
+        name TEXT NOT NULL UNIQUE COLLATE NOCASE
+    )
+    """)
+    cur.execute("""
+        INSERT OR IGNORE INTO office (name)
+        SELECT UPPER(TRIM(office_location)) FROM users
+        WHERE office_location IS NOT NULL AND TRIM(office_location) <> ''
+    """)
+    cur.execute("INSERT OR IGNORE INTO office (name) SELECT UPPER(office) FROM office_route")
+
+    for table in ("tokens", "challan", "payments", "delivery_log"):
+        cur.execute(f"ALTER TABLE {table} ADD COLUMN office_id INTEGER REFERENCES office(id)")
+
+    # Bookings and challans belong to the office at their origin city,
+    # deliveries to the office at the token's destination. Past payments
+    # were taken centrally and stay unassigned.
+    for table in ("tokens", "challan"):
+        cur.execute(f"UPDATE {table} SET office_id = ({_OFFICE_FOR_CITY_SQL.format(city=f'{table}.from_city')})")
+    cur.execute(f"""
+        UPDATE delivery_log SET office_id = (
+            {_OFFICE_FOR_CITY_SQL.format(city="(SELECT t.to_city FROM tokens t WHERE t.id = delivery_log.token_id)")}
+        )
+    """)
+
+    cur.execute("""
+        CREATE INDEX IF NOT EXISTS ix_tokens_office_pending
+        ON tokens (office_id, status, from_city COLLATE NOCASE, to_city COLLATE NOCASE, marka, token_no)
+    """)
+    cur.execute("CREATE INDEX IF NOT EXISTS ix_tokens_office_day ON tokens (office_id, business_day)")
+    cur.execute("CREATE INDEX IF NOT EXISTS ix_challan_office_day ON challan (office_id, business_day)")
+    cur.execute("CREATE INDEX IF NOT EXISTS ix_payments_office_day ON payments (office_id, business_day)")
+    cur.execute("CREATE INDEX IF NOT EXISTS ix_delivery_office_day ON delivery_log (office_id, business_day)")
+
+
+def _migration_010_dashboard_index(cur):
+    """
+    Day-range token scans (dashboard, reports) read route, status, party,
+    weight and amount. Carrying them in the day index avoids a table lookup
+    per row; it replaces ix_tokens_day, which is its prefix.
+    """
+    cur.execute("DROP INDEX IF EXISTS ix_tokens_day")
+    cur.execute("""
+        CREATE INDEX IF NOT EXISTS ix_tokens_day_cover
+        ON tokens (business_day, from_city COLLATE NOCASE, to_city COLLATE NOCASE, status, party_id, weight, amount)
+    """)
+
+
+# Signed contribution of one token row (NEW or OLD) to daily_route_party_summary;
+# cancelled tokens and tokens without a booking time contribute nothing.
+_SUMMARY_UPSERT_SQL = """
+    INSERT INTO daily_route_party_summary
+        (business_day, from_city, to_city, party_id, tokens, weight, pkgs, amount, pending, loaded, delivered)
+    SELECT {r}.business_day, COALESCE({r}.from_city, ''), COALESCE({r}.to_city, ''), COALESCE({r}.party_id, 0),
+           {s}1, {s}COALESCE({r}.weight, 0), {s}COALESCE({r}.pkgs, 0), {s}COALESCE({r}.amount, 0),
+           {s}({r}.status = 'PENDING'), {s}({r}.status = 'LOADED'), {s}({r}.status = 'DELIVERED')
+    WHERE {r}.business_day IS NOT NULL AND {r}.status IS NOT 'CANCELLED'
+    ON CONFLICT (business_day, from_city, to_city, party_id) DO UPDATE SET
+        tokens = tokens + excluded.tokens, weight = weight + excluded.weight,
+        pkgs = pkgs + excluded.pkgs, amount = amount + excluded.amount,
+        pending = pending + excluded.pending, loaded = loaded + excluded.loaded,
+        delivered = delivered + excluded.delivered;
+"""
+
+# Same grouping from the tokens table, for backfill and rebuild ({where} narrows the days)
+_SUMMARY_SELECT_SQL = """
+    SELECT business_day, COALESCE(from_city, ''), COALESCE(to_city, ''), COALESCE(party_id, 0),
+           COUNT(*), COALESCE(SUM(weight), 0), COALESCE(SUM(pkgs), 0), COALESCE(SUM(amount), 0),
+           SUM(status = 'PENDING'), SUM(status = 'LOADED'), SUM(status = 'DELIVERED')
+    FROM tokens
+    WHERE business_day IS NOT NULL AND status IS NOT 'CANCELLED'{where}
+    GROUP BY 1, 2, 3, 4
+"""
+
+
+def _migration_011_daily_summary(cur):
+    """
+    daily_route_party_summary rollup (one row per IST day, route and party),
+    kept current by triggers on tokens. Cancelled tokens drop out of the
+    rollup and of party_balance.
+    """
+    cur.execute("""
+    CREATE TABLE IF NOT EXISTS daily_route_party_summary (
+        business_day TEXT NOT NULL,
+        from_city TEXT NOT NULL COLLATE NOCASE,
+        to_city TEXT NOT NULL COLLATE NOCASE,
+        party_id INTEGER NOT NULL,              -- 0 = no party
+        tokens INTEGER NOT NULL DEFAULT 0,
+        weight REAL NOT NULL DEFAULT 0,
+        pkgs INTEGER NOT NULL DEFAULT 0,
+        amount REAL NOT NULL DEFAULT 0,
+        pending INTEGER NOT NULL DEFAULT 0,
+        loaded INTEGER NOT NULL DEFAULT 0,
+        delivered INTEGER NOT NULL DEFAULT 0,
+        PRIMARY KEY (business_day, from_city, to_city, party_id)
+    ) WITHOUT ROWID
+    """)
+    cur.execute(f"""
+    CREATE TRIGGER IF NOT EXISTS trg_tokens_summary_ai AFTER INSERT ON tokens
+    BEGIN
+        {_SUMMARY_UPSERT_SQL.format(r="NEW", s="")}
+    END
+    """)
+    cur.execute(f"""
+    CREATE TRIGGER IF NOT EXISTS trg_tokens_summary_ad AFTER DELETE ON tokens
+    BEGIN
+        {_SUMMARY_UPSERT_SQL.format(r="OLD", s="-")}
+    END
+    """)
+    cur.execute(f"""
+    CREATE TRIGGER IF NOT EXISTS trg_tokens_summary_au
+    AFTER UPDATE OF booked_at, from_city, to_city, party_id, weight, pkgs, amount, status ON tokens
+    BEGIN
+        {_SUMMARY_UPSERT_SQL.format(r="OLD", s="-")}
+        {_SUMMARY_UPSERT_SQL.format(r="NEW", s="")}
+    END
+    """)
+    _fill_daily_summary(cur)
+
+    # party_balance: a cancelled token no longer counts towards the party's total
+    live_amount = "CASE WHEN {r}.status IS 'CANCELLED' THEN 0 ELSE COALESCE({r}.amount, 0) END"
+    for suffix in ("ai", "ad", "au"):
+        cur.execute(f"DROP TRIGGER IF EXISTS trg_tokens_balance_{suffix}")
+    cur.execute(f"""
+    CREATE TRIGGER trg_tokens_balance_ai AFTER INSERT ON tokens
+    WHEN NEW.party_id IS NOT NULL
+    BEGIN
+        INSERT OR IGNORE INTO party_balance (party_id) VALUES (NEW.party_id);
+        UPDATE party_balance SET token_total = token_total + {live_amount.format(r="NEW")}
+        WHERE party_id = NEW.party_id;
+    END
+    """)
+    cur.execute(f"""
+    CREATE TRIGGER trg_tokens_balance_ad AFTER DELETE ON tokens
+    WHEN OLD.party_id IS NOT NULL
+    BEGIN
+        UPDATE party_balance SET token_total = token_total - {live_amount.format(r="OLD")}
+        WHERE party_id = OLD.party_id;
+    END
+    """)
+    cur.execute(f"""
+    CREATE TRIGGER trg_tokens_balance_au AFTER UPDATE OF party_id, amount, status ON tokens
+    WHEN OLD.party_id IS NOT NEW.party_id OR OLD.amount IS NOT NEW.amount OR OLD.status IS NOT NEW.status
+    BEGIN
+        UPDATE party_balance SET token_total = token_total - {live_amount.format(r="OLD")}
+        WHERE party_id = OLD.party_id;
+        INSERT OR IGNORE INTO party_balance (party_id)
+        SELECT NEW.party_id WHERE NEW.party_id IS NOT NULL;
+        UPDATE party_balance SET token_total = token_total + {live_amount.format(r="NEW")}
+        WHERE party_id = NEW.party_id;
+    END
+    """)
+
+
+# Signed change a token / payment row ({r} = NEW or OLD) makes to every closed
+# month-end balance on or after its business day ({op} is + or -).
+_CHECKPOINT_ADJUST_SQL = """
+    INSERT OR IGNORE INTO party_closing_balance (period_end, party_id)
+    SELECT period_end, {r}.party_id FROM closed_period
+    WHERE {r}.party_id IS NOT NULL AND period_end >= {r}.business_day;
+    UPDATE party_closing_balance SET closing_balance = closing_balance {op} {amount}
+    WHERE party_id = {r}.party_id AND period_end >= {r}.business_day;
+"""
+
+
+def _migration_012_closing_balance(cur):
+    """
+    Month-end closing balance per party (written by close_period()), so an
+    opening balance is the nearest checkpoint plus at most a month of rows.
+    Triggers correct the checkpoints when a closed month is edited later.
+    """
+    cur.execute("""
+    CREATE TABLE IF NOT EXISTS closed_period (
+        period_end TEXT PRIMARY KEY,            -- last business day of the month
+        parties INTEGER NOT NULL DEFAULT 0,
+        closed_at INTEGER
+    )
+    """)
+    cur.execute("""
+    CREATE TABLE IF NOT EXISTS party_closing_balance (
+        period_end TEXT NOT NULL,
+        party_id INTEGER NOT NULL,
+        closing_balance REAL NOT NULL DEFAULT 0,
+        PRIMARY KEY (period_end, party_id)
+    ) WITHOUT ROWID
+    """)
+
+    sources = {
+        "tokens": ("CASE WHEN {r}.status IS 'CANCELLED' THEN 0 ELSE COALESCE({r}.amount, 0) END",
+                   "booked_at, party_id, amount, status"),
+        "payments": ("COALESCE({r}.amount, 0)", "paid_at, party_id, amount"),
+    }
+    for table, (amount, columns) in sources.items():
+        credit = table == "payments"
+        add = lambda r: _CHECKPOINT_ADJUST_SQL.format(r=r, op="-" if credit else "+", amount=amount.format(r=r))
+        sub = lambda r: _CHECKPOINT_ADJUST_SQL.format(r=r, op="+" if credit else "-", amount=amount.format(r=r))
+        closed = "EXISTS (SELECT 1 FROM closed_period WHERE period_end >= {r}.business_day)"
+        cur.execute(f"""
+        CREATE TRIGGER IF NOT EXISTS trg_{table}_closing_ai AFTER INSERT ON {table}
+        WHEN {closed.format(r="NEW")}
+        BEGIN
+            {add("NEW")}
+        END
+        """)
+        cur.execute(f"""
+        CREATE TRIGGER IF NOT EXISTS trg_{table}_closing_ad AFTER DELETE ON {table}
+        WHEN {closed.format(r="OLD")}
+        BEGIN
+            {sub("OLD")}
+        END
+        """)
+        cur.execute(f"""
+        CREATE TRIGGER IF NOT EXISTS trg_{table}_closing_au AFTER UPDATE OF {columns} ON {table}
+        WHEN {closed.format(r="OLD")} OR {closed.format(r="NEW")}
+        BEGIN
+            {sub("OLD")}
+            {add("NEW")}
+        END
+        """)
+
+
+# Tables whose rows the read cache depends on. Triggers bump a per-table
+# generation on every insert / update / delete, so cached entries are dropped
+# only when a table they read changed (see ReadCache). Derived tables that only
+# change through triggers on these are listed in DERIVED_TABLES instead; the
+# repair jobs that rewrite them bump their generation explicitly.
+TRACKED_TABLES = (
+    "party_master", "party_marka", "item_master", "rate_master",
+    "city", "route", "office_route", "office",
+    "tokens", "payments", "challan", "delivery_log", "token_reservation", "closed_period",
+)
+DERIVED_TABLES = ("party_balance", "daily_route_party_summary", "party_closing_balance")
+
+
+def _migration_013_table_generation(cur):
+    """Per-table change counters for scoped read-cache invalidation."""
+    cur.execute("""
+    CREATE TABLE IF NOT EXISTS table_generation (
+        name TEXT PRIMARY KEY,
+        generation INTEGER NOT NULL DEFAULT 0
+    ) WITHOUT ROWID
+    """)
+    cur.executemany("INSERT OR IGNORE INTO table_generation (name) VALUES (?)",
+                    [(t,) for t in TRACKED_TABLES + DERIVED_TABLES])
+    for table in TRACKED_TABLES:
+        for suffix, event in (("ai", "INSERT"), ("au", "UPDATE"), ("ad", "DELETE")):
+            cur.execute(f"""
+            CREATE TRIGGER IF NOT EXISTS trg_{table}_gen_{suffix} AFTER {event} ON {table}
+            BEGIN
+                UPDATE table_generation SET generation = generation + 1 WHERE name = '{table}';
+            END
+            """)
+
+
+def _migration_014_drop_text_date_indexes(cur):
+    """
+    Date filters use the business_day indexes (migration 7); these indexes
+    on the old text date columns are never used by a query (payments.date is
+    dd/mm/YYYY text, useless for ranges) and only add cost to every insert.
+    """
+    for name in ("ix_tokens_date", "ix_tokens_party_date", "ix_payments_party_date"):
+        cur.execute(f"DROP INDEX IF EXISTS {name}")
+
+
+def _migration_015_status_trigger_scope(cur):
+    """
+    PENDING -> LOADED -> DELIVERED does not change what a token owes, so the
+    party_balance and closing-balance update triggers now only fire for a
+    change of party, amount or booking day, or a move into / out of CANCELLED.
+    """
+    live_amount = "CASE WHEN {r}.status IS 'CANCELLED' THEN 0 ELSE COALESCE({r}.amount, 0) END"
+    cancel_flip = "(OLD.status IS 'CANCELLED') <> (NEW.status IS 'CANCELLED')"
+    closed = "EXISTS (SELECT 1 FROM closed_period WHERE period_end >= {r}.business_day)"
+
+    cur.execute("DROP TRIGGER IF EXISTS trg_tokens_balance_au")
+    cur.execute(f"""
+    CREATE TRIGGER trg_tokens_balance_au AFTER UPDATE OF party_id, amount, status ON tokens
+    WHEN OLD.party_id IS NOT NEW.party_id OR OLD.amount IS NOT NEW.amount OR {cancel_flip}
+    BEGIN
+        UPDATE party_balance SET token_total = token_total - {live_amount.format(r="OLD")}
+        WHERE party_id = OLD.party_id;
+        INSERT OR IGNORE INTO party_balance (party_id)
+        SELECT NEW.party_id WHERE NEW.party_id IS NOT NULL;
+        UPDATE party_balance SET token_total = token_total + {live_amount.format(r="NEW")}
+        WHERE party_id = NEW.party_id;
+    END
+    """)
+
+    cur.execute("DROP TRIGGER IF EXISTS trg_tokens_closing_au")
+    cur.execute(f"""
+    CREATE TRIGGER trg_tokens_closing_au AFTER UPDATE OF booked_at, party_id, amount, status ON tokens
+    WHEN (OLD.booked_at IS NOT NEW.booked_at OR OLD.party_id IS NOT NEW.party_id
+          OR OLD.amount IS NOT NEW.amount OR {cancel_flip})
+     AND ({closed.format(r="OLD")} OR {closed.format(r="NEW")})
+    BEGIN
+        {_CHECKPOINT_ADJUST_SQL.format(r="OLD", op="-", amount=live_amount.format(r="OLD"))}
+        {_CHECKPOINT_ADJUST_SQL.format(r="NEW", op="+", amount=live_amount.format(r="NEW"))}
+    END
+    """)
+
+
+MIGRATIONS = [
+    _migration_001_base_tables,
+    _migration_002_indexes,
+    _migration_003_doc_sequence,
+    _migration_004_token_reservation,
+    _migration_005_party_balance,
+    _migration_006_party_marka,
+    _migration_007_typed_dates,
+    _migration_008_city_route,
+    _migration_009_office_scope,
+    _migration_010_dashboard_index,
+    _migration_011_daily_summary,
+    _migration_012_closing_balance,
+    _migration_013_table_generation,
+    _migration_014_drop_text_date_indexes,
+    _migration_015_status_trigger_scope,
+]
+SCHEMA_VERSION = len(MIGRATIONS)
+
+# DB paths already known to be at SCHEMA_VERSION in this process
+_schema_ready = set()
+
+
+def get_schema_version():
+    with get_conn() as conn:
+        return conn.execute("PRAGMA user_version").fetchone()[0]
+
+
+def init_db():
+    """
+    Bring the database up to SCHEMA_VERSION.
+    Safe to call on every Streamlit rerun: once a path is current it is
+    remembered and later calls return without touching SQLite.
+    """
+    if DB_PATH in _schema_ready:
+        return
+    if get_schema_version() < SCHEMA_VERSION:
+        with transaction() as conn:
+            # Re-read under the write lock in case another process migrated first
+            version = conn.execute("PRAGMA user_version").fetchone()[0]
+            cur = conn.cursor()
+            for step, migrate in enumerate(MIGRATIONS, start=1):
+                if step > version:
+                    migrate(cur)
+                    cur.execute(f"PRAGMA user_version = {step}")
+        with get_conn() as conn:
+            conn.execute("PRAGMA optimize")
+    _schema_ready.add(DB_PATH)
 
 
 # ---------------------------------------------------------
@@ -212,33 +1237,27 @@ def create_user(username: str, password: str, role: str = "OPERATOR", office: st
     Raises:
         ValueError: if username already exists.
     """
-    conn = get_conn()
-    cur = conn.cursor()
     try:
-        cur.execute(
-            "INSERT INTO users (username, password_hash, role, office_location, created_at) VALUES (?, ?, ?, ?, ?)",
-            (username, hash_pw(password), role, office, datetime.utcnow().isoformat())
-        )
-        conn.commit()
-        user_id = cur.lastrowid
+        with get_conn() as conn:
+            cur = conn.cursor()
+            cur.execute(
+                "INSERT INTO users (username, password_hash, role, office_location, created_at) VALUES (?, ?, ?, ?, ?)",
+                (username, hash_pw(password), role, office, datetime.utcnow().isoformat())
+            )
+            user_id = cur.lastrowid
+            if office:
+                _office_id(cur, office)
     except sqlite3.IntegrityError as e:
-        conn.rollback()
-        conn.close()
         raise ValueError(f"User '{username}' already exists") from e
-    finally:
-        try:
-            conn.close()
-        except Exception:
-            pass
     return user_id
 
 
 def get_user(username: str):
-    conn = get_conn()
-    cur = conn.cursor()
-    cur.execute("SELECT id, username, role, office_location, password_hash FROM users WHERE username = ?", (username,))
-    row = cur.fetchone()
-    conn.close()
+    with get_conn() as conn:
+        cur = conn.cursor()
+        cur.execute("SELECT id, username, role, office_location, password_hash FROM users WHERE username = ?",
+                    (username,))
+        row = cur.fetchone()
     if not row:
         return None
     return {
@@ -260,198 +1279,1075 @@ def verify_user(username: str, password: str):
 
 
 # ---------------------------------------------------------
-# GET NEXT AUTO NUMBERS
+# DOCUMENT NUMBER SEQUENCES (TOKEN / CHALLAN / BILL)
 # ---------------------------------------------------------
-def get_next_token_no():
-    conn = get_conn()
+# Numbers come from the doc_sequence counter table and are allocated inside
+# the same write transaction as the INSERT that uses them.
+#
+# Series scope per kind:
+#   "global"    - one running series (default, matches the old MAX()+1 numbers)
+#   "office"    - separate series per booking office
+#   "fy"        - restart every Indian financial year (April - March)
+#   "office_fy" - per office, per financial year
+DOC_SERIES_SCOPE = {"TOKEN": "global", "CHALLAN": "global", "BILL": "global"}
+
+# Numbers reserved per trip to the counter row. 1 = allocate in the booking
+# transaction (gap-free). >1 = hand out numbers from an in-process block,
+# which keeps the counter row out of busy booking transactions but leaves
+# gaps when the process restarts or a booking fails.
+DOC_SEQUENCE_BLOCK = {"TOKEN": 1, "CHALLAN": 1, "BILL": 1}
+
+_DOC_SOURCES = {
+    "TOKEN": ("tokens", "token_no"),
+    "CHALLAN": ("challan", "challan_no"),
+    "BILL": ("bills", "bill_no"),
+}
+
+_doc_blocks = {}
+_doc_blocks_lock = threading.Lock()
+
+
+def financial_year(on=None):
+    """Indian financial year label for a date, e.g. 2025-26. Defaults to today (IST)."""
+    on = on or (datetime.utcnow() + IST_OFFSET).date()
+    start = on.year if on.month >= 4 else on.year - 1
+    return f"{start}-{(start + 1) % 100:02d}"
+
+
+def _series_key(kind: str, office: str = None):
+    scope = DOC_SERIES_SCOPE.get(kind, "global")
+    parts = [kind]
+    if scope in ("office", "office_fy"):
+        parts.append((office or "ALL").strip().upper())
+    if scope in ("fy", "office_fy"):
+        parts.append(financial_year())
+    return ":".join(parts)
+
+
+def _series_start(cur, kind: str, key: str):
+    """First number for a series that has no counter row yet."""
+    if key != kind:
+        return 1
+    table, col = _DOC_SOURCES[kind]
+    cur.execute(f"SELECT COALESCE(MAX({col}), 0) + 1 FROM {table}")
+    return cur.fetchone()[0]
+
+
+def allocate_doc_no(conn, kind: str, office: str = None, count: int = 1):
+    """
+    Reserve `count` consecutive numbers for `kind` and return the first one.
+    Must be called on a connection that is inside a write transaction
+    (see transaction()), so the number commits or rolls back with the row
+    that uses it.
+    """
+    key = _series_key(kind, office)
     cur = conn.cursor()
-    cur.execute("SELECT COALESCE(MAX(token_no), 0) + 1 FROM tokens")
-    nxt = cur.fetchone()[0]
-    conn.close()
-    return nxt
+    cur.execute("UPDATE doc_sequence SET next_value = next_value + ? WHERE series = ?", (count, key))
+    if cur.rowcount == 0:
+        start = _series_start(cur, kind, key)
+        cur.execute("INSERT INTO doc_sequence (series, next_value) VALUES (?, ?)", (key, start + count))
+        return start
+    cur.execute("SELECT next_value FROM doc_sequence WHERE series = ?", (key,))
+    return cur.fetchone()[0] - count
 
 
-def get_next_challan_no():
-    conn = get_conn()
-    cur = conn.cursor()
-    cur.execute("SELECT COALESCE(MAX(challan_no), 0) + 1 FROM challan")
-    nxt = cur.fetchone()[0]
-    conn.close()
+def _prefetch_doc_no(kind: str, office: str = None):
+    """
+    In block mode, take the next number from this process's reserved block,
+    refilling it in its own short transaction. Returns None in the default
+    gap-free mode, where the caller allocates inside its own transaction.
+    Call this before opening the booking transaction.
+    """
+    block = DOC_SEQUENCE_BLOCK.get(kind, 1)
+    if block <= 1:
+        return None
+    key = _series_key(kind, office)
+    with _doc_blocks_lock:
+        nxt, end = _doc_blocks.get(key, (0, 0))
+        if nxt >= end:
+            with transaction() as conn:
+                nxt = allocate_doc_no(conn, kind, office, count=block)
+            end = nxt + block
+        _doc_blocks[key] = (nxt + 1, end)
     return nxt
 
 
-def get_next_bill_no():
-    conn = get_conn()
-    cur = conn.cursor()
-    cur.execute("SELECT COALESCE(MAX(bill_no), 0) + 1 FROM bills")
-    nxt = cur.fetchone()[0]
-    conn.close()
-    return nxt
+def peek_doc_no(kind: str, office: str = None):
+    """Next number that will be handed out for `kind` (display only, not reserved)."""
+    key = _series_key(kind, office)
+    with _doc_blocks_lock:
+        nxt, end = _doc_blocks.get(key, (0, 0))
+    if nxt < end:
+        return nxt
+    with get_conn() as conn:
+        cur = conn.cursor()
+        cur.execute("SELECT next_value FROM doc_sequence WHERE series = ?", (key,))
+        row = cur.fetchone()
+        return row[0] if row else _series_start(cur, kind, key)
+
+
+def get_next_token_no(office: str = None):
+    return peek_doc_no("TOKEN", office)
+
+
+def get_next_challan_no(office: str = None):
+    return peek_doc_no("CHALLAN", office)
+
+
+def get_next_bill_no(office: str = None):
+    return peek_doc_no("BILL", office)
 
 
 # ---------------------------------------------------------
 # PARTY LIST HELPER
 # ---------------------------------------------------------
+def _load_party_list():
+    with get_conn() as conn:
+        return conn.execute("SELECT id, party_name, marka FROM party_master ORDER BY party_name").fetchall()
+
+
 def get_party_list():
-    conn = get_conn()
-    cur = conn.cursor()
-    cur.execute("SELECT id, party_name, marka FROM party_master ORDER BY party_name")
-    rows = cur.fetchall()
-    conn.close()
-    return rows
+    return list(_read_cache.get(("party_list",), _load_party_list, tables=("party_master",)))
 
 
 # ---------------------------------------------------------
 # PARTY BALANCE = TOTAL TOKENS - TOTAL PAYMENTS
 # ---------------------------------------------------------
+# party_balance holds the running totals; triggers on tokens and payments
+# (migration 5) keep it current, so a balance read is one primary-key lookup.
+_PARTY_TOTALS_SQL = """
+    SELECT party_id, SUM(token_total), SUM(payment_total) FROM (
+        SELECT party_id, COALESCE(SUM(amount), 0) AS token_total, 0 AS payment_total
+        FROM tokens WHERE party_id IS NOT NULL AND status IS NOT 'CANCELLED' GROUP BY party_id
+        UNION ALL
+        SELECT party_id, 0, COALESCE(SUM(amount), 0)
+        FROM payments WHERE party_id IS NOT NULL GROUP BY party_id
+    ) GROUP BY party_id
+"""
+
+
+# party_balance only changes with tokens / payments (or a rebuild)
+_BALANCE_TABLES = ("tokens", "payments", "party_balance")
+
+
+def _fill_party_balance(cur):
+    cur.execute("DELETE FROM party_balance")
+    cur.execute(f"INSERT INTO party_balance (party_id, token_total, payment_total) {_PARTY_TOTALS_SQL}")
+
+
+def _load_party_balance(party_id: int):
+    with get_conn() as conn:
+        row = conn.execute("SELECT token_total - payment_total FROM party_balance WHERE party_id=?",
+                           (party_id,)).fetchone()
+    return row[0] if row else 0.0
+
+
 def compute_party_balance(party_id: int):
-    conn = get_conn()
-    cur = conn.cursor()
+    return _read_cache.get(("party_balance", party_id), lambda: _load_party_balance(party_id),
+                           tables=_BALANCE_TABLES)
+
+
+# Outstanding report: SQLite does the grouping, the filter, the sort and the
+# paging, so only one page of rows ever leaves it. The party count and grand
+# total of the filtered set come from a separate aggregate over the same
+# rows, so they stay right on any page and let an out-of-range page be
+# clamped to the last one.
+# "Today" reads party_balance; an earlier cut-off day groups tokens and
+# payments up to that day (covered by ix_tokens_day_cover / ix_payments_party_day).
+OUTSTANDING_SORTS = {
+    "outstanding": "x.balance",
+    "billing": "x.token_total",
+    "payments": "x.payment_total",
+    "party": "party_name COLLATE NOCASE",
+}
+
+_PARTY_TOTALS_UNTIL_SQL = """
+    SELECT party_id, SUM(token_total) AS token_total, SUM(payment_total) AS payment_total FROM (
+        SELECT party_id, COALESCE(SUM(amount), 0) AS token_total, 0 AS payment_total
+        FROM tokens
+        WHERE business_day <= :as_of AND party_id IS NOT NULL AND status IS NOT 'CANCELLED'
+        GROUP BY party_id
+        UNION ALL
+        SELECT party_id, 0, COALESCE(SUM(amount), 0)
+        FROM payments WHERE business_day <= :as_of AND party_id IS NOT NULL GROUP BY party_id
+    ) GROUP BY party_id
+"""
+
+_OUTSTANDING_FROM_SQL = """
+    FROM (
+        SELECT party_id, token_total, payment_total, token_total - payment_total AS balance
+        FROM {source}
+    ) x
+    LEFT JOIN party_master p ON p.id = x.party_id
+    WHERE :min_amount IS NULL OR x.balance > :min_amount
+"""
+
+
+def get_outstanding(sort: str = "outstanding", descending: bool = True, min_amount: float = None,
+                    limit: int = 50, offset: int = 0, as_of: date = None):
+    """
+    One page of the outstanding-by-party report.
+
+    sort: a key of OUTSTANDING_SORTS; min_amount keeps only parties whose
+    balance is above it; as_of is the last business day to count (None = now).
+    An offset past the last row is moved to the start of the last page.
+    Returns {"rows": [(party_name, token_total, payment_total, balance), ...],
+    "parties": matching party count, "outstanding": their total balance,
+    "offset": offset of the page returned}.
+    """
+    if sort not in OUTSTANDING_SORTS:
+        raise ValueError(f"Unknown sort: {sort}")
+    limit = max(int(limit), 1)
+    source = "party_balance" if as_of is None else f"({_PARTY_TOTALS_UNTIL_SQL})"
+    filtered = _OUTSTANDING_FROM_SQL.format(source=source)
+    params = {"min_amount": min_amount}
+    if as_of is not None:
+        params["as_of"] = as_of.isoformat()
+    tables = _BALANCE_TABLES + ("party_master",)
+
+    _, totals = cached_query(f"SELECT COUNT(*), COALESCE(SUM(x.balance), 0) {filtered}", params, tables)
+    parties, outstanding = totals[0]
+    offset = min(max(int(offset), 0), (max(parties - 1, 0) // limit) * limit)
+
+    _, rows = cached_query(f"""
+        SELECT COALESCE(p.party_name, 'Unknown') AS party_name, x.token_total, x.payment_total, x.balance
+        {filtered}
+        ORDER BY {OUTSTANDING_SORTS[sort]} {"DESC" if descending else "ASC"}, party_name COLLATE NOCASE
+        LIMIT :limit OFFSET :offset
+    """, dict(params, limit=limit, offset=offset), tables)
+    return {"rows": rows, "parties": parties, "outstanding": outstanding, "offset": offset}
+
+
+# Party ledger: tokens (debit) and payments (credit) merged by one UNION ALL,
+# ordered by the typed timestamps, with the running balance from a window sum.
+_LEDGER_SQL = """
+    SELECT strftime('%d-%m-%Y', x.day) AS date, x.type, x.details, x.debit, x.credit,
+           :opening + SUM(x.debit - x.credit) OVER (
+               ORDER BY x.at, x.kind, x.ref ROWS UNBOUNDED PRECEDING) AS balance
+    FROM (
+        SELECT t.business_day AS day, t.booked_at AS at, 0 AS kind, t.id AS ref, 'TOKEN' AS type,
+               'Token #' || t.id AS details, COALESCE(t.amount, 0) AS debit, 0 AS credit
+        FROM tokens t
+        WHERE t.party_id = :party_id AND t.business_day BETWEEN :start AND :end
+          AND t.status IS NOT 'CANCELLED'
+        UNION ALL
+        SELECT p.business_day, p.paid_at, 1, p.id, 'PAYMENT',
+               'Payment (' || COALESCE(p.mode, '') || ')'
+                   || CASE WHEN COALESCE(p.remark, '') <> '' THEN ' - ' || p.remark ELSE '' END,
+               0, COALESCE(p.amount, 0)
+        FROM payments p
+        WHERE p.party_id = :party_id AND p.business_day BETWEEN :start AND :end
+    ) x
+    ORDER BY x.at, x.kind, x.ref
+"""
+
+
+def get_party_ledger(party_id: int, start_day: date, end_day: date, opening_balance: float = 0.0):
+    """
+    Ledger of a party for start_day..end_day (business days, inclusive):
+    (column_names, rows) with rows of (date, type, details, debit, credit, balance),
+    oldest first; balance starts from opening_balance.
+    """
+    return cached_query(_LEDGER_SQL, {"party_id": party_id, "start": start_day.isoformat(),
+                                      "end": end_day.isoformat(), "opening": float(opening_balance)},
+                        tables=("tokens", "payments"))
+
+
+def rebuild_party_balance():
+    """Recompute party_balance from scratch (full scan of tokens and payments)."""
+    with transaction() as conn:
+        cur = conn.cursor()
+        _fill_party_balance(cur)
+        _touch_tables(cur, "party_balance")
+
+
+def verify_party_balance(tolerance: float = 0.005):
+    """
+    Compare party_balance with a full recomputation.
+    Returns a list of (party_id, stored_balance, expected_balance) that differ;
+    an empty list means the table is correct.
+    """
+    with get_conn() as conn:
+        cur = conn.cursor()
+        cur.execute("SELECT party_id, token_total - payment_total FROM party_balance")
+        stored = dict(cur.fetchall())
+        cur.execute(_PARTY_TOTALS_SQL)
+        expected = {pid: tok - paid for pid, tok, paid in cur.fetchall()}
+
+    mismatches = []
+    for pid in sorted(set(stored) | set(expected)):
+        have, want = stored.get(pid, 0.0), expected.get(pid, 0.0)
+        if abs(have - want) > tolerance:
+            mismatches.append((pid, have, want))
+    return mismatches
+
+
+# ---------------------------------------------------------
+# MONTH CLOSING (closed_period / party_closing_balance)
+# ---------------------------------------------------------
+# close_period() stores every party's balance at a month end, computed from
+# the previous closed month plus that month's tokens and payments. A party
+# with no row at a closed month had a zero balance there. Opening balances
+# then read the nearest closed month before the day plus the few rows after
+# it, instead of the party's whole history.
+_CLOSING_SELECT_SQL = """
+    SELECT :end, party_id, SUM(v) FROM (
+        SELECT party_id, closing_balance AS v FROM party_closing_balance WHERE period_end = :prev
+        UNION ALL
+        SELECT party_id, COALESCE(amount, 0) FROM tokens
+        WHERE business_day > :prev AND business_day <= :end
+          AND party_id IS NOT NULL AND status IS NOT 'CANCELLED'
+        UNION ALL
+        SELECT party_id, -COALESCE(amount, 0) FROM payments
+        WHERE business_day > :prev AND business_day <= :end AND party_id IS NOT NULL
+    ) GROUP BY party_id
+"""
+
+_OPENING_BALANCE_SQL = """
+    SELECT
+        COALESCE((SELECT closing_balance FROM party_closing_balance
+                  WHERE period_end = {cp} AND party_id = :party_id), 0)
+      + COALESCE((SELECT SUM(amount) FROM tokens
+                  WHERE party_id = :party_id AND business_day > COALESCE({cp}, '') AND business_day < :day
+                    AND status IS NOT 'CANCELLED'), 0)
+      - COALESCE((SELECT SUM(amount) FROM payments
+                  WHERE party_id = :party_id AND business_day > COALESCE({cp}, '') AND business_day < :day), 0),
+        {cp}
+""".format(cp="(SELECT MAX(period_end) FROM closed_period WHERE period_end < :day)")
+
+
+def _month_end(day: date):
+    nxt = date(day.year + (day.month == 12), day.month % 12 + 1, 1)
+    return nxt - timedelta(days=1)
+
+
+def _as_month(month):
+    """date, or 'YYYY-MM' / 'YYYY-MM-DD' text -> last day of that month."""
+    if isinstance(month, str):
+        try:
+            month = datetime.strptime(month.strip()[:7], "%Y-%m").date()
+        except ValueError:
+            raise ValueError(f"Month must be YYYY-MM, got {month!r}")
+    return _month_end(month)
+
+
+def _last_complete_month():
+    today = (datetime.utcnow() + IST_OFFSET).date()
+    return today.replace(day=1) - timedelta(days=1)
+
+
+def close_period(month=None):
+    """
+    Store every party's closing balance for one month (default: last month).
+    Re-closing a month recomputes it. Returns the number of party rows written.
+    """
+    end = _as_month(month or _last_complete_month())
+    if end > _last_complete_month():
+        raise ValueError(f"{end:%Y-%m} is not over yet")
+    with transaction() as conn:
+        cur = conn.cursor()
+        cur.execute("SELECT COALESCE(MAX(period_end), '') FROM closed_period WHERE period_end < ?",
+                    (end.isoformat(),))
+        prev = cur.fetchone()[0]
+        cur.execute("INSERT OR REPLACE INTO party_closing_balance (period_end, party_id, closing_balance)"
+                    + _CLOSING_SELECT_SQL, {"end": end.isoformat(), "prev": prev})
+        cur.execute("SELECT COUNT(*) FROM party_closing_balance WHERE period_end = ?", (end.isoformat(),))
+        parties = cur.fetchone()[0]
+        cur.execute("INSERT OR REPLACE INTO closed_period (period_end, parties, closed_at) VALUES (?, ?, ?)",
+                    (end.isoformat(), parties, int(time.time())))
+    return parties
+
+
+def close_periods(through=None):
+    """
+    Close every month after the last closed one up to `through` (default:
+    last month), one transaction per month. Months that are not over yet are
+    skipped. Returns the month ends closed.
+    """
+    end = min(_as_month(through or _last_complete_month()), _last_complete_month())
+    with get_conn() as conn:
+        cur = conn.cursor()
+        cur.execute("SELECT MAX(period_end) FROM closed_period")
+        last = cur.fetchone()[0]
+        if last is None:
+            cur.execute("""
+                SELECT MIN(day) FROM (SELECT MIN(business_day) AS day FROM tokens
+                                      UNION ALL SELECT MIN(business_day) FROM payments)
+            """)
+            first = cur.fetchone()[0]
+            start = date.fromisoformat(first) if first else None
+        else:
+            start = date.fromisoformat(last) + timedelta(days=1)
+
+    closed = []
+    while start is not None and _month_end(start) <= end:
+        close_period(start)
+        closed.append(_month_end(start))
+        start = _month_end(start) + timedelta(days=1)
+    return closed
+
+
+def get_closed_periods():
+    """Rows of (period_end, parties, closed_at), latest first."""
+    return cached_query("SELECT period_end, parties, closed_at FROM closed_period ORDER BY period_end DESC",
+                        tables=("closed_period",))[1]
+
+
+def get_opening_balance(party_id: int, day: date):
+    """
+    Party balance before `day` (tokens minus payments on earlier business
+    days): (balance, period_end of the checkpoint used or None).
+    """
+    _, rows = cached_query(_OPENING_BALANCE_SQL, {"party_id": party_id, "day": day.isoformat()},
+                           tables=("closed_period", "party_closing_balance", "tokens", "payments"))
+    return rows[0]
+
+
+def verify_closing_balances(tolerance: float = 0.005):
+    """
+    Compare every stored month-end balance with a full recomputation.
+    Returns a list of (period_end, party_id, stored, expected) that differ.
+    """
+    mismatches = []
+    with get_conn() as conn:
+        cur = conn.cursor()
+        cur.execute("SELECT period_end FROM closed_period ORDER BY period_end")
+        for (end,) in cur.fetchall():
+            cur.execute("SELECT party_id, closing_balance FROM party_closing_balance WHERE period_end = ?", (end,))
+            stored = dict(cur.fetchall())
+            cur.execute(_CLOSING_SELECT_SQL, {"end": end, "prev": ""})
+            expected = {pid: bal for _, pid, bal in cur.fetchall()}
+            for pid in sorted(set(stored) | set(expected)):
+                have, want = stored.get(pid, 0.0), expected.get(pid, 0.0)
+                if abs(have - want) > tolerance:
+                    mismatches.append((end, pid, have, want))
+    return mismatches
+
+
+# ---------------------------------------------------------
+# DAILY BOOKING ROLLUP (daily_route_party_summary)
+# ---------------------------------------------------------
+# Triggers from migration 11 keep the rollup in step with every token insert,
+# edit, cancel and delete. The rebuild below is only for repair; it works in
+# month-sized transactions so bookings are never blocked for long, and each
+# chunk is consistent because the triggers keep running between chunks.
+SUMMARY_REBUILD_DAYS = 31
+
+_summary_rebuild = {"running": False, "last": None, "error": None}
+_summary_rebuild_lock = threading.Lock()
+
+
+def _fill_daily_summary(cur, start: str = None, end: str = None):
+    """Recompute the rollup for start..end (business_day text, inclusive), or for all days."""
+    if start is None:
+        cur.execute("DELETE FROM daily_route_party_summary")
+        where, params = "", ()
+    else:
+        cur.execute("DELETE FROM daily_route_party_summary WHERE business_day BETWEEN ? AND ?", (start, end))
+        where, params = " AND business_day BETWEEN ? AND ?", (start, end)
+    cur.execute(f"""
+        INSERT INTO daily_route_party_summary
+            (business_day, from_city, to_city, party_id, tokens, weight, pkgs, amount, pending, loaded, delivered)
+        {_SUMMARY_SELECT_SQL.format(where=where)}
+    """, params)
+
+
+def rebuild_daily_summary(chunk_days: int = SUMMARY_REBUILD_DAYS):
+    """Recompute daily_route_party_summary from tokens, chunk_days per transaction."""
+    started = time.perf_counter()
+    with get_conn() as conn:
+        first, last = conn.execute("SELECT MIN(business_day), MAX(business_day) FROM tokens").fetchone()
+
+    chunks = 0
+    with transaction() as conn:
+        # days outside the token range can only hold stale rows
+        conn.execute("DELETE FROM daily_route_party_summary WHERE ? IS NULL OR business_day NOT BETWEEN ? AND ?",
+                     (first, first, last))
+        _touch_tables(conn.cursor(), "daily_route_party_summary")
+    if first:
+        day, end = date.fromisoformat(first), date.fromisoformat(last)
+        while day <= end:
+            upto = min(day + timedelta(days=chunk_days - 1), end)
+            with transaction() as conn:
+                cur = conn.cursor()
+                _fill_daily_summary(cur, day.isoformat(), upto.isoformat())
+                _touch_tables(cur, "daily_route_party_summary")
+            chunks += 1
+            day = upto + timedelta(days=1)
+    return {"first_day": first, "last_day": last, "chunks": chunks,
+            "elapsed_ms": (time.perf_counter() - started) * 1000}
+
+
+def start_daily_summary_rebuild(chunk_days: int = SUMMARY_REBUILD_DAYS):
+    """Run rebuild_daily_summary() on a background thread. Returns False if one is already running."""
+    with _summary_rebuild_lock:
+        if _summary_rebuild["running"]:
+            return False
+        _summary_rebuild.update(running=True, error=None)
+
+    def run():
+        try:
+            result = rebuild_daily_summary(chunk_days)
+            _summary_rebuild.update(last=result)
+        except Exception as e:
+            _summary_rebuild.update(error=str(e))
+        finally:
+            _summary_rebuild.update(running=False)
+
+    threading.Thread(target=run, name="daily-summary-rebuild", daemon=True).start()
+    return True
+
+
+def get_daily_summary_rebuild_status():
+    """{'running': bool, 'last': result of the last rebuild or None, 'error': str or None}"""
+    return dict(_summary_rebuild)
+
+
+def verify_daily_summary():
+    """Rollup rows that differ from a fresh grouping of tokens: [(key, stored, expected)]."""
+    with get_conn() as conn:
+        cur = conn.cursor()
+        cur.execute("""
+            SELECT business_day, from_city, to_city, party_id, tokens, weight, pkgs, amount, pending, loaded, delivered
+            FROM daily_route_party_summary WHERE tokens <> 0
+        """)
+        stored = {r[:4]: r[4:] for r in cur.fetchall()}
+        cur.execute(_SUMMARY_SELECT_SQL.format(where=""))
+        expected = {r[:4]: r[4:] for r in cur.fetchall()}
+
+    out = []
+    for key in sorted(set(stored) | set(expected)):
+        have, want = stored.get(key), expected.get(key)
+        if have is None or want is None or any(abs(a - b) > 0.005 for a, b in zip(have, want)):
+            out.append((key, have, want))
+    return out
 
-    cur.execute("SELECT COALESCE(SUM(amount),0) FROM tokens WHERE party_id=?", 
-                (party_id,))
-    token_total = cur.fetchone()[0]
 
-    cur.execute("SELECT COALESCE(SUM(amount),0) FROM payments WHERE party_id=?", 
-                (party_id,))
-    paid = cur.fetchone()[0]
+# Report grain -> SQL expression over business_day
+_SUMMARY_GRAINS = {
+    "day": "business_day",
+    "week": "date(business_day, '-' || ((strftime('%w', business_day) + 6) % 7) || ' days')",
+    "month": "substr(business_day, 1, 7) || '-01'",
+}
 
-    conn.close()
-    return token_total - paid
+
+def get_booking_summary(start_day: date, end_day: date, grain: str = "day",
+                        from_city: str = None, to_city: str = None):
+    """
+    Bookings per day / week (Monday start) / month from the rollup:
+    (column_names, rows) with rows of (period_start, tokens, weight, pkgs, amount).
+    """
+    sql = f"""
+        SELECT {_SUMMARY_GRAINS[grain]} AS period, SUM(tokens) AS tokens, SUM(weight) AS weight,
+               SUM(pkgs) AS pkgs, SUM(amount) AS amount
+        FROM daily_route_party_summary
+        WHERE business_day BETWEEN ? AND ?{" AND from_city = ?" if from_city else ""}{" AND to_city = ?" if to_city else ""}
+        GROUP BY period
+        HAVING SUM(tokens) <> 0
+        ORDER BY period
+    """
+    params = [start_day.isoformat(), end_day.isoformat()]
+    params += [normalize_city(c) for c in (from_city, to_city) if c]
+    return cached_query(sql, params, tables=("daily_route_party_summary", "tokens"))
+
+
+# =========================================================
+# CITY / ROUTE MASTER
+# =========================================================
+# City names are stored upper-cased and trimmed; lookups compare with NOCASE
+# so an index on the city columns still applies.
+def normalize_city(name: str):
+    return (name or "").strip().upper() or None
+
+
+def _ensure_city(cur, name: str):
+    name = normalize_city(name)
+    cur.execute("INSERT OR IGNORE INTO city (name) VALUES (?)", (name,))
+    cur.execute("SELECT id FROM city WHERE name = ?", (name,))
+    return cur.fetchone()[0]
+
+
+def _ensure_route(cur, from_city: str, to_city: str):
+    from_id, to_id = _ensure_city(cur, from_city), _ensure_city(cur, to_city)
+    cur.execute("INSERT OR IGNORE INTO route (from_city_id, to_city_id) VALUES (?, ?)", (from_id, to_id))
+    cur.execute("SELECT id FROM route WHERE from_city_id = ? AND to_city_id = ?", (from_id, to_id))
+    return cur.fetchone()[0]
+
+
+def _read_route_master():
+    with get_conn() as conn:
+        cur = conn.cursor()
+        cur.execute("""
+            SELECT r.id, f.name, t.name
+            FROM route r
+            JOIN city f ON f.id = r.from_city_id
+            JOIN city t ON t.id = r.to_city_id
+            ORDER BY f.name, t.name
+        """)
+        routes = cur.fetchall()
+        cur.execute("""
+            SELECT o.office, f.name, t.name
+            FROM office_route o
+            JOIN route r ON r.id = o.route_id
+            JOIN city f ON f.id = r.from_city_id
+            JOIN city t ON t.id = r.to_city_id
+        """)
+        offices = {office.upper(): (frm, to) for office, frm, to in cur.fetchall()}
+        cur.execute("SELECT name, id FROM office")
+        office_ids = {name.upper(): oid for name, oid in cur.fetchall()}
+    return {"routes": routes, "offices": offices, "office_ids": office_ids}
+
+
+ROUTE_TABLES = ("city", "route", "office_route", "office")
+
+
+def _load_route_cache():
+    """Routes, office defaults and office ids are tiny and change rarely; served from the read cache."""
+    return _read_cache.get(("route_master",), _read_route_master, tables=ROUTE_TABLES)
+
+
+def invalidate_route_cache():
+    _read_cache.discard(("route_master",))
+
+
+def get_routes():
+    """All routes as (route_id, from_city, to_city)."""
+    return list(_load_route_cache()["routes"])
+
+
+def get_office_routes():
+    """{OFFICE: (from_city, to_city)} for every office with a default route."""
+    return dict(_load_route_cache()["offices"])
+
+
+def get_office_route(office: str):
+    """Default (from_city, to_city) for an operator's office, or None."""
+    return _load_route_cache()["offices"].get((office or "").strip().upper())
+
+
+def _office_id(cur, office: str = None, from_city: str = None):
+    """
+    office_id for a write: the named office (created if new), else the office
+    whose default route starts at from_city, else None.
+    """
+    if office and office.strip():
+        name = office.strip().upper()
+        cur.execute("INSERT OR IGNORE INTO office (name) VALUES (?)", (name,))
+        cur.execute("SELECT id FROM office WHERE name = ?", (name,))
+        return cur.fetchone()[0]
+    if from_city:
+        cur.execute(_OFFICE_FOR_CITY_SQL.format(city="?"), (normalize_city(from_city),))
+        row = cur.fetchone()
+        return row[0] if row else None
+    return None
+
+
+def get_office_id(office: str):
+    """Id of an office by name (cached), or None if it has never been used."""
+    return _load_route_cache()["office_ids"].get((office or "").strip().upper())
+
+
+def save_route(from_city: str, to_city: str, office: str = None):
+    """
+    Add a route (and its cities) if missing; with office, make it that
+    office's default route. Returns route id.
+    """
+    if not normalize_city(from_city) or not normalize_city(to_city):
+        raise ValueError("From and To city are required")
+    if normalize_city(from_city) == normalize_city(to_city):
+        raise ValueError("From and To city must be different")
+    with transaction() as conn:
+        cur = conn.cursor()
+        route_id = _ensure_route(cur, from_city, to_city)
+        if office and office.strip():
+            _office_id(cur, office)
+            cur.execute("INSERT OR REPLACE INTO office_route (office, route_id) VALUES (?, ?)",
+                        (office.strip().upper(), route_id))
+    invalidate_route_cache()
+    return route_id
+
+
+def save_rate(party_id: int, from_city: str, to_city: str, rate_type: str, rate: float):
+    """Insert a rate_master row for a route (the route is registered if new)."""
+    with transaction() as conn:
+        cur = conn.cursor()
+        _ensure_route(cur, from_city, to_city)
+        cur.execute("""
+            INSERT INTO rate_master (party_id, from_city, to_city, rate_type, rate)
+            VALUES (?, ?, ?, ?, ?)
+        """, (party_id, normalize_city(from_city), normalize_city(to_city), rate_type, rate))
+    invalidate_route_cache()
 
 
 # =========================================================
 # MARKA & TOKEN HELPERS
 # =========================================================
+def split_markas(marka_field: str):
+    """'ABC, xyz,,ABC' -> ['ABC', 'xyz'] (trimmed, blanks and case-insensitive repeats dropped)."""
+    out, seen = [], set()
+    for m in (marka_field or "").split(","):
+        m = m.strip()
+        if m and m.upper() not in seen:
+            seen.add(m.upper())
+            out.append(m)
+    return out
+
+
 def get_all_markas():
     """
     Return a list of ALL markas with associated party info.
-    One party can have multiple markas (comma-separated in DB).
+    One party can have multiple markas (one party_marka row each).
     Each item: {'marka': str, 'party_id': int, 'party_name': str}
     """
-    conn = get_conn()
-    cur = conn.cursor()
-    cur.execute("""
-        SELECT id, party_name, marka 
-        FROM party_master 
-        WHERE marka IS NOT NULL AND TRIM(marka) <> '' 
-        ORDER BY party_name, marka
-    """)
-    rows = cur.fetchall()
-    conn.close()
-    
-    out = []
-    for r in rows:
-        party_id, party_name, marka_field = r
-        # Split comma-separated markas
-        if marka_field and ',' in marka_field:
-            markas = [m.strip() for m in marka_field.split(',') if m.strip()]
-            for single_marka in markas:
-                out.append({
-                    'marka': single_marka, 
-                    'party_id': party_id, 
-                    'party_name': party_name
-                })
-        else:
-            # Single marka
-            out.append({
-                'marka': marka_field, 
-                'party_id': party_id, 
-                'party_name': party_name
-            })
+    with get_conn() as conn:
+        rows = conn.execute("""
+            SELECT m.marka, m.party_id, p.party_name
+            FROM party_marka m
+            JOIN party_master p ON p.id = m.party_id
+            ORDER BY p.party_name, m.marka
+        """).fetchall()
+    return [{'marka': r[0], 'party_id': r[1], 'party_name': r[2]} for r in rows]
+
+
+def find_markas(markas, conn=None):
+    """
+    Indexed, case-insensitive lookup of several markas.
+    Returns {MARKA_UPPER: (party_id, marka as stored, party_name)} for the ones that exist.
+    """
+    markas = list({m.strip().upper() for m in markas if m and m.strip()})
+    if conn is None:
+        with get_conn() as conn:
+            return find_markas(markas, conn)
+    out = {}
+    for chunk in _chunks(markas):
+        placeholder = ",".join(["?"] * len(chunk))
+        cur = conn.execute(f"""
+            SELECT m.marka, m.party_id, p.party_name
+            FROM party_marka m
+            JOIN party_master p ON p.id = m.party_id
+            WHERE m.marka IN ({placeholder})
+        """, chunk)
+        for marka, party_id, party_name in cur.fetchall():
+            out[marka.upper()] = (party_id, marka, party_name)
     return out
 
 
+def save_party(party_name: str, address: str = None, mobile: str = None, gst_no: str = None,
+               marka: str = None, default_rate_per_kg: float = None,
+               default_rate_per_parcel: float = None):
+    """
+    Insert or update a party (matched by party_name) and its markas.
+    marka is the comma-separated text from the form; each marka is stored in
+    party_marka and party_master.marka keeps the cleaned list for display.
+    Returns party id.
+
+    Raises:
+        ValueError: if a marka already belongs to another party.
+    """
+    markas = split_markas(marka)
+    with transaction() as conn:
+        cur = conn.cursor()
+        cur.execute("SELECT id FROM party_master WHERE party_name = ?", (party_name,))
+        row = cur.fetchone()
+        party_id = row[0] if row else None
+
+        taken = [(m, pname) for _, (pid, m, pname) in find_markas(markas, conn).items() if pid != party_id]
+        if taken:
+            raise ValueError("Marka already assigned: " + ", ".join(f"{m} ({p})" for m, p in taken))
+
+        values = (address, mobile, gst_no, ", ".join(markas), default_rate_per_kg, default_rate_per_parcel)
+        if party_id is None:
+            cur.execute("""
+                INSERT INTO party_master (party_name, address, mobile, gst_no, marka,
+                                          default_rate_per_kg, default_rate_per_parcel)
+                VALUES (?, ?, ?, ?, ?, ?, ?)
+            """, (party_name, *values))
+            party_id = cur.lastrowid
+        else:
+            cur.execute("""
+                UPDATE party_master
+                SET address = ?, mobile = ?, gst_no = ?, marka = ?,
+                    default_rate_per_kg = ?, default_rate_per_parcel = ?
+                WHERE id = ?
+            """, (*values, party_id))
+
+        cur.execute("DELETE FROM party_marka WHERE party_id = ?", (party_id,))
+        cur.executemany("INSERT INTO party_marka (party_id, marka) VALUES (?, ?)",
+                        [(party_id, m) for m in markas])
+    return party_id
+
+
 def create_token_in_db(marka: str, party_id: int, weight: float, pkgs: int, rate: float,
                        rate_type: str = None, driver_mobile: str = None, from_city: str = None,
-                       to_city: str = None, consignor: str = None, consignee: str = None):
+                       to_city: str = None, consignor: str = None, consignee: str = None,
+                       office: str = None):
     """
     Inserts a token (bilty) with minimal required fields.
+    party_id may be None, in which case it is looked up from the marka.
+    The token number is allocated in the same transaction as the insert.
     Returns inserted token_no (integer).
     """
-    token_no = get_next_token_no()
-    now = datetime.utcnow().isoformat()
+    now_dt = datetime.utcnow()
+    now = now_dt.isoformat()
     amount = (weight or 0.0) * (rate or 0.0)
-
-    conn = get_conn()
-    cur = conn.cursor()
-    cur.execute("""
-        INSERT INTO tokens (token_no, date_time, party_id, consignor, consignee, marka, from_city, to_city,
-                            weight, pkgs, rate, rate_type, amount, driver_mobile, status)
-        VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?)
-    """, (token_no, now, party_id, consignor, consignee, marka, from_city, to_city,
-          weight, pkgs, rate, rate_type, amount, driver_mobile, "PENDING"))
-    conn.commit()
-    conn.close()
+    from_city, to_city = normalize_city(from_city), normalize_city(to_city)
+
+    token_no = _prefetch_doc_no("TOKEN", office)
+    with transaction() as conn:
+        if party_id is None:
+            hit = find_markas([marka], conn).get((marka or "").strip().upper())
+            if hit is None:
+                raise ValueError(f"Unknown marka '{marka}'")
+            party_id, marka = hit[0], hit[1]
+        if token_no is None:
+            token_no = allocate_doc_no(conn, "TOKEN", office)
+        conn.execute("""
+            INSERT INTO tokens (token_no, date_time, booked_at, office_id, party_id, consignor, consignee, marka,
+                                from_city, to_city, weight, pkgs, rate, rate_type, amount, driver_mobile, status)
+            VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?)
+        """, (token_no, now, to_epoch(now_dt), _office_id(conn.cursor(), office, from_city), party_id,
+              consignor, consignee, marka, from_city, to_city,
+              weight, pkgs, rate, rate_type, amount, driver_mobile, "PENDING"))
     return token_no
 
 
-def get_pending_tokens(from_city: str = None, to_city: str = None):
+# ---------------------------------------------------------
+# BULK TOKEN IMPORT
+# ---------------------------------------------------------
+BULK_CHUNK_SIZE = 500
+
+
+def _to_number(value, cast, field, default=None):
+    if value is None or (isinstance(value, str) and not value.strip()):
+        if default is None:
+            raise ValueError(f"{field} is required")
+        return default
+    try:
+        num = float(str(value).replace(",", "").strip())
+    except ValueError:
+        raise ValueError(f"{field} '{value}' is not a number") from None
+    if cast is int:
+        if not num.is_integer():
+            raise ValueError(f"{field} must be a whole number")
+        num = int(num)
+    if num < 0:
+        raise ValueError(f"{field} cannot be negative")
+    return num
+
+
+def _validate_bulk_chunk(chunk, marka_map, from_city, to_city):
+    """Turn (row_no, dict) pairs into insert tuples; returns (good, errors)."""
+    good, errors = [], []
+    for row_no, row in chunk:
+        try:
+            marka = str(row.get("marka") or "").strip()
+            if not marka:
+                raise ValueError("marka is required")
+            party = marka_map.get(marka.upper())
+            if party is None:
+                raise ValueError(f"unknown marka '{marka}'")
+            weight = _to_number(row.get("weight"), float, "weight")
+            pkgs = _to_number(row.get("pkgs"), int, "pkgs", default=1)
+            if pkgs < 1:
+                raise ValueError("pkgs must be at least 1")
+            rate = _to_number(row.get("rate"), float, "rate", default=0.0)
+            rate_type = (str(row.get("rate_type") or "").strip().upper() or None)
+            if rate_type not in (None, "KG", "PARCEL"):
+                raise ValueError(f"rate_type '{rate_type}' must be KG or PARCEL")
+            frm = normalize_city(str(row.get("from_city") or "")) or normalize_city(from_city)
+            to = normalize_city(str(row.get("to_city") or "")) or normalize_city(to_city)
+            if not frm or not to:
+                raise ValueError("from_city and to_city are required")
+            good.append((party[0], str(row.get("consignor") or "").strip() or None,
+                         str(row.get("consignee") or "").strip() or None, party[1], frm, to,
+                         weight, pkgs, rate, rate_type, weight * rate,
+                         str(row.get("driver_mobile") or "").strip() or None))
+        except ValueError as e:
+            errors.append((row_no, str(e)))
+    return good, errors
+
+
+def create_tokens_bulk(rows, from_city: str = None, to_city: str = None, office: str = None,
+                       chunk_size: int = BULK_CHUNK_SIZE):
+    """
+    Book many tokens (bilties) at once.
+    rows: iterable of (row_no, dict) with keys marka, weight, pkgs, rate and
+    optionally rate_type, from_city, to_city, consignor, consignee,
+    driver_mobile. from_city / to_city fill rows that leave them blank.
+    Rows are validated in chunks as they stream in; every valid row is then
+    inserted with executemany in one transaction, with a single block of
+    token numbers. Invalid rows are skipped and reported.
+    Returns dict: inserted, first_token_no, last_token_no, rows_total,
+    errors [(row_no, message)], elapsed_ms, rows_per_sec.
+    """
+    started = time.perf_counter()
+    # MARKA_UPPER -> (party_id, marka, party_name), filled per chunk from party_marka
+    marka_map = {}
+
+    def validate(chunk):
+        wanted = {str(r.get("marka") or "").strip().upper() for _, r in chunk}
+        missing = [m for m in wanted if m and m not in marka_map]
+        if missing:
+            marka_map.update(find_markas(missing))
+        g, e = _validate_bulk_chunk(chunk, marka_map, from_city, to_city)
+        good.extend(g)
+        errors.extend(e)
+
+    good, errors, chunk, rows_total = [], [], [], 0
+    for item in rows:
+        rows_total += 1
+        chunk.append(item)
+        if len(chunk) >= chunk_size:
+            validate(chunk)
+            chunk = []
+    if chunk:
+        validate(chunk)
+
+    first_no = last_no = None
+    if good:
+        now_dt = datetime.utcnow()
+        stamp = (now_dt.isoformat(), to_epoch(now_dt))
+        with transaction() as conn:
+            cur = conn.cursor()
+            first_no = allocate_doc_no(conn, "TOKEN", office, count=len(good))
+            last_no = first_no + len(good) - 1
+            # importing office, else the office at each row's origin city
+            office_ids = {}
+            for r in good:
+                if r[4] not in office_ids:
+                    office_ids[r[4]] = _office_id(cur, office, r[4])
+            for offset in range(0, len(good), chunk_size):
+                part = good[offset:offset + chunk_size]
+                cur.executemany("""
+                    INSERT INTO tokens (token_no, date_time, booked_at, office_id, party_id, consignor, consignee,
+                                        marka, from_city, to_city, weight, pkgs, rate, rate_type, amount,
+                                        driver_mobile, status)
+                    VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, 'PENDING')
+                """, [(first_no + offset + k, *stamp, office_ids[r[4]]) + r for k, r in enumerate(part)])
+
+    elapsed = time.perf_counter() - started
+    return {
+        "inserted": len(good),
+        "first_token_no": first_no,
+        "last_token_no": last_no,
+        "rows_total": rows_total,
+        "errors": errors,
+        "elapsed_ms": elapsed * 1000.0,
+        "rows_per_sec": rows_total / elapsed if elapsed > 0 else 0.0,
+    }
+
+
+class PendingToken:
+    """
+    Compact row for the pending-token list (no per-row dict).
+    Read fields as attributes (t.weight); t["weight"] and t.get("weight")
+    also work for code written against the old dict rows.
+    """
+    __slots__ = ("id", "token_no", "date_time", "party_id", "marka", "from_city", "to_city",
+                 "weight", "pkgs", "rate", "amount", "party_name")
+
+    def __init__(self, row):
+        for name, value in zip(self.__slots__, row):
+            setattr(self, name, value)
+
+    def __getitem__(self, key):
+        try:
+            return getattr(self, key)
+        except AttributeError:
+            raise KeyError(key) from None
+
+    def get(self, key, default=None):
+        return getattr(self, key, default)
+
+    def __repr__(self):
+        return f"PendingToken(id={self.id}, token_no={self.token_no}, marka={self.marka!r})"
+
+
+def get_pending_tokens(from_city: str = None, to_city: str = None, session_id: str = None,
+                       office: str = None):
     """
     Returns list of pending tokens (status = 'PENDING') with party names.
-    Each item is a dict with token fields including party_name.
-    Case-insensitive matching for from/to city to avoid missed rows.
+    Each item is a PendingToken with token fields including party_name.
+    Case-insensitive matching for from/to city (NOCASE, so the route index is used).
+    With session_id, tokens another session currently has reserved
+    (see reserve_tokens) are left out. With office, only that office's
+    bookings are returned (ix_tokens_office_pending).
+    Served from the read cache until the next commit or reservation expiry.
     """
-    conn = get_conn()
-    cur = conn.cursor()
+    key = ("pending_tokens", (office or "").strip().upper(), normalize_city(from_city) if from_city else None,
+           normalize_city(to_city) if from_city and to_city else None, session_id)
+    rows, _ = _read_cache.get(
+        key, lambda: _load_pending_tokens(from_city, to_city, session_id, office),
+        expires_at=lambda loaded: loaded[1], tables=("tokens", "party_master", "token_reservation"))
+    return list(rows)
 
-    if from_city and to_city:
-        cur.execute("""
-            SELECT t.id, t.token_no, t.date_time, t.party_id, t.marka, 
-                   t.from_city, t.to_city, t.weight, t.pkgs, t.rate, t.amount,
-                   COALESCE(p.party_name, 'Unknown') as party_name
-            FROM tokens t
-            LEFT JOIN party_master p ON t.party_id = p.id
-            WHERE t.status = 'PENDING' 
-              AND UPPER(t.from_city) = UPPER(?) 
-              AND UPPER(t.to_city) = UPPER(?)
-            ORDER BY t.marka, t.token_no
-        """, (from_city, to_city))
-    elif from_city:
-        cur.execute("""
-            SELECT t.id, t.token_no, t.date_time, t.party_id, t.marka, 
-                   t.from_city, t.to_city, t.weight, t.pkgs, t.rate, t.amount,
-                   COALESCE(p.party_name, 'Unknown') as party_name
-            FROM tokens t
-            LEFT JOIN party_master p ON t.party_id = p.id
-            WHERE t.status = 'PENDING' AND UPPER(t.from_city) = UPPER(?)
-            ORDER BY t.marka, t.token_no
-        """, (from_city,))
-    else:
-        cur.execute("""
-            SELECT t.id, t.token_no, t.date_time, t.party_id, t.marka, 
+
+def _load_pending_tokens(from_city, to_city, session_id, office):
+    """
+    Query behind get_pending_tokens. Returns (rows, next_expiry): next_expiry
+    is when the earliest foreign reservation lapses (the list changes then
+    without any commit), or None.
+    """
+    now = time.time()
+    where = ["t.status = 'PENDING'"]
+    params = []
+    if office:
+        where.insert(0, "t.office_id = ?")
+        params.append(get_office_id(office))
+    if from_city:
+        where.append("t.from_city = ? COLLATE NOCASE")
+        params.append(normalize_city(from_city))
+        if to_city:
+            where.append("t.to_city = ? COLLATE NOCASE")
+            params.append(normalize_city(to_city))
+    if session_id:
+        where.append("""NOT EXISTS (
+                SELECT 1 FROM token_reservation r
+                WHERE r.token_id = t.id AND r.session_id <> ? AND r.expires_at > ?)""")
+        params.extend([session_id, now])
+
+    with get_conn() as conn:
+        cur = conn.cursor()
+        cur.execute(f"""
+            SELECT t.id, t.token_no, t.date_time, t.party_id, t.marka,
                    t.from_city, t.to_city, t.weight, t.pkgs, t.rate, t.amount,
                    COALESCE(p.party_name, 'Unknown') as party_name
             FROM tokens t
             LEFT JOIN party_master p ON t.party_id = p.id
-            WHERE t.status = 'PENDING'
+            WHERE {" AND ".join(where)}
             ORDER BY t.marka, t.token_no
-        """)
+        """, params)
 
-    rows = cur.fetchall()
-    conn.close()
-    out = []
-    for r in rows:
-        out.append({
-            "id": r[0],
-            "token_no": r[1],
-            "date_time": r[2],
-            "party_id": r[3],
-            "marka": r[4],
-            "from_city": r[5],
-            "to_city": r[6],
-            "weight": r[7],
-            "pkgs": r[8],
-            "rate": r[9],
-            "amount": r[10],
-            "party_name": r[11]  # CRITICAL: party_name included
-        })
-    return out
+        rows = [PendingToken(r) for r in cur.fetchall()]
+        next_expiry = None
+        if session_id:
+            cur.execute("SELECT MIN(expires_at) FROM token_reservation WHERE session_id <> ? AND expires_at > ?",
+                        (session_id, now))
+            next_expiry = cur.fetchone()[0]
+    return rows, next_expiry
+
+
+def cancel_token(token_id: int):
+    """
+    Cancel a booking that has not been loaded yet. The token row stays (its
+    number is not reused) with status CANCELLED; triggers take it out of
+    party_balance and daily_route_party_summary.
+    Raises ValueError if the token is missing or already loaded/delivered.
+    """
+    with transaction() as conn:
+        cur = conn.execute("UPDATE tokens SET status = 'CANCELLED' WHERE id = ? AND status = 'PENDING'",
+                           (token_id,))
+        if cur.rowcount == 0:
+            row = conn.execute("SELECT status FROM tokens WHERE id = ?", (token_id,)).fetchone()
+            if row is None:
+                raise ValueError(f"Token id {token_id} not found")
+            raise ValueError(f"Token is {row[0]}; only PENDING tokens can be cancelled")
+        conn.execute("DELETE FROM token_reservation WHERE token_id = ?", (token_id,))
 
 
 def group_tokens_by_marka(tokens_list):
     """
-    Accepts list of tokens (dicts) and returns grouped list:
+    Accepts list of tokens (PendingToken or dicts) and returns grouped list:
     [{'marka': 'X', 'tokens': [ ... ]}, ...]
     """
     grouped = {}
@@ -467,77 +2363,382 @@ def group_tokens_by_marka(tokens_list):
 # =========================================================
 # CHALLAN HELPERS
 # =========================================================
-def create_challan(token_ids: list, from_city: str, to_city: str, truck_no: str,
-                   driver_name: str, driver_mobile: str, hire: float = 0.0,
-                   loading_hamali: float = 0.0, unloading_hamali: float = 0.0, other_exp: float = 0.0):
+# ---------------------------------------------------------
+# TOKEN RESERVATIONS (CHALLAN LOADING)
+# ---------------------------------------------------------
+# While an operator ticks tokens on the challan screen they hold a short
+# reservation, so other sessions' pending lists hide those tokens. The
+# LOADED claim in create_challan_batch() is the real guard; reservations
+# only keep two operators from picking the same bilty in the first place.
+RESERVATION_TTL_S = 300
+
+
+class TokensUnavailableError(ValueError):
+    """Raised when tokens picked for a challan were loaded or reserved elsewhere."""
+
+    def __init__(self, message: str, token_ids: list):
+        super().__init__(message)
+        self.token_ids = token_ids
+
+
+def reserve_tokens(session_id: str, token_ids: list, ttl_s: float = RESERVATION_TTL_S):
     """
-    Creates a challan with given token ids.
-    Marks tokens as LOADED and creates mapping entries.
-    Returns challan_no (int).
+    Reserve token ids for session_id (or extend its existing reservations).
+    Returns the ids that are held by another session and were not reserved.
     """
+    token_ids = list(dict.fromkeys(token_ids))
+    if not token_ids:
+        return []
+    now = time.time()
+    with transaction() as conn:
+        cur = conn.cursor()
+        cur.execute("DELETE FROM token_reservation WHERE expires_at <= ?", (now,))
+        cur.executemany("""
+            INSERT INTO token_reservation (token_id, session_id, expires_at)
+            VALUES (?, ?, ?)
+            ON CONFLICT(token_id) DO UPDATE SET expires_at = excluded.expires_at
+            WHERE token_reservation.session_id = excluded.session_id
+        """, [(tid, session_id, now + ttl_s) for tid in token_ids])
+        taken = []
+        for chunk in _chunks(token_ids):
+            placeholder = ",".join(["?"] * len(chunk))
+            cur.execute(f"""
+                SELECT token_id FROM token_reservation
+                WHERE token_id IN ({placeholder}) AND session_id <> ?
+            """, (*chunk, session_id))
+            taken.extend(r[0] for r in cur.fetchall())
+    return taken
+
+
+def release_tokens(session_id: str, token_ids: list = None):
+    """Drop session_id's reservations (all of them when token_ids is None)."""
+    with transaction() as conn:
+        if token_ids is None:
+            conn.execute("DELETE FROM token_reservation WHERE session_id = ?", (session_id,))
+            return
+        for chunk in _chunks(list(token_ids)):
+            placeholder = ",".join(["?"] * len(chunk))
+            conn.execute(f"DELETE FROM token_reservation WHERE session_id = ? AND token_id IN ({placeholder})",
+                         (session_id, *chunk))
+
+
+def create_challan_batch(token_ids: list, from_city: str, to_city: str, truck_no: str,
+                         driver_name: str, driver_mobile: str, hire: float = 0.0,
+                         loading_hamali: float = 0.0, unloading_hamali: float = 0.0,
+                         other_exp: float = 0.0, office: str = None,
+                         session_id: str = None, on_conflict: str = "reject"):
+    """
+    Creates a challan for token ids in one BEGIN IMMEDIATE transaction.
+    Tokens are claimed with a conditional, set-based
+    UPDATE ... WHERE id IN (...) AND status = 'PENDING', which skips tokens
+    already loaded or reserved by another session. Mapping rows are copied
+    with one INSERT ... SELECT, and totals are read back inside the same
+    transaction.
+
+    on_conflict="reject" raises TokensUnavailableError (nothing is written)
+    if any token could not be claimed; "shrink" creates the challan with the
+    tokens that were still available.
+    Returns dict: challan_id, challan_no, token_ids, skipped_token_ids,
+    token_count, total_weight, total_pkgs, total_amount, balance, elapsed_ms.
+    """
+    if on_conflict not in ("reject", "shrink"):
+        raise ValueError(f"Unknown on_conflict policy: {on_conflict}")
     if not token_ids:
         raise ValueError("No tokens provided for challan creation")
 
-    conn = get_conn()
-    cur = conn.cursor()
-    placeholder = ",".join(["?"] * len(token_ids))
-    cur.execute(f"SELECT COALESCE(SUM(amount),0), COALESCE(SUM(weight),0) FROM tokens WHERE id IN ({placeholder})", tuple(token_ids))
-    totals = cur.fetchone()
-    total_amount = totals[0] or 0.0
-    total_weight = totals[1] or 0.0
+    started = time.perf_counter()
+    token_ids = list(dict.fromkeys(token_ids))
+    expenses = (hire or 0.0) + (loading_hamali or 0.0) + (unloading_hamali or 0.0) + (other_exp or 0.0)
+    now_dt = datetime.utcnow()
+    today = now_dt.date().isoformat()
+    from_city, to_city = normalize_city(from_city), normalize_city(to_city)
+
+    prefetched_no = _prefetch_doc_no("CHALLAN", office)
+    with transaction() as conn:
+        cur = conn.cursor()
+        challan_no = prefetched_no or allocate_doc_no(conn, "CHALLAN", office)
+        cur.execute("""
+            INSERT INTO challan (challan_no, date, challan_at, office_id, from_city, to_city, truck_no,
+                                 driver_name, driver_mobile, hire, loading_hamali, unloading_hamali, other_exp,
+                                 balance)
+            VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, 0)
+        """, (challan_no, today, to_epoch(now_dt), _office_id(cur, office, from_city), from_city, to_city,
+              truck_no, driver_name, driver_mobile, hire, loading_hamali, unloading_hamali, other_exp))
+        challan_id = cur.lastrowid
+
+        now = time.time()
+        claimed = 0
+        for chunk in _chunks(token_ids):
+            placeholder = ",".join(["?"] * len(chunk))
+            cur.execute(f"""
+                UPDATE tokens SET status = 'LOADED', challan_id = ?
+                WHERE id IN ({placeholder}) AND status = 'PENDING'
+                  AND NOT EXISTS (
+                      SELECT 1 FROM token_reservation r
+                      WHERE r.token_id = tokens.id AND r.session_id <> ? AND r.expires_at > ?)
+            """, (challan_id, *chunk, session_id or "", now))
+            claimed += cur.rowcount
+
+        cur.execute("SELECT id FROM tokens WHERE challan_id = ?", (challan_id,))
+        claimed_ids = [r[0] for r in cur.fetchall()]
+        skipped = []
+        if claimed < len(token_ids):
+            claimed_set = set(claimed_ids)
+            skipped = [tid for tid in token_ids if tid not in claimed_set]
+            if on_conflict == "reject" or not claimed_ids:
+                raise TokensUnavailableError(
+                    f"{len(skipped)} token(s) were already loaded or are reserved by another operator",
+                    skipped)
 
-    challan_no = get_next_challan_no()
-    today = datetime.utcnow().date().isoformat()
-    balance = total_amount - ((hire or 0.0) + (loading_hamali or 0.0) + (unloading_hamali or 0.0) + (other_exp or 0.0))
+        cur.execute("""
+            INSERT INTO challan_tokens (challan_id, token_id)
+            SELECT challan_id, id FROM tokens WHERE challan_id = ?
+        """, (challan_id,))
+        cur.execute("DELETE FROM token_reservation WHERE token_id IN (SELECT id FROM tokens WHERE challan_id = ?)",
+                    (challan_id,))
 
-    cur.execute("""
-        INSERT INTO challan (challan_no, date, from_city, to_city, truck_no, driver_name, driver_mobile,
-                             hire, loading_hamali, unloading_hamali, other_exp, balance)
-        VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?)
-    """, (challan_no, today, from_city, to_city, truck_no, driver_name, driver_mobile,
-          hire, loading_hamali, unloading_hamali, other_exp, balance))
-    challan_id = cur.lastrowid
+        cur.execute("""
+            SELECT COUNT(*), COALESCE(SUM(weight),0), COALESCE(SUM(pkgs),0), COALESCE(SUM(amount),0)
+            FROM tokens WHERE challan_id = ?
+        """, (challan_id,))
+        token_count, total_weight, total_pkgs, total_amount = cur.fetchone()
+        balance = total_amount - expenses
+        cur.execute("UPDATE challan SET balance = ? WHERE id = ?", (balance, challan_id))
 
-    for tid in token_ids:
-        cur.execute("INSERT INTO challan_tokens (challan_id, token_id) VALUES (?, ?)", (challan_id, tid))
-        cur.execute("UPDATE tokens SET status = ?, challan_id = ? WHERE id = ?", ("LOADED", challan_id, tid))
+    return {
+        "challan_id": challan_id,
+        "challan_no": challan_no,
+        "token_ids": claimed_ids,
+        "skipped_token_ids": skipped,
+        "token_count": token_count,
+        "total_weight": total_weight,
+        "total_pkgs": total_pkgs,
+        "total_amount": total_amount,
+        "balance": balance,
+        "elapsed_ms": (time.perf_counter() - started) * 1000.0,
+    }
 
-    conn.commit()
-    conn.close()
-    return challan_no
+
+def create_challan(token_ids: list, from_city: str, to_city: str, truck_no: str,
+                   driver_name: str, driver_mobile: str, hire: float = 0.0,
+                   loading_hamali: float = 0.0, unloading_hamali: float = 0.0, other_exp: float = 0.0,
+                   office: str = None):
+    """
+    Creates a challan with given token ids.
+    Marks tokens as LOADED and creates mapping entries.
+    Returns challan_no (int). See create_challan_batch() for totals/timing.
+    """
+    return create_challan_batch(token_ids, from_city, to_city, truck_no, driver_name, driver_mobile,
+                                hire=hire, loading_hamali=loading_hamali,
+                                unloading_hamali=unloading_hamali, other_exp=other_exp,
+                                office=office)["challan_no"]
 
 
 # =========================================================
 # DELIVERY HELPERS
 # =========================================================
-def mark_token_delivered(token_id: int, receiver_name: str = None, signature_text: str = None):
+def mark_token_delivered(token_id: int, receiver_name: str = None, signature_text: str = None,
+                         delivery_date: date = None, office: str = None):
     """
     Mark a token as delivered and log delivery.
+    delivery_date defaults to now; a date from the form is logged as that IST day.
+    The delivery belongs to `office`, else the office at the token's destination.
     """
-    conn = get_conn()
-    cur = conn.cursor()
-    now = datetime.utcnow().isoformat()
+    if delivery_date is None:
+        when = datetime.utcnow()
+        date_text = when.isoformat()
+    else:
+        when = delivery_date
+        date_text = delivery_date.strftime("%d-%m-%Y")
+
+    with transaction() as conn:
+        cur = conn.cursor()
+        cur.execute("UPDATE tokens SET status = ? WHERE id = ?", ("DELIVERED", token_id))
+        cur.execute("SELECT to_city FROM tokens WHERE id = ?", (token_id,))
+        row = cur.fetchone()
+        office_id = _office_id(cur, office, row[0] if row else None)
+        cur.execute("""
+            INSERT INTO delivery_log (token_id, delivery_date, delivered_at, office_id, receiver_name, signature)
+            VALUES (?, ?, ?, ?, ?, ?)
+        """, (token_id, date_text, to_epoch(when), office_id, receiver_name, signature_text))
 
-    cur.execute("UPDATE tokens SET status = ? WHERE id = ?", ("DELIVERED", token_id))
 
-    cur.execute("""
-        INSERT INTO delivery_log (token_id, delivery_date, receiver_name, signature)
-        VALUES (?, ?, ?, ?)
-    """, (token_id, now, receiver_name, signature_text))
+# =========================================================
+# PAYMENT HELPERS
+# =========================================================
+def record_payment(party_id: int, date_str: str, amount: float, mode: str, remark: str = None,
+                   office: str = None):
+    """
+    Insert a payment. date_str is the form's 'dd/mm/YYYY' text (kept as typed);
+    paid_at / business_day are derived from it. office is the collecting office (optional).
+    Returns payment id.
 
-    conn.commit()
-    conn.close()
+    Raises:
+        ValueError: if the date cannot be read.
+    """
+    paid_at = to_epoch(date_str)
+    if paid_at is None:
+        raise ValueError(f"Invalid date '{date_str}' — use dd/mm/YYYY")
+    with transaction() as conn:
+        cur = conn.cursor()
+        cur.execute("""
+            INSERT INTO payments (party_id, date, paid_at, office_id, amount, mode, remark)
+            VALUES (?, ?, ?, ?, ?, ?, ?)
+        """, (party_id, date_str, paid_at, _office_id(cur, office), amount, mode, remark))
+        return cur.lastrowid
 
 
 # =========================================================
-# OTHER HELPERS
+# DASHBOARD AGGREGATES
 # =========================================================
-def get_token_by_token_no(token_no: int):
+# Every query covers the selected window plus the equally long window right
+# before it and splits the rows with one CASE on business_day, so the
+# period-over-period deltas come out of the same scan. Booking numbers are
+# read from daily_route_party_summary (a few rows per day), the rest from the
+# ix_*_day indexes. Cancelled tokens are not counted.
+_DASHBOARD_TABLES = ("tokens", "daily_route_party_summary", "challan", "payments", "delivery_log",
+                     "party_master", "party_balance")
+_PERIOD_SQL = "CASE WHEN {day} >= :start THEN 'cur' ELSE 'prev' END"
+
+
+def _route_filter(alias: str, from_city: str = None, to_city: str = None):
+    sql = ""
+    if from_city:
+        sql += f" AND {alias}.from_city = :from_city COLLATE NOCASE"
+    if to_city:
+        sql += f" AND {alias}.to_city = :to_city COLLATE NOCASE"
+    return sql
+
+
+def get_dashboard(start_day: date, end_day: date, from_city: str = None, to_city: str = None):
+    """
+    Dashboard numbers for start_day..end_day (IST business days, inclusive),
+    optionally for one route. Cached per filter combination in the read cache.
+
+    Returns a dict:
+      kpi       {'cur'|'prev': {tokens, revenue, weight, parties, challans,
+                 trucks, collected, deliveries, avg_delivery_days}}
+      daily     [(day, tokens, weight, revenue)]
+      status    [(status, tokens)]
+      routes    [(from_city, to_city, tokens, revenue)]
+      top_parties [(party_name, tokens, revenue, outstanding)]  (top 5 by tokens)
+    """
+    params = {
+        "start": start_day.isoformat(),
+        "end": end_day.isoformat(),
+        "prev_start": (start_day - (end_day - start_day) - timedelta(days=1)).isoformat(),
+        "from_city": normalize_city(from_city) if from_city else None,
+        "to_city": normalize_city(to_city) if to_city else None,
+    }
+    key = ("dashboard", params["start"], params["end"], params["from_city"], params["to_city"])
+    return _read_cache.get(key, lambda: _load_dashboard(params), tables=_DASHBOARD_TABLES)
+
+
+def _load_dashboard(params):
+    sum_route = _route_filter("s", params["from_city"], params["to_city"])
+    tok_route = _route_filter("t", params["from_city"], params["to_city"])
+    ch_route = _route_filter("c", params["from_city"], params["to_city"])
+    kpi = {p: {"tokens": 0, "revenue": 0.0, "weight": 0.0, "parties": 0, "challans": 0, "trucks": 0,
+               "collected": 0.0, "deliveries": 0, "avg_delivery_days": None} for p in ("cur", "prev")}
+
     conn = get_conn()
     cur = conn.cursor()
-    cur.execute("SELECT id, token_no, party_id, marka, status, amount, weight, pkgs, from_city, to_city FROM tokens WHERE token_no = ?", (token_no,))
-    r = cur.fetchone()
-    conn.close()
+    try:
+        # booking figures come from the daily rollup (migration 11), not from tokens
+        cur.execute(f"""
+            SELECT {_PERIOD_SQL.format(day="s.business_day")} AS period,
+                   SUM(s.tokens), SUM(s.amount), SUM(s.weight), COUNT(DISTINCT NULLIF(s.party_id, 0))
+            FROM daily_route_party_summary s
+            WHERE s.business_day BETWEEN :prev_start AND :end AND s.tokens <> 0{sum_route}
+            GROUP BY period
+        """, params)
+        for period, tokens, revenue, weight, parties in cur.fetchall():
+            kpi[period].update(tokens=tokens, revenue=revenue, weight=weight, parties=parties)
+
+        cur.execute(f"""
+            SELECT {_PERIOD_SQL.format(day="c.business_day")} AS period,
+                   COUNT(*), COUNT(DISTINCT NULLIF(TRIM(c.truck_no), ''))
+            FROM challan c
+            WHERE c.business_day BETWEEN :prev_start AND :end{ch_route}
+            GROUP BY period
+        """, params)
+        for period, challans, trucks in cur.fetchall():
+            kpi[period].update(challans=challans, trucks=trucks)
+
+        cur.execute(f"""
+            SELECT {_PERIOD_SQL.format(day="p.business_day")} AS period, COALESCE(SUM(p.amount), 0)
+            FROM payments p
+            WHERE p.business_day BETWEEN :prev_start AND :end
+            GROUP BY period
+        """, params)
+        for period, collected in cur.fetchall():
+            kpi[period]["collected"] = collected
+
+        cur.execute(f"""
+            SELECT {_PERIOD_SQL.format(day="d.business_day")} AS period,
+                   COUNT(*), AVG((d.delivered_at - t.booked_at) / 86400.0)
+            FROM delivery_log d
+            JOIN tokens t ON t.id = d.token_id
+            WHERE d.business_day BETWEEN :prev_start AND :end{tok_route}
+            GROUP BY period
+        """, params)
+        for period, deliveries, avg_days in cur.fetchall():
+            kpi[period].update(deliveries=deliveries, avg_delivery_days=avg_days)
+
+        # one pass over the rollup for the daily trend, status mix and route split
+        cur.execute(f"""
+            SELECT s.business_day, s.from_city, s.to_city, SUM(s.tokens), SUM(s.weight), SUM(s.amount),
+                   SUM(s.pending), SUM(s.loaded), SUM(s.delivered)
+            FROM daily_route_party_summary s
+            WHERE s.business_day BETWEEN :start AND :end AND s.tokens <> 0{sum_route}
+            GROUP BY s.business_day, s.from_city, s.to_city
+        """, params)
+        by_day, by_route = {}, {}
+        by_status = {"PENDING": 0, "LOADED": 0, "DELIVERED": 0}
+        for day, frm, to, tokens, weight, amount, pending, loaded, delivered in cur.fetchall():
+            d = by_day.setdefault(day, [0, 0.0, 0.0])
+            d[0] += tokens
+            d[1] += weight
+            d[2] += amount
+            by_status["PENDING"] += pending
+            by_status["LOADED"] += loaded
+            by_status["DELIVERED"] += delivered
+            r = by_route.setdefault((frm, to), [0, 0.0])
+            r[0] += tokens
+            r[1] += amount
+        daily = [(day, *by_day[day]) for day in sorted(by_day)]
+        status = sorted(((k, v) for k, v in by_status.items() if v), key=lambda kv: -kv[1])
+        routes = sorted(((frm, to, n, amt) for (frm, to), (n, amt) in by_route.items()), key=lambda r: -r[2])
+
+        cur.execute(f"""
+            SELECT COALESCE(p.party_name, 'Unknown'), x.tokens, x.revenue,
+                   COALESCE(b.token_total - b.payment_total, 0)
+            FROM (
+                SELECT s.party_id, SUM(s.tokens) AS tokens, SUM(s.amount) AS revenue
+                FROM daily_route_party_summary s
+                WHERE s.business_day BETWEEN :start AND :end AND s.tokens <> 0{sum_route}
+                GROUP BY s.party_id
+                ORDER BY tokens DESC, revenue DESC
+                LIMIT 5
+            ) x
+            LEFT JOIN party_master p ON p.id = x.party_id
+            LEFT JOIN party_balance b ON b.party_id = x.party_id
+            ORDER BY x.tokens DESC, x.revenue DESC
+        """, params)
+        top_parties = cur.fetchall()
+    finally:
+        conn.close()
+
+    return {"kpi": kpi, "daily": daily, "status": status, "routes": routes, "top_parties": top_parties}
+
+
+# =========================================================
+# OTHER HELPERS
+# =========================================================
+def get_token_by_token_no(token_no: int):
+    with get_conn() as conn:
+        r = conn.execute("SELECT id, token_no, party_id, marka, status, amount, weight, pkgs, from_city, to_city "
+                         "FROM tokens WHERE token_no = ?", (token_no,)).fetchone()
     if not r:
         return None
     return {
@@ -551,4 +2752,62 @@ def get_token_by_token_no(token_no: int):
         "pkgs": r[7],
         "from_city": r[8],
         "to_city": r[9]
-    }
\ No newline at end of file
+    }
+
+
+# =========================================================
+# COMMAND LINE (maintenance jobs)
+# =========================================================
+def main(argv=None):
+    import argparse
+
+    parser = argparse.ArgumentParser(description="TMS database maintenance")
+    sub = parser.add_subparsers(dest="command", required=True)
+    sub.add_parser("migrate", help="apply pending schema migrations")
+    sub.add_parser("verify-balances", help="check party_balance against a full recomputation")
+    sub.add_parser("rebuild-balances", help="recompute party_balance from tokens and payments")
+    sub.add_parser("verify-summary", help="check daily_route_party_summary against tokens")
+    rebuild = sub.add_parser("rebuild-summary", help="recompute daily_route_party_summary from tokens")
+    rebuild.add_argument("--chunk-days", type=int, default=SUMMARY_REBUILD_DAYS,
+                         help="days recomputed per transaction (default %(default)s)")
+    close = sub.add_parser("close-period", help="store month-end party balances for unclosed months")
+    close.add_argument("--month", help="close up to this month, YYYY-MM (default: last month)")
+    sub.add_parser("verify-closing", help="check month-end party balances against a full recomputation")
+    args = parser.parse_args(argv)
+
+    init_db()
+    if args.command == "migrate":
+        print(f"Schema version {get_schema_version()}")
+    elif args.command == "verify-balances":
+        mismatches = verify_party_balance()
+        for pid, have, want in mismatches:
+            print(f"party {pid}: stored {have:.2f}, expected {want:.2f}")
+        print("party_balance OK" if not mismatches else f"{len(mismatches)} mismatched parties")
+        return 1 if mismatches else 0
+    elif args.command == "rebuild-balances":
+        rebuild_party_balance()
+        print("party_balance rebuilt")
+    elif args.command == "verify-summary":
+        mismatches = verify_daily_summary()
+        for key, have, want in mismatches[:50]:
+            print(f"{key}: stored {have}, expected {want}")
+        print("daily_route_party_summary OK" if not mismatches else f"{len(mismatches)} mismatched rows")
+        return 1 if mismatches else 0
+    elif args.command == "rebuild-summary":
+        result = rebuild_daily_summary(args.chunk_days)
+        print(f"daily_route_party_summary rebuilt: {result['first_day']} – {result['last_day']}, "
+              f"{result['chunks']} chunks, {result['elapsed_ms']:.0f} ms")
+    elif args.command == "close-period":
+        closed = close_periods(args.month)
+        print(f"Closed {len(closed)} months" + (f": {closed[0]:%Y-%m} – {closed[-1]:%Y-%m}" if closed else ""))
+    elif args.command == "verify-closing":
+        mismatches = verify_closing_balances()
+        for end, pid, have, want in mismatches[:50]:
+            print(f"{end} party {pid}: stored {have:.2f}, expected {want:.2f}")
+        print("party_closing_balance OK" if not mismatches else f"{len(mismatches)} mismatched rows")
+        return 1 if mismatches else 0
+    return 0
+
+
+if __name__ == "__main__":
+    raise SystemExit(main())
@@ -1,274 +1,188 @@
-# pages/combined_all_part1.py - WITH DASHBOARD
+# pages/combined_all_part1.py - DASHBOARD / MASTERS / TOKEN / CHALLAN SECTIONS
 import streamlit as st
-import pandas as pd
-from datetime import datetime, date
-import io
+from datetime import datetime, date, timedelta
+import time
+# pandas / reportlab / openpyxl are imported inside the sections that use
+# them, so the login screen and token page start without loading them.
+import uuid
 
 # Import shared utilities
-from auth_utils import safe_rerun, hide_default_sidebar, show_default_sidebar
+from auth_utils import timed_fragment
 
 # DB helpers
 from db import (
-    get_conn, get_party_list, get_all_markas,
-    create_token_in_db, get_pending_tokens, group_tokens_by_marka,
-    create_challan, get_next_challan_no
+    get_conn, save_party, get_dashboard, IST,
+    get_routes, get_office_route, get_office_routes, save_route, save_rate,
+    create_token_in_db, create_tokens_bulk, get_pending_tokens,
+    create_challan_batch, get_next_challan_no,
+    reserve_tokens, release_tokens, TokensUnavailableError, RESERVATION_TTL_S
 )
 
-# -------------------------
-# Navigation handlers
-# -------------------------
-def nav_to_page(page_name):
-    """Navigate to a page"""
-    st.session_state["combined_page"] = page_name
-
-def get_main_render():
-    """Return the right render area based on user role."""
-    role = st.session_state.get("role")
-
-    if role == "ADMIN":
-        admin_top_buttons()
-        return st  # render in main area
-    else:
-        hide_default_sidebar()
-        return operator_left_panel()
-
-
-# -------------------------
-# Operator left-panel menu
-# -------------------------
-def operator_left_panel():
-    hide_default_sidebar()
-    left_col, main_col = st.columns([1, 4], gap="small")
-    with left_col:
-        st.markdown("### 🚚 Operator Menu")
-
-        if st.button("Token / Bilty", key="op_btn_token", use_container_width=True):
-            nav_to_page("token")
-            safe_rerun()
-
-        if st.button("Challan / Loading", key="op_btn_challan", use_container_width=True):
-            nav_to_page("challan")
-            safe_rerun()
-
-        st.markdown("---")
-        st.markdown(f"**User:** {st.session_state.get('username')}")
-        st.markdown(f"**Office:** {st.session_state.get('office')}")
-
-    return main_col
-
+# Cached master data (parties, markas, items, rates)
+from utils.cache_utils import (
+    party_list, marka_index, party_table, item_table, rate_table, clear_master_cache
+)
 
 # -------------------------
-# Admin sidebar menu
+# SECTION: INTERACTIVE DASHBOARD
 # -------------------------
-def admin_top_buttons():
-    st.sidebar.markdown("### 📋 Admin Menu")
+DASHBOARD_RANGES = {"Last 7 Days": 7, "Last 30 Days": 30, "Last 90 Days": 90, "This Month": None,
+                    "Last 365 Days": 365}
 
-    if st.sidebar.button("🏠 Home", key="admin_btn_home", use_container_width=True):
-        nav_to_page("home")
-        safe_rerun()
-    
-    if st.sidebar.button("📊 Dashboard", key="admin_btn_dashboard", use_container_width=True):
-        nav_to_page("dashboard")
-        safe_rerun()
-
-    if st.sidebar.button("👥 Party Master", key="admin_btn_party", use_container_width=True):
-        nav_to_page("party")
-        safe_rerun()
-
-    if st.sidebar.button("📦 Item / Rate Master", key="admin_btn_item_rate", use_container_width=True):
-        nav_to_page("item_rate")
-        safe_rerun()
-
-    if st.sidebar.button("📄 Token / Bilty", key="admin_btn_token", use_container_width=True):
-        nav_to_page("token")
-        safe_rerun()
 
-    if st.sidebar.button("🚛 Challan / Loading", key="admin_btn_challan", use_container_width=True):
-        nav_to_page("challan")
-        safe_rerun()
+def _dashboard_window(range_label):
+    """(start_day, end_day) in IST for a Date Range option; both inclusive."""
+    today = datetime.now(IST).date()
+    days = DASHBOARD_RANGES[range_label]
+    if days is None:
+        return today.replace(day=1), today
+    return today - timedelta(days=days - 1), today
 
-    st.sidebar.markdown("---")
 
-    if st.sidebar.button("💰 Payments", key="admin_btn_payments", use_container_width=True):
-        nav_to_page("payments")
-        safe_rerun()
+def _fmt_inr(amount):
+    amount = amount or 0
+    if abs(amount) >= 1e7:
+        return f"₹{amount / 1e7:.1f}Cr"
+    if abs(amount) >= 1e5:
+        return f"₹{amount / 1e5:.1f}L"
+    if abs(amount) >= 1e3:
+        return f"₹{amount / 1e3:.0f}K"
+    return f"₹{amount:.0f}"
 
-    if st.sidebar.button("🧾 Billing", key="admin_btn_billing", use_container_width=True):
-        nav_to_page("billing")
-        safe_rerun()
 
-    if st.sidebar.button("📚 Ledger", key="admin_btn_ledger", use_container_width=True):
-        nav_to_page("ledger")
-        safe_rerun()
+def _delta_text(cur, prev):
+    if not prev:
+        return "— no data in previous period" if not cur else "new this period"
+    change = (cur - prev) / prev * 100
+    return f"{'↑' if change >= 0 else '↓'} {abs(change):.1f}% vs previous period"
 
-    if st.sidebar.button("📊 Reports", key="admin_btn_reports", use_container_width=True):
-        nav_to_page("reports")
-        safe_rerun()
 
-    if st.sidebar.button("📦 Delivery Entry", key="admin_btn_delivery", use_container_width=True):
-        nav_to_page("delivery")
-        safe_rerun()
+def _kpi_card(render, gradient, title, value, delta):
+    render.markdown(f"""
+        <div style='background: linear-gradient(135deg, {gradient}); 
+                    padding: 20px; border-radius: 10px; color: white; text-align: center;'>
+            <h4 style='margin:0; font-size:14px;'>{title}</h4>
+            <h1 style='margin:10px 0; font-size:32px;'>{value}</h1>
+            <p style='margin:0; font-size:12px;'>{delta}</p>
+        </div>
+    """, unsafe_allow_html=True)
 
 
-# -------------------------
-# SECTION: INTERACTIVE DASHBOARD
-# -------------------------
 def section_dashboard(render):
+    import pandas as pd
+
     render.title("📊 Transport Management Dashboard")
-    render.info("Real-time insights and analytics with interactive visualizations")
+    render.info("Tokens, challans, payments और deliveries से live numbers — चुनी हुई अवधि बनाम उससे पहले की उतनी ही अवधि।")
 
     # Filters
+    routes = get_routes()
     col_f1, col_f2 = render.columns(2)
     with col_f1:
-        date_range = render.selectbox("Date Range", 
-            ["Last 7 Days", "Last 30 Days", "Last 90 Days", "This Month"],
-            key="dash_date_range")
+        date_range = render.selectbox("Date Range", list(DASHBOARD_RANGES), key="dash_date_range")
     with col_f2:
-        route_filter = render.selectbox("Route Filter",
-            ["All Routes", "Delhi → Mumbai", "Mumbai → Delhi"],
-            key="dash_route")
+        route_idx = render.selectbox("Route Filter", range(len(routes) + 1),
+                                     format_func=lambda i: "All Routes" if i == 0
+                                     else f"{routes[i - 1][1]} → {routes[i - 1][2]}",
+                                     key="dash_route")
 
-    render.markdown("---")
+    start_day, end_day = _dashboard_window(date_range)
+    from_city, to_city = routes[route_idx - 1][1:] if route_idx else (None, None)
 
-    # Generate dummy data
-    def generate_dashboard_data():
-        from datetime import timedelta
-        dates = [(datetime.now() - timedelta(days=i)).strftime("%d %b") for i in range(6, -1, -1)]
-        
-        daily_data = pd.DataFrame({
-            'Date': dates,
-            'Tokens': [45, 52, 38, 61, 48, 35, 28],
-            'Weight (kg)': [2800, 3200, 2400, 3800, 3000, 2100, 1700],
-            'Revenue (₹)': [68000, 78000, 58000, 92000, 72000, 51000, 41000]
-        })
-        
-        status_data = pd.DataFrame({
-            'Status': ['Pending', 'Loaded', 'In Transit', 'Delivered'],
-            'Count': [45, 78, 92, 132]
-        })
-        
-        route_data = pd.DataFrame({
-            'Route': ['Delhi → Mumbai', 'Mumbai → Delhi', 'Delhi → Pune', 'Mumbai → Bangalore'],
-            'Tokens': [145, 132, 45, 25]
-        })
-        
-        top_parties = pd.DataFrame({
-            'Party': ['ABC Logistics', 'XYZ Traders', 'PQR Enterprises', 'LMN Industries', 'RST Corporation'],
-            'Tokens': [85, 72, 64, 58, 45],
-            'Revenue': [245000, 198000, 176000, 164000, 142000],
-            'Outstanding': [45000, 22000, 0, 38000, 15000]
-        })
-        
-        return daily_data, status_data, route_data, top_parties
+    started = time.perf_counter()
+    data = get_dashboard(start_day, end_day, from_city, to_city)
+    render.caption(f"{start_day:%d %b %Y} – {end_day:%d %b %Y} · {(time.perf_counter() - started) * 1000:.1f} ms")
+
+    render.markdown("---")
 
-    daily_data, status_data, route_data, top_parties = generate_dashboard_data()
+    cur, prev = data["kpi"]["cur"], data["kpi"]["prev"]
 
     # KPI Cards
     kpi1, kpi2, kpi3, kpi4 = render.columns(4)
-    
     with kpi1:
-        render.markdown("""
-            <div style='background: linear-gradient(135deg, #667eea 0%, #764ba2 100%); 
-                        padding: 20px; border-radius: 10px; color: white; text-align: center;'>
-                <h4 style='margin:0; font-size:14px;'>💰 Total Revenue</h4>
-                <h1 style='margin:10px 0; font-size:32px;'>₹4.6L</h1>
-                <p style='margin:0; font-size:12px;'>↑ 12.5% from last week</p>
-            </div>
-        """, unsafe_allow_html=True)
-    
+        _kpi_card(render, "#667eea 0%, #764ba2 100%", "💰 Total Revenue", _fmt_inr(cur["revenue"]),
+                  _delta_text(cur["revenue"], prev["revenue"]))
     with kpi2:
-        render.markdown("""
-            <div style='background: linear-gradient(135deg, #f093fb 0%, #f5576c 100%); 
-                        padding: 20px; border-radius: 10px; color: white; text-align: center;'>
-                <h4 style='margin:0; font-size:14px;'>📦 Total Tokens</h4>
-                <h1 style='margin:10px 0; font-size:32px;'>307</h1>
-                <p style='margin:0; font-size:12px;'>↑ 8.3% from last week</p>
-            </div>
-        """, unsafe_allow_html=True)
-    
+        _kpi_card(render, "#f093fb 0%, #f5576c 100%", "📦 Total Tokens", cur["tokens"],
+                  _delta_text(cur["tokens"], prev["tokens"]))
     with kpi3:
-        render.markdown("""
-            <div style='background: linear-gradient(135deg, #4facfe 0%, #00f2fe 100%); 
-                        padding: 20px; border-radius: 10px; color: white; text-align: center;'>
-                <h4 style='margin:0; font-size:14px;'>🚛 Active Trucks</h4>
-                <h1 style='margin:10px 0; font-size:32px;'>45</h1>
-                <p style='margin:0; font-size:12px;'>↓ 2.1% from last week</p>
-            </div>
-        """, unsafe_allow_html=True)
-    
+        _kpi_card(render, "#4facfe 0%, #00f2fe 100%", "🚛 Active Trucks", cur["trucks"],
+                  _delta_text(cur["trucks"], prev["trucks"]))
     with kpi4:
-        render.markdown("""
-            <div style='background: linear-gradient(135deg, #43e97b 0%, #38f9d7 100%); 
-                        padding: 20px; border-radius: 10px; color: white; text-align: center;'>
-                <h4 style='margin:0; font-size:14px;'>👥 Active Parties</h4>
-                <h1 style='margin:10px 0; font-size:32px;'>28</h1>
-                <p style='margin:0; font-size:12px;'>↑ 5.7% from last week</p>
-            </div>
-        """, unsafe_allow_html=True)
+        _kpi_card(render, "#43e97b 0%, #38f9d7 100%", "👥 Active Parties", cur["parties"],
+                  _delta_text(cur["parties"], prev["parties"]))
+
+    if not data["daily"]:
+        render.markdown("---")
+        render.info("इस अवधि / route में कोई token नहीं है।")
+        return
 
     render.markdown("---")
 
     # Charts Row 1
+    daily_data = pd.DataFrame(data["daily"], columns=["Date", "Tokens", "Weight (kg)", "Revenue (₹)"])
+    daily_data["Date"] = pd.to_datetime(daily_data["Date"])
+    status_data = pd.DataFrame(data["status"], columns=["Status", "Count"])
     chart_col1, chart_col2 = render.columns(2)
-    
+
     with chart_col1:
         render.subheader("📈 Daily Booking Trend")
-        render.line_chart(daily_data.set_index('Date')[['Tokens', 'Revenue (₹)']])
-    
+        render.line_chart(daily_data.set_index("Date")[["Tokens", "Revenue (₹)"]])
+
     with chart_col2:
         render.subheader("📦 Token Status Distribution")
-        render.bar_chart(status_data.set_index('Status'))
+        render.bar_chart(status_data.set_index("Status"))
 
     # Charts Row 2
+    route_data = pd.DataFrame([(f"{f} → {t}", n) for f, t, n, _ in data["routes"]], columns=["Route", "Tokens"])
+    top_parties = pd.DataFrame(data["top_parties"], columns=["Party", "Tokens", "Revenue", "Outstanding"])
     chart_col3, chart_col4 = render.columns(2)
-    
+
     with chart_col3:
         render.subheader("🗺️ Route-wise Distribution")
-        render.bar_chart(route_data.set_index('Route'))
-    
+        render.bar_chart(route_data.set_index("Route"))
+
     with chart_col4:
         render.subheader("💹 Top 5 Parties by Tokens")
-        render.bar_chart(top_parties.set_index('Party')['Tokens'])
+        render.bar_chart(top_parties.set_index("Party")["Tokens"])
 
     render.markdown("---")
 
     # Top Parties Table
     render.subheader("👥 Top 5 Parties Details")
-    
-    # Format the dataframe for display
     display_df = top_parties.copy()
-    display_df['Revenue'] = display_df['Revenue'].apply(lambda x: f"₹{x/1000:.0f}K")
-    display_df['Outstanding'] = display_df['Outstanding'].apply(lambda x: f"₹{x/1000:.0f}K")
-    display_df['Status'] = display_df['Outstanding'].apply(
-        lambda x: '🟢 Clear' if x == '₹0K' else '🟡 Pending' if int(x.replace('₹','').replace('K','')) < 30 else '🔴 High'
+    display_df["Status"] = display_df["Outstanding"].apply(
+        lambda x: "🟢 Clear" if x <= 0 else "🟡 Pending" if x < 30000 else "🔴 High"
     )
-    
+    display_df["Revenue"] = display_df["Revenue"].apply(_fmt_inr)
+    display_df["Outstanding"] = display_df["Outstanding"].apply(_fmt_inr)
     render.dataframe(display_df, use_container_width=True, height=250)
 
     render.markdown("---")
 
     # Additional Metrics
     metric_col1, metric_col2, metric_col3 = render.columns(3)
-    
+
     with metric_col1:
+        avg_now, avg_before = cur["avg_delivery_days"], prev["avg_delivery_days"]
         render.metric(
             label="⏱️ Avg Delivery Time",
-            value="2.4 days",
-            delta="-0.3 days"
+            value=f"{avg_now:.1f} days" if avg_now is not None else "—",
+            delta=f"{avg_now - avg_before:+.1f} days" if avg_now is not None and avg_before is not None else None,
+            delta_color="inverse"
         )
-    
+
     with metric_col2:
         render.metric(
-            label="😊 Customer Satisfaction",
-            value="94.2%",
-            delta="2.1%"
+            label="💵 Payments Collected",
+            value=_fmt_inr(cur["collected"]),
+            delta=_fmt_inr(cur["collected"] - prev["collected"])
         )
-    
+
     with metric_col3:
         render.metric(
-            label="🚛 Fleet Utilization",
-            value="87.5%",
-            delta="4.2%"
+            label="🚛 Challans",
+            value=cur["challans"],
+            delta=cur["challans"] - prev["challans"]
         )
 
 
@@ -299,35 +213,26 @@ def section_party(render):
             if not party_name.strip():
                 render.error("Party Name ज़रूरी है।")
             else:
-                conn = get_conn()
-                cur = conn.cursor()
-                cur.execute("""
-                    INSERT OR REPLACE INTO party_master
-                    (id, party_name, address, mobile, gst_no, marka,
-                     default_rate_per_kg, default_rate_per_parcel)
-                    VALUES (
-                        COALESCE((SELECT id FROM party_master WHERE party_name = ?), NULL),
-                        ?,?,?,?,?,?,?
-                    )
-                """, (party_name, party_name, address, mobile, gst_no, marka,
-                      default_rate_per_kg, default_rate_per_parcel))
-                conn.commit()
-                conn.close()
-                render.success("Party saved successfully ✅")
+                try:
+                    save_party(party_name, address, mobile, gst_no, marka,
+                               default_rate_per_kg, default_rate_per_parcel)
+                    clear_master_cache()
+                    render.success("Party saved successfully ✅")
+                except ValueError as e:
+                    render.error(f"❌ {e}")
 
     render.markdown("---")
     render.subheader("📋 Party List")
-    conn = get_conn()
-    df = pd.read_sql_query("SELECT party_name, mobile, marka, default_rate_per_kg FROM party_master ORDER BY party_name", conn)
-    conn.close()
-    render.dataframe(df, use_container_width=True)
+    render.dataframe(party_table(), use_container_width=True)
 
 # -------------------------
 # SECTION: ITEM & RATE MASTER
 # -------------------------
 def section_item_rate(render):
+    import pandas as pd
+
     render.title("📦 Item & Rate Master")
-    tab1, tab2 = render.tabs(["Item Master", "Rate Master"])
+    tab1, tab2, tab3 = render.tabs(["Item Master", "Rate Master", "Route Master"])
 
     with tab1:
         render.subheader("Item / Goods Type Master (Optional)")
@@ -339,24 +244,19 @@ def section_item_rate(render):
                 if not item_name.strip():
                     render.error("Item Name required.")
                 else:
-                    conn = get_conn()
-                    cur = conn.cursor()
-                    cur.execute("""
-                        INSERT OR IGNORE INTO item_master (item_name, description)
-                        VALUES (?, ?)
-                    """, (item_name, desc))
-                    conn.commit()
-                    conn.close()
+                    with get_conn() as conn:
+                        conn.execute("""
+                            INSERT OR IGNORE INTO item_master (item_name, description)
+                            VALUES (?, ?)
+                        """, (item_name, desc))
+                    clear_master_cache()
                     render.success("Item saved ✅")
 
-        conn = get_conn()
-        df_items = pd.read_sql_query("SELECT item_name, description FROM item_master ORDER BY item_name", conn)
-        conn.close()
-        render.dataframe(df_items, use_container_width=True)
+        render.dataframe(item_table(), use_container_width=True)
 
     with tab2:
         render.subheader("Rate Master (Party + Route Wise)")
-        parties = get_party_list()
+        parties = party_list()
         party_map = {p[1]: p[0] for p in parties} if parties else {}
         party_name = render.selectbox("Party (optional, blank = general)", [""] + list(party_map.keys()))
         from_city = render.text_input("From City (e.g., DELHI)", key="rate_from")
@@ -368,32 +268,64 @@ def section_item_rate(render):
             if not from_city.strip() or not to_city.strip():
                 render.error("From और To दोनों ज़रूरी हैं।")
             else:
-                conn = get_conn()
-                cur = conn.cursor()
-                cur.execute("""
-                    INSERT INTO rate_master (party_id, from_city, to_city, rate_type, rate)
-                    VALUES (?, ?, ?, ?, ?)
-                """, (
+                save_rate(
                     party_map.get(party_name) if party_name else None,
-                    from_city.upper().strip(),
-                    to_city.upper().strip(),
+                    from_city,
+                    to_city,
                     rate_type,
                     rate_val
-                ))
-                conn.commit()
-                conn.close()
+                )
+                clear_master_cache()
                 render.success("Rate saved ✅")
 
-        conn = get_conn()
-        df_rates = pd.read_sql_query("""
-            SELECT
-              COALESCE((SELECT party_name FROM party_master p WHERE p.id = r.party_id), 'ALL') AS party,
-              from_city, to_city, rate_type, rate
-            FROM rate_master r
-            ORDER BY party, from_city, to_city
-        """, conn)
-        conn.close()
-        render.dataframe(df_rates, use_container_width=True)
+        render.dataframe(rate_table(), use_container_width=True)
+
+    with tab3:
+        render.subheader("Routes & Office Defaults")
+        render.caption("नई branch जोड़ने के लिए route बनाएँ; Office भरने पर वही उस office के operators का default route होगा।")
+        with render.form("route_form"):
+            r_from = render.text_input("From City", key="route_from")
+            r_to = render.text_input("To City", key="route_to")
+            r_office = render.text_input("Office (optional, e.g., PUNE)", key="route_office")
+            if render.form_submit_button("💾 Save Route"):
+                try:
+                    save_route(r_from, r_to, r_office)
+                    clear_master_cache()
+                    render.success("Route saved ✅")
+                except ValueError as e:
+                    render.error(f"❌ {e}")
+
+        route_rows = []
+        office_routes = get_office_routes()
+        for _, frm, to in get_routes():
+            offices = [o for o, r in office_routes.items() if r == (frm, to)]
+            route_rows.append({"From": frm, "To": to, "Default for office": ", ".join(offices)})
+        render.dataframe(pd.DataFrame(route_rows), use_container_width=True)
+
+# -------------------------
+# Route helpers (city / route master)
+# -------------------------
+def pick_route(render, key, label="Route"):
+    """
+    Operators get their office's default route; admins choose from the route master.
+    Returns (from_city, to_city), or (None, None) when nothing is configured.
+    """
+    if st.session_state.get("role") == "OPERATOR":
+        route = get_office_route(st.session_state.get("office"))
+        if route:
+            render.markdown(f"**Route (auto):** {route[0]} ➜ {route[1]}")
+            return route
+        render.markdown("Route: —")
+        return None, None
+
+    routes = get_routes()
+    if not routes:
+        render.warning("कोई Route नहीं है — Item / Rate Master → Route Master में जोड़ें।")
+        return None, None
+    idx = render.selectbox(label, range(len(routes)),
+                           format_func=lambda i: f"{routes[i][1]} ➜ {routes[i][2]}", key=key)
+    return routes[idx][1], routes[idx][2]
+
 
 # -------------------------
 # SECTION: TOKEN / BILTY
@@ -403,33 +335,46 @@ def section_token(render):
     render.info("यहाँ से आप आसानी से Token (Bilty) बना सकते हैं — Marka पहले, बाकी auto-fill।")
 
     office = st.session_state.get("office")
-    if st.session_state.get("role") == "OPERATOR":
-        if office == "DELHI":
-            from_city, to_city = "DELHI", "MUMBAI"
-        elif office == "MUMBAI":
-            from_city, to_city = "MUMBAI", "DELHI"
-        else:
-            from_city, to_city = "DELHI", "MUMBAI"
-        render.markdown(f"**Route (auto):** {from_city} ➜ {to_city}")
-    else:
-        from_city = render.selectbox("From City (Select)", ["DELHI", "MUMBAI"], key="token_from")
-        to_city = "MUMBAI" if from_city == "DELHI" else "DELHI"
-        render.markdown(f"**To City (auto):** {to_city}")
+    from_city, to_city = pick_route(render, key="token_route", label="Route (Select)")
+    if not from_city:
+        render.error("❌ इस office के लिए कोई route set नहीं है।")
+        return
 
-    markas = get_all_markas()
-    if not markas:
+    index = marka_index()
+    if not len(index):
         render.error("❌ कोई Marka मौजूद नहीं है — पहले Party Master में Marka डालें।")
         return
 
+    with render.container():
+        token_form(from_city, to_city, office, index)
+
+
+MARKA_SUGGESTIONS = 20
+
+
+@timed_fragment("token_form")
+def token_form(from_city, to_city, office, index):
+    """
+    Marka, weight, rate and the Create button. Runs as a fragment: typing a
+    weight or rate reruns only this block, not login, sidebar and master queries.
+    """
+    render = st
+    # Only the top matches go to the browser; the search runs on the server
+    query = render.text_input("Marka / Party search (मार्का खोजें)", key="token_marka_query",
+                              placeholder="Marka या Party के पहले अक्षर लिखें")
+    markas = index.search(query, MARKA_SUGGESTIONS)
+    if not markas:
+        render.warning(f"'{query}' से कोई Marka नहीं मिला।")
+        return
     options = [f"{m['marka']}  —  {m['party_name']}" for m in markas]
-    
+
     selected_opt = render.selectbox(
-        "Marka (मार्का) — select / search", 
-        options, 
-        index=0, 
+        "Marka (मार्का) — select",
+        options,
+        index=0,
         key="token_marka_select"
     )
-    
+
     sel_index = options.index(selected_opt)
     selected_marka = markas[sel_index]["marka"]
     selected_party_id = markas[sel_index]["party_id"]
@@ -459,21 +404,13 @@ def section_token(render):
             rate_type=None,
             driver_mobile=driver_mobile,
             from_city=from_city,
-            to_city=to_city
+            to_city=to_city,
+            office=office
         )
         render.success(f"✅ Token created — Token No: {token_no}")
 
-        from reportlab.pdfgen import canvas
-        from reportlab.lib.pagesizes import A4
-
-        buffer = io.BytesIO()
-        c = canvas.Canvas(buffer, pagesize=A4)
-        c.setFont("Helvetica-Bold", 18)
-        c.drawCentredString(300, 800, "TOKEN / BILTY")
-        c.setFont("Helvetica-Bold", 14)
-        c.drawString(40, 760, f"Token No: {token_no}")
-        c.setFont("Helvetica", 12)
-        y = 730
+        from utils.pdf_utils import token_pdf  # reportlab loads on first token only
+
         rows = [
             ("Date/Time", datetime.utcnow().isoformat()),
             ("Party", selected_party_name),
@@ -485,73 +422,283 @@ def section_token(render):
             ("Amount (₹)", amount),
             ("Driver Mobile", driver_mobile or "-"),
         ]
-        for label, val in rows:
-            c.drawString(50, y, f"{label}: {val}")
-            y -= 20
-        c.setFont("Helvetica-Bold", 12)
-        c.drawString(50, y - 10, "Thank you")
-        c.showPage()
-        c.save()
-        buffer.seek(0)
 
         render.download_button(
             label="📥 Download Token PDF",
-            data=buffer,
+            data=token_pdf(token_no, rows),
             file_name=f"TOKEN_{token_no}.pdf",
             mime="application/pdf"
         )
 
+# -------------------------
+# SECTION: BULK TOKEN IMPORT
+# -------------------------
+def section_token_import(render):
+    render.title("📥 Bulk Token Import (CSV / Excel)")
+    render.info("एक साथ सैकड़ों Bilty बनाने के लिए CSV या Excel file upload करें। Marka से Party अपने आप मिलेगी।")
+
+    from utils.import_utils import iter_token_rows, token_template_csv
+
+    office = st.session_state.get("office")
+    from_city, to_city = pick_route(render, key="import_route", label="Default Route")
+    render.caption("Rows with their own from_city / to_city keep them; blank ones use the default route.")
+
+    render.download_button(
+        "⬇️ Download CSV Template",
+        data=token_template_csv(),
+        file_name="token_import_template.csv",
+        mime="text/csv"
+    )
+
+    uploaded = render.file_uploader("Token file", type=["csv", "xlsx"], key="token_import_file")
+    if uploaded is None:
+        return
+
+    if render.button("📥 Import Tokens", type="primary", key="token_import_btn"):
+        import pandas as pd
+
+        try:
+            result = create_tokens_bulk(
+                iter_token_rows(uploaded, uploaded.name),
+                from_city=from_city,
+                to_city=to_city,
+                office=office
+            )
+        except ValueError as e:
+            render.error(f"❌ {e}")
+            return
+        if result["inserted"]:
+            clear_master_cache()
+
+        col1, col2, col3 = render.columns(3)
+        col1.metric("Imported", result["inserted"])
+        col2.metric("Errors", len(result["errors"]))
+        col3.metric("Rows / sec", f"{result['rows_per_sec']:.0f}")
+        render.caption(f"{result['rows_total']} rows processed in {result['elapsed_ms']:.1f} ms")
+
+        if result["inserted"]:
+            render.success(f"✅ Token No {result['first_token_no']} – {result['last_token_no']} बन गए।")
+        if result["errors"]:
+            render.warning("इन rows में गलती है — ठीक करके दोबारा upload करें:")
+            err_df = pd.DataFrame(result["errors"], columns=["Row", "Error"])
+            render.dataframe(err_df, use_container_width=True)
+
+
 # -------------------------
 # SECTION: CHALLAN / LOADING
 # -------------------------
+def _session_uid():
+    """Stable id for this browser session, used to own token reservations."""
+    if "session_uid" not in st.session_state:
+        st.session_state["session_uid"] = uuid.uuid4().hex
+    return st.session_state["session_uid"]
+
+
+def _sync_token_reservations(selected_ids):
+    """
+    Reserve newly ticked tokens and release unticked ones.
+    Returns ids another operator already holds (they are not reserved).
+    """
+    sid = _session_uid()
+    held = st.session_state.get("challan_reserved", set())
+    selected = set(selected_ids)
+
+    released = held - selected
+    if released:
+        release_tokens(sid, released)
+
+    taken = []
+    stale = time.time() - st.session_state.get("challan_reserved_at", 0) > RESERVATION_TTL_S / 2
+    if selected and (selected - held or stale):
+        taken = reserve_tokens(sid, list(selected))
+        st.session_state["challan_reserved_at"] = time.time()
+    st.session_state["challan_reserved"] = selected - set(taken)
+    return taken
+
+
+def _challan_selection():
+    """Selected token ids (a set) and their running totals, kept across reruns."""
+    if "challan_selected" not in st.session_state:
+        st.session_state["challan_selected"] = set()
+        st.session_state["challan_totals"] = {"weight": 0.0, "amount": 0.0}
+    return st.session_state["challan_selected"], st.session_state["challan_totals"]
+
+
+def _set_token_selected(token, on: bool):
+    """Add/remove one token, adjusting the totals by that token only."""
+    selected, totals = _challan_selection()
+    if on == (token.id in selected):
+        return
+    sign = 1 if on else -1
+    if on:
+        selected.add(token.id)
+    else:
+        selected.discard(token.id)
+    totals["weight"] += sign * (token.weight or 0)
+    totals["amount"] += sign * (token.amount or 0)
+
+
+def _clear_challan_selection():
+    selected, totals = _challan_selection()
+    selected.clear()
+    totals.update(weight=0.0, amount=0.0)
+    _reset_challan_grid()
+
+
+CHALLAN_PAGE_SIZES = [50, 100, 200]
+
+
+def _reset_challan_grid():
+    """New editor key, so the grid redraws from the selection set instead of replaying old edits."""
+    st.session_state["challan_grid_rev"] = st.session_state.get("challan_grid_rev", 0) + 1
+
+
+def _on_grid_edit(grid_key, page_tokens):
+    """data_editor only sends back the rows that were ticked/unticked on this page."""
+    edits = st.session_state.get(grid_key, {}).get("edited_rows", {})
+    for row, changes in edits.items():
+        if "Select" in changes and int(row) < len(page_tokens):
+            _set_token_selected(page_tokens[int(row)], bool(changes["Select"]))
+    _reset_challan_grid()
+
+
+def _select_tokens(tokens, on: bool):
+    for t in tokens:
+        _set_token_selected(t, on)
+    _reset_challan_grid()
+
+
+def _filter_pending(pending, marka, search):
+    search = (search or "").strip().upper()
+    out = []
+    for t in pending:
+        if marka and t.marka != marka:
+            continue
+        if search and search not in f"{t.token_no} {t.marka or ''} {t.party_name or ''}".upper():
+            continue
+        out.append(t)
+    return out
+
+
+def render_token_grid(render, pending):
+    """
+    Filterable, paged token picker. Only the current page is drawn, so the
+    rerun cost stays flat however many tokens are pending.
+    """
+    import pandas as pd
+
+    selected, _ = _challan_selection()
+    markas = sorted({t.marka or "UNKNOWN" for t in pending})
+
+    col1, col2, col3 = render.columns([2, 2, 1])
+    with col1:
+        marka = render.selectbox("Marka", ["सभी Marka"] + markas, key="challan_marka_filter")
+    with col2:
+        search = render.text_input("Search (Token No / Marka / Party)", key="challan_search")
+    with col3:
+        page_size = render.selectbox("Rows", CHALLAN_PAGE_SIZES, key="challan_page_size")
+    marka = None if marka == "सभी Marka" else marka
+    shown = _filter_pending(pending, marka, search)
+
+    if marka:
+        in_marka = [t for t in pending if t.marka == marka]
+        b1, b2 = render.columns(2)
+        b1.button(f"☑️ Select all of {marka} ({len(in_marka)})", key="challan_marka_all",
+                  on_click=_select_tokens, args=(in_marka, True), use_container_width=True)
+        b2.button(f"✖ Unselect {marka}", key="challan_marka_none",
+                  on_click=_select_tokens, args=(in_marka, False), use_container_width=True)
+
+    if not shown:
+        render.info("इस filter में कोई token नहीं है।")
+        return
+
+    pages = (len(shown) + page_size - 1) // page_size
+    page = 1
+    if pages > 1:
+        page = int(render.number_input(f"Page (1–{pages})", min_value=1, max_value=pages, value=1, step=1,
+                                       key="challan_page"))
+    page_tokens = shown[(page - 1) * page_size: page * page_size]
+
+    grid = pd.DataFrame({
+        "Select": [t.id in selected for t in page_tokens],
+        "Token": [t.token_no for t in page_tokens],
+        "Marka": [t.marka for t in page_tokens],
+        "Party": [t.party_name for t in page_tokens],
+        "Weight (kg)": [t.weight or 0 for t in page_tokens],
+        "Pkgs": [t.pkgs or 0 for t in page_tokens],
+        "Amount (₹)": [t.amount or 0 for t in page_tokens],
+    })
+    grid_key = f"challan_grid_{st.session_state.get('challan_grid_rev', 0)}"
+    render.data_editor(
+        grid,
+        key=grid_key,
+        hide_index=True,
+        use_container_width=True,
+        disabled=[c for c in grid.columns if c != "Select"],
+        column_config={"Select": st.column_config.CheckboxColumn("✔", width="small")},
+        on_change=_on_grid_edit,
+        args=(grid_key, page_tokens),
+    )
+    render.caption(f"{len(shown)} tokens · page {page}/{pages} · {len(selected)} selected")
+
+
 def section_challan(render):
     render.title("🚛 Challan / Loading")
     render.info("Pending tokens चुनकर challan बनाओ — Operator के लिए Route auto होगा।")
 
     office = st.session_state.get("office")
-    if st.session_state.get("role") == "OPERATOR":
-        if office == "DELHI":
-            from_city, to_city = "DELHI", "MUMBAI"
-        elif office == "MUMBAI":
-            from_city, to_city = "MUMBAI", "DELHI"
-        else:
-            from_city, to_city = None, None
-        render.markdown(f"**Route (auto):** {from_city} ➜ {to_city}" if from_city else "Route: —")
-    else:
-        from_city = render.selectbox("From City", ["DELHI", "MUMBAI"], key="challan_from")
-        to_city = "MUMBAI" if from_city == "DELHI" else "DELHI"
-        render.markdown(f"To City (auto): {to_city}")
-
-    pending = get_pending_tokens(from_city=from_city, to_city=to_city) if from_city else get_pending_tokens()
+    from_city, to_city = pick_route(render, key="challan_route")
+
+    with render.container():
+        challan_form(from_city, to_city, office)
+
+
+@timed_fragment("challan_form")
+def challan_form(from_city, to_city, office):
+    """
+    Token grid, challan details and Create. Runs as a fragment, so grid
+    edits and number inputs rerun only this block.
+    """
+    render = st
+    session_id = _session_uid()
+    # operators only load their own office's bookings
+    own_office = office if st.session_state.get("role") == "OPERATOR" else None
+    pending = get_pending_tokens(from_city=from_city, to_city=to_city, session_id=session_id,
+                                 office=own_office) \
+        if from_city else get_pending_tokens(session_id=session_id, office=own_office)
     
     if not pending:
         render.warning("अभी कोई pending token नहीं है।")
         return
 
-    grouped = group_tokens_by_marka(pending)
+    token_by_id = {t.id: t for t in pending}
+    selected, totals = _challan_selection()
+    gone = [tid for tid in selected if tid not in token_by_id]
+    if gone:
+        # Loaded or reserved elsewhere since the last rerun: rebuild totals from what is left
+        selected.difference_update(gone)
+        totals.update(weight=sum(token_by_id[tid].weight or 0 for tid in selected),
+                      amount=sum(token_by_id[tid].amount or 0 for tid in selected))
 
-    render.subheader("Select Tokens (Grouped by Marka)")
-    selected_token_ids = []
-    for grp in grouped:
-        render.markdown(f"### Marka: {grp['marka']}")
-        for t in grp["tokens"]:
-            label = f"Token {t['token_no']} | {t.get('weight',0)}kg | ₹{t.get('amount',0):.2f}"
-            checked = render.checkbox(label, key=f"t_{t['id']}")
-            if checked:
-                selected_token_ids.append(t["id"])
+    render.subheader("Select Tokens")
+    render_token_grid(render, pending)
 
-    if not selected_token_ids:
+    taken = _sync_token_reservations(selected)
+    if taken:
+        render.warning(f"⚠️ {len(taken)} token दूसरे operator ने पहले ही select कर लिए हैं — उन्हें हटा दिया गया।")
+        _select_tokens([token_by_id[tid] for tid in taken], False)
+
+    if not selected:
         render.info("कम से कम 1 token select करें।")
         return
 
-    first = next((t for t in pending if t["id"] in selected_token_ids), None)
-    if first:
-        from_city = first["from_city"]
-        to_city = first["to_city"]
+    selected_tokens = [t for t in pending if t.id in selected]
+    from_city = selected_tokens[0].from_city
+    to_city = selected_tokens[0].to_city
 
     render.markdown("---")
     render.subheader("Challan Details")
-    challan_no = get_next_challan_no()
+    challan_no = get_next_challan_no(office)
     render.text_input("Challan No (Auto)", value=str(challan_no), disabled=True, key="challan_no_disp")
     date_str = render.text_input("Challan Date", value=datetime.now().strftime("%d/%m/%Y"), key="challan_date")
 
@@ -573,35 +720,45 @@ def section_challan(render):
 
     other_exp = render.number_input("Other Expenses", min_value=0.0, value=0.0, key="challan_other")
 
-    total_weight = sum(t.get("weight",0) or 0 for t in pending if t["id"] in selected_token_ids)
-    total_amount = sum(t.get("amount",0) or 0 for t in pending if t["id"] in selected_token_ids)
+    total_weight = totals["weight"]
+    total_amount = totals["amount"]
     render.markdown(f"**Total Weight:** {total_weight} kg — **Total Amount:** ₹ {total_amount:.2f}")
 
     if render.button("✅ Create Challan", key="create_challan_btn"):
-        challan_no_created = create_challan(
-            token_ids=selected_token_ids,
-            from_city=from_city,
-            to_city=to_city,
-            truck_no=truck_no,
-            driver_name=driver_name,
-            driver_mobile=driver_mobile,
-            hire=hire,
-            loading_hamali=loading_hamali,
-            unloading_hamali=unloading_hamali,
-            other_exp=other_exp
-        )
+        try:
+            result = create_challan_batch(
+                token_ids=[t.id for t in selected_tokens],
+                from_city=from_city,
+                to_city=to_city,
+                truck_no=truck_no,
+                driver_name=driver_name,
+                driver_mobile=driver_mobile,
+                hire=hire,
+                loading_hamali=loading_hamali,
+                unloading_hamali=unloading_hamali,
+                other_exp=other_exp,
+                office=office,
+                session_id=session_id
+            )
+        except TokensUnavailableError as e:
+            nos = [str(token_by_id[tid].token_no) for tid in e.token_ids if tid in token_by_id]
+            render.error(f"❌ Token {', '.join(nos)} पहले ही दूसरे challan में load हो चुके हैं — list refresh करके दोबारा select करें।")
+            return
+        st.session_state["challan_reserved"] = set()
+        _clear_challan_selection()
+        challan_no_created = result["challan_no"]
+        render.caption(f"{result['token_count']} tokens loaded in {result['elapsed_ms']:.1f} ms")
 
         try:
             from utils.pdf_utils import challan_pdf
             rows = []
-            for t in pending:
-                if t["id"] in selected_token_ids:
-                    rows.append({
-                        "token_no": t.get("token_no"),
-                        "weight": t.get("weight",0),
-                        "amount": t.get("amount",0),
-                        "party_name": t.get("party_name","")
-                    })
+            for t in selected_tokens:
+                rows.append({
+                    "token_no": t.token_no,
+                    "weight": t.weight or 0,
+                    "amount": t.amount or 0,
+                    "party_name": t.party_name or ""
+                })
 
             challan_data = {
                 "challan_no": challan_no_created,
@@ -615,7 +772,7 @@ def section_challan(render):
                 "loading_hamali": loading_hamali,
                 "unloading_hamali": unloading_hamali,
                 "other_exp": other_exp,
-                "balance": total_amount - (hire + loading_hamali + unloading_hamali + other_exp)
+                "balance": result["balance"]
             }
 
             pdf_buf = challan_pdf(challan_data, rows)
@@ -1,116 +1,45 @@
-# pages/combined_all_part2.py - WITH DASHBOARD ROUTING
+# pages/combined_all_part2.py - PAYMENTS / BILLING / LEDGER / REPORTS / DELIVERY SECTIONS
 import streamlit as st
-import pandas as pd
 import io
+import time
 from datetime import datetime, date
 
-# Import part1 to get functions
-import pages.combined_all_part1 as part1
+# Import DB functions
+from db import (
+    get_conn, compute_party_balance, get_outstanding, get_party_ledger,
+    get_opening_balance, get_closed_periods, close_periods,
+    record_payment, mark_token_delivered, cached_query,
+    get_booking_summary, start_daily_summary_rebuild, get_daily_summary_rebuild_status
+)
 
-# Import shared utilities
-from auth_utils import safe_rerun
+# Cached master data
+from utils.cache_utils import party_list
 
-# Import DB functions
-from db import get_conn, get_party_list, compute_party_balance
+# pandas and utils.pdf_utils (reportlab) are imported inside the pages that
+# need them, so login and the first page do not pay for them.
 
-# Import PDF functions
-from utils.pdf_utils import bill_pdf, ledger_pdf
 
-def run_app():
+def read_sql_timed(area, sql, params=(), tables=None):
     """
-    Runtime entrypoint - called from app.py after login
+    Run a read query (through the db read cache) into a DataFrame and show how
+    many rows came back and how long it took. tables: what the query reads.
     """
-    # Get render target and current page
-    main_render = part1.get_main_render()
-    page = st.session_state.get("combined_page", "home")
-
-    # Router - direct page rendering
-    if page == "dashboard":
-        if st.session_state.get("role") == "ADMIN":
-            part1.section_dashboard(main_render)
-        else:
-            st.error("❌ Access Denied: Operators cannot access Dashboard")
-    elif page == "token":
-        part1.section_token(main_render)
-    elif page == "challan":
-        part1.section_challan(main_render)
-    elif page == "party":
-        if st.session_state.get("role") == "ADMIN":
-            part1.section_party(main_render)
-        else:
-            st.error("❌ Access Denied: Operators cannot access Party Master")
-    elif page == "item_rate":
-        if st.session_state.get("role") == "ADMIN":
-            part1.section_item_rate(main_render)
-        else:
-            st.error("❌ Access Denied: Operators cannot access Item/Rate Master")
-    elif page == "payments":
-        if st.session_state.get("role") == "ADMIN":
-            render_payments(main_render)
-        else:
-            st.error("❌ Access Denied")
-    elif page == "billing":
-        if st.session_state.get("role") == "ADMIN":
-            render_billing(main_render)
-        else:
-            st.error("❌ Access Denied")
-    elif page == "ledger":
-        if st.session_state.get("role") == "ADMIN":
-            render_ledger(main_render)
-        else:
-            st.error("❌ Access Denied")
-    elif page == "reports":
-        if st.session_state.get("role") == "ADMIN":
-            render_reports(main_render)
-        else:
-            st.error("❌ Access Denied")
-    elif page == "delivery":
-        if st.session_state.get("role") == "ADMIN":
-            render_delivery(main_render)
-        else:
-            st.error("❌ Access Denied")
-    else:
-        # Home page
-        if st.session_state.get("role") == "ADMIN":
-            main_render.title("👋 Admin Dashboard — Transport Management")
-            main_render.write("Use the buttons below to open any section.")
-            
-            # Quick access grid with Dashboard button
-            menu = [
-                ("📊 Dashboard", "dashboard"),
-                ("👥 Party Master", "party"),
-                ("📦 Item / Rate Master", "item_rate"),
-                ("📄 Token / Bilty", "token"),
-                ("🚛 Challan / Loading", "challan"),
-                ("💰 Payments", "payments"),
-                ("🧾 Billing", "billing"),
-                ("📚 Ledger", "ledger"),
-                ("📊 Reports", "reports"),
-            ]
-            cols_per_row = 3
-            for i in range(0, len(menu), cols_per_row):
-                cols = main_render.columns(cols_per_row, gap="large")
-                for j, (label, page_name) in enumerate(menu[i:i+cols_per_row]):
-                    with cols[j]:
-                        btn_key = f"admin_dashboard_btn_{page_name}"
-                        if main_render.button(label, key=btn_key, use_container_width=True):
-                            st.session_state["combined_page"] = page_name
-                            safe_rerun()
-
-            parties = get_party_list()
-            if parties:
-                main_render.success(f"Total Parties: {len(parties)}")
-            else:
-                main_render.info("👉 No parties yet. Add parties using Party Master.")
-        else:
-            main_render.info("👉 Use the menu to navigate")
+    import pandas as pd
+
+    started = time.perf_counter()
+    columns, rows = cached_query(sql, params, tables)
+    df = pd.DataFrame(rows, columns=columns)
+    area.caption(f"{len(df)} rows · {(time.perf_counter() - started) * 1000:.1f} ms")
+    return df
 
 # -------------------------
 # SECTION: PAYMENTS
 # -------------------------
 def render_payments(area):
+    import pandas as pd
+
     area.title("💰 Payment Entry (Cash / Bank)")
-    parties = get_party_list()
+    parties = party_list()
     if not parties:
         area.warning("पहले Party Master में Party बनाओ।")
         return
@@ -129,26 +58,22 @@ def render_payments(area):
         submitted = area.form_submit_button("💾 Save Payment")
 
         if submitted:
-            conn = get_conn()
-            cur = conn.cursor()
-            cur.execute("""
-                INSERT INTO payments (party_id, date, amount, mode, remark)
-                VALUES (?,?,?,?,?)
-            """, (party_id, date_str, amount, mode, remark))
-            conn.commit()
-            conn.close()
-            area.success("Payment saved ✅")
+            try:
+                record_payment(party_id, date_str, amount, mode, remark,
+                               office=st.session_state.get("office"))
+                area.success("Payment saved ✅")
+            except ValueError as e:
+                area.error(f"❌ {e}")
 
     area.markdown("---")
     area.subheader("Recent Payments")
-    conn = get_conn()
-    df = pd.read_sql_query("""
-        SELECT date, amount, mode, remark
-        FROM payments
-        WHERE party_id=?
-        ORDER BY id DESC LIMIT 50
-    """, conn, params=(party_id,))
-    conn.close()
+    with get_conn() as conn:
+        df = pd.read_sql_query("""
+            SELECT date, amount, mode, remark
+            FROM payments
+            WHERE party_id=?
+            ORDER BY id DESC LIMIT 50
+        """, conn, params=(party_id,))
     area.dataframe(df, use_container_width=True)
 
 # -------------------------
@@ -158,11 +83,7 @@ def render_billing(area):
     area.title("🧾 Billing (Party-wise)")
     area.info("किसी party के लिए date range चुनकर Bill बना सकते हैं।")
 
-    conn = get_conn()
-    cur = conn.cursor()
-    cur.execute("SELECT id, party_name FROM party_master ORDER BY party_name")
-    parties = cur.fetchall()
-    conn.close()
+    parties = party_list()
 
     if not parties:
         area.error("❌ No parties found. Add parties first.")
@@ -178,15 +99,16 @@ def render_billing(area):
     with col2:
         end_dt = area.date_input("To Date", date.today(), key="bill_to")
 
-    old_balance = area.number_input("Old Balance (₹)", value=0.0, step=100.0, key="bill_old_bal")
-
     if start_dt > end_dt:
         area.error("❌ From Date cannot be greater than To Date.")
         return
 
+    old_balance, checkpoint = get_opening_balance(party_id, start_dt)
+    area.info(f"Old Balance ({start_dt.strftime('%d-%m-%Y')} से पहले): ₹ {old_balance:,.2f}"
+              + (f" · closed month {checkpoint[:7]} + बाद की entries" if checkpoint else ""))
+
     if area.button("🔍 Show Bill", type="primary", key="show_bill_btn"):
-        conn = get_conn()
-        df = pd.read_sql_query("""
+        df = read_sql_timed(area, """
             SELECT 
                 t.id AS token_no,
                 t.date_time,
@@ -197,21 +119,10 @@ def render_billing(area):
                 t.to_city
             FROM tokens t
             WHERE t.party_id = ?
+              AND t.business_day BETWEEN ? AND ?
               AND t.status IN ('PENDING', 'LOADED')
-            ORDER BY t.date_time
-        """, conn, params=(party_id,))
-        conn.close()
-
-        if df.empty:
-            area.warning("No records for this party.")
-            return
-
-        df["dt"] = pd.to_datetime(df["date_time"], errors="coerce")
-        df = df[df["dt"].notna()].copy()
-        df["d"] = df["dt"].dt.date
-
-        mask = (df["d"] >= start_dt) & (df["d"] <= end_dt)
-        df = df[mask]
+            ORDER BY t.booked_at
+        """, (party_id, start_dt.isoformat(), end_dt.isoformat()), tables=("tokens",))
 
         if df.empty:
             area.warning("No records in this date range.")
@@ -251,6 +162,8 @@ def render_billing(area):
             "old_balance": old_balance,
         }
 
+        from utils.pdf_utils import bill_pdf
+
         pdf_buf = bill_pdf(header, rows)
         area.download_button(
             "⬇️ Download Bill PDF",
@@ -273,13 +186,11 @@ def render_billing(area):
 # SECTION: LEDGER
 # -------------------------
 def render_ledger(area):
+    import pandas as pd
+
     area.title("📚 Party Ledger")
 
-    conn = get_conn()
-    cur = conn.cursor()
-    cur.execute("SELECT id, party_name FROM party_master ORDER BY party_name")
-    parties = cur.fetchall()
-    conn.close()
+    parties = party_list()
 
     if not parties:
         area.error("❌ Add Party first.")
@@ -289,8 +200,6 @@ def render_ledger(area):
     party_name = area.selectbox("Select Party", list(party_map.keys()), key="ledger_party")
     party_id = party_map[party_name]
 
-    opening_balance = area.number_input("Opening Balance (₹)", value=0.0, step=100.0, key="ledger_opening")
-
     col1, col2 = area.columns(2)
     with col1:
         start_dt = area.date_input("From Date", date.today().replace(day=1), key="ledger_from")
@@ -301,70 +210,31 @@ def render_ledger(area):
         area.error("❌ From Date cannot be after To Date.")
         return
 
-    if area.button("📄 Show Ledger", type="primary", key="show_ledger_btn"):
-        conn = get_conn()
-        tokens = pd.read_sql_query("""
-            SELECT t.date_time, t.id AS token_no, t.amount, t.party_id
-            FROM tokens t
-            WHERE t.party_id = ?
-            ORDER BY t.date_time
-        """, conn, params=(party_id,))
-
-        payments = pd.read_sql_query("""
-            SELECT date, amount, mode, remark
-            FROM payments
-            WHERE party_id = ?
-            ORDER BY date
-        """, conn, params=(party_id,))
-        conn.close()
+    opening_balance, checkpoint = get_opening_balance(party_id, start_dt)
+    area.info(f"Opening Balance: ₹ {opening_balance:,.2f}"
+              + (f" · closed month {checkpoint[:7]} + बाद की entries" if checkpoint else ""))
+
+    with area.expander("🔒 Month Closing"):
+        closed = get_closed_periods()
+        area.write(f"Last closed month: {closed[0][0][:7]}" if closed else "अभी कोई month close नहीं हुआ।")
+        if area.button("🔒 Close pending months", key="ledger_close_months"):
+            months = close_periods()
+            if months:
+                area.success(f"✅ Closed {len(months)} months ({months[0]:%Y-%m} – {months[-1]:%Y-%m})")
+            else:
+                area.info("सभी पूरे months पहले से closed हैं।")
 
-        rows = []
-        if not tokens.empty:
-            tokens["dt"] = pd.to_datetime(tokens["date_time"], errors="coerce")
-            tokens = tokens[tokens["dt"].notna()]
-            tokens["d"] = tokens["dt"].dt.date
-            tokens = tokens[(tokens["d"] >= start_dt) & (tokens["d"] <= end_dt)]
-            for _, r in tokens.iterrows():
-                rows.append({
-                    "date": r["d"].strftime("%d-%m-%Y"),
-                    "type": "TOKEN",
-                    "details": f"Token #{r['token_no']}",
-                    "debit": r["amount"],
-                    "credit": 0,
-                })
-
-        if not payments.empty:
-            payments["dt"] = pd.to_datetime(payments["date"], errors="coerce", dayfirst=True)
-            payments = payments[payments["dt"].notna()]
-            payments["d"] = payments["dt"].dt.date
-            payments = payments[(payments["d"] >= start_dt) & (payments["d"] <= end_dt)]
-            for _, r in payments.iterrows():
-                desc = f"Payment ({r['mode']})"
-                if r["remark"]:
-                    desc += f" - {r['remark']}"
-                rows.append({
-                    "date": r["d"].strftime("%d-%m-%Y"),
-                    "type": "PAYMENT",
-                    "details": desc,
-                    "debit": 0,
-                    "credit": r["amount"],
-                })
+    if area.button("📄 Show Ledger", type="primary", key="show_ledger_btn"):
+        started = time.perf_counter()
+        columns, rows = get_party_ledger(party_id, start_dt, end_dt, opening_balance)
+        area.caption(f"{len(rows)} rows · {(time.perf_counter() - started) * 1000:.1f} ms")
 
         if not rows:
             area.warning("No transactions.")
             return
 
-        ledger_df = pd.DataFrame(rows)
-        ledger_df["date_sort"] = pd.to_datetime(ledger_df["date"], dayfirst=True)
-        ledger_df.sort_values("date_sort", inplace=True)
-
-        balance = opening_balance
-        balances = []
-        for _, r in ledger_df.iterrows():
-            balance += r["debit"] - r["credit"]
-            balances.append(balance)
-        ledger_df["balance"] = balances
-        ledger_df.drop(columns=["date_sort"], inplace=True)
+        ledger_df = pd.DataFrame(rows, columns=columns)
+        balance = ledger_df["balance"].iat[-1]
 
         area.dataframe(ledger_df, use_container_width=True)
 
@@ -376,6 +246,8 @@ def render_ledger(area):
             "closing_balance": float(balance)
         }
 
+        from utils.pdf_utils import ledger_pdf
+
         pdf_buf = ledger_pdf(header, ledger_df.to_dict(orient="records"))
         area.download_button(
             "⬇️ Download Ledger PDF",
@@ -397,86 +269,113 @@ def render_ledger(area):
 # -------------------------
 # SECTION: REPORTS
 # -------------------------
-def render_reports(area):
-    area.title("📊 Reports")
-    conn = get_conn()
+OUTSTANDING_SORT_LABELS = {"outstanding": "Outstanding", "billing": "Total Billing",
+                           "payments": "Payments", "party": "Party Name"}
+OUTSTANDING_PAGE_SIZES = [25, 50, 100, 500]
+
 
-    tokens = pd.read_sql_query("""
-        SELECT t.id AS token_no, t.date_time, p.party_name, t.weight, t.pkgs AS packages, t.amount
-        FROM tokens t
-        LEFT JOIN party_master p ON p.id = t.party_id
-    """, conn)
+def _reset_outstanding_page():
+    st.session_state["rep_out_page"] = 1
 
-    payments = pd.read_sql_query("SELECT party_id, date, amount FROM payments", conn)
-    parties = pd.read_sql_query("SELECT id, party_name FROM party_master", conn)
-    conn.close()
 
-    if not tokens.empty:
-        tokens["dt"] = pd.to_datetime(tokens["date_time"], errors="coerce")
-        tokens = tokens[tokens["dt"].notna()]
-        tokens["d"] = tokens["dt"].dt.date
+def render_reports(area):
+    import pandas as pd
 
-    if not payments.empty:
-        payments["dt"] = pd.to_datetime(payments["date"], errors="coerce", dayfirst=True)
-        payments = payments[payments["dt"].notna()]
+    area.title("📊 Reports")
 
     tab1, tab2 = area.tabs(["📅 Daily Booking", "💰 Outstanding"])
 
     with tab1:
-        area.subheader("📅 Daily Booking")
-        col1, col2 = area.columns(2)
+        area.subheader("📅 Booking Summary")
+        col1, col2, col3 = area.columns(3)
         with col1:
             start_dt = area.date_input("From Date", date.today().replace(day=1), key="rep_from")
         with col2:
             end_dt = area.date_input("To Date", date.today(), key="rep_to")
+        with col3:
+            grain = area.selectbox("Group by", ["day", "week", "month"], key="rep_grain",
+                                   format_func={"day": "Daily", "week": "Weekly", "month": "Monthly"}.get)
 
         if start_dt > end_dt:
             area.error("Invalid date range.")
         else:
-            if tokens.empty:
-                area.warning("No booking data.")
+            started = time.perf_counter()
+            columns, rows = get_booking_summary(start_dt, end_dt, grain)
+            grp = pd.DataFrame(rows, columns=columns)
+            area.caption(f"{len(grp)} rows · {(time.perf_counter() - started) * 1000:.1f} ms (daily rollup)")
+            if grp.empty:
+                area.warning("No records in range.")
             else:
-                df = tokens[(tokens["d"] >= start_dt) & (tokens["d"] <= end_dt)]
-                if df.empty:
-                    area.warning("No records in range.")
-                else:
-                    grp = df.groupby("d").agg(
-                        tokens=("token_no", "count"),
-                        weight=("weight", "sum"),
-                        amount=("amount", "sum")
-                    ).reset_index()
-                    grp["d"] = grp["d"].apply(lambda x: x.strftime("%d-%m-%Y"))
-                    area.dataframe(grp.rename(columns={"d": "Date", "tokens": "Tokens", "weight": "Total Weight", "amount": "Total Amount"}), use_container_width=True)
+                grp["period"] = pd.to_datetime(grp["period"]).dt.strftime("%b %Y" if grain == "month" else "%d-%m-%Y")
+                label = {"day": "Date", "week": "Week of", "month": "Month"}[grain]
+                area.dataframe(grp.rename(columns={"period": label, "tokens": "Tokens", "weight": "Total Weight",
+                                                   "pkgs": "Packages", "amount": "Total Amount"}),
+                               use_container_width=True)
+
+        status = get_daily_summary_rebuild_status()
+        if area.button("🔄 Rebuild rollup (background)", key="rep_rebuild_summary", disabled=status["running"]):
+            start_daily_summary_rebuild()
+            area.info("Rebuild शुरू हो गया — report चलता रहेगा।")
+        elif status["running"]:
+            area.info("Rollup rebuild चल रहा है…")
+        elif status["error"]:
+            area.error(f"❌ Last rebuild failed: {status['error']}")
+        elif status["last"]:
+            area.caption(f"Last rebuild: {status['last']['chunks']} chunks in {status['last']['elapsed_ms']:.0f} ms")
 
     with tab2:
         area.subheader("💰 Outstanding by Party")
-        if tokens.empty and payments.empty:
+        col1, col2, col3, col4 = area.columns(4)
+        with col1:
+            sort = area.selectbox("Sort by", list(OUTSTANDING_SORT_LABELS), key="rep_out_sort",
+                                  format_func=OUTSTANDING_SORT_LABELS.get, on_change=_reset_outstanding_page)
+        with col2:
+            descending = area.radio("Order", ["High → Low", "Low → High"], key="rep_out_order", horizontal=True,
+                                    on_change=_reset_outstanding_page) == "High → Low"
+        with col3:
+            min_amount = area.number_input("Only above ₹", min_value=0.0, value=0.0, step=1000.0,
+                                           key="rep_out_min", on_change=_reset_outstanding_page)
+        with col4:
+            page_size = area.selectbox("Rows per page", OUTSTANDING_PAGE_SIZES, key="rep_out_size",
+                                       on_change=_reset_outstanding_page)
+        as_of = area.date_input("As of", date.today(), key="rep_out_as_of", on_change=_reset_outstanding_page)
+        page = st.session_state.setdefault("rep_out_page", 1)
+
+        started = time.perf_counter()
+        result = get_outstanding(sort, descending, min_amount or None, page_size, (page - 1) * page_size,
+                                 None if as_of >= date.today() else as_of)
+        elapsed_ms = (time.perf_counter() - started) * 1000
+        # the report may have shrunk since the page was picked; follow the clamped page
+        page = result["offset"] // page_size + 1
+        st.session_state["rep_out_page"] = page
+        if not result["rows"]:
             area.warning("Not enough data.")
         else:
-            tok_sum = tokens.groupby("party_name")["amount"].sum() if not tokens.empty else pd.Series(dtype="float64")
-            pay_sum = pd.Series(dtype="float64")
-            if not payments.empty and not parties.empty:
-                pay_sum = payments.merge(parties, left_on="party_id", right_on="id").groupby("party_name")["amount"].sum()
-            out_df = pd.DataFrame({"Total Billing": tok_sum, "Payments": pay_sum}).fillna(0)
-            out_df["Outstanding"] = out_df["Total Billing"] - out_df["Payments"]
-            area.dataframe(out_df, use_container_width=True)
+            pages = -(-result["parties"] // page_size)
+            area.caption(f"{result['parties']} parties · Total outstanding ₹ {result['outstanding']:,.2f} · "
+                         f"page {page} of {pages} · {elapsed_ms:.1f} ms")
+            out_df = pd.DataFrame(result["rows"], columns=["party_name", "Total Billing", "Payments", "Outstanding"])
+            area.dataframe(out_df.set_index("party_name"), use_container_width=True)
+            if pages > 1:
+                area.number_input("Page", min_value=1, max_value=pages, step=1, key="rep_out_page")
 
 # -------------------------
 # SECTION: DELIVERY ENTRY
 # -------------------------
 def render_delivery(area):
+    import pandas as pd
+
     area.title("📦 Delivery Entry (Token Delivery Update)")
     area.info("यहाँ से Delivered माल का entry करें।")
 
-    conn = get_conn()
-    df = pd.read_sql_query("""
-        SELECT t.id AS token_id, t.date_time, p.party_name, t.from_city, t.to_city, t.weight, t.amount
-        FROM tokens t
-        LEFT JOIN party_master p ON p.id = t.party_id
-        WHERE t.status='LOADED'
-        ORDER BY t.date_time
-    """, conn)
-    conn.close()
+    with get_conn() as conn:
+        df = pd.read_sql_query("""
+            SELECT t.id AS token_id, t.date_time, p.party_name, t.from_city, t.to_city, t.weight, t.amount
+            FROM tokens t
+            LEFT JOIN party_master p ON p.id = t.party_id
+            WHERE t.status='LOADED'
+            ORDER BY t.date_time
+        """, conn)
 
     if df.empty:
         area.warning("कोई Loaded token नहीं मिला।")
@@ -504,11 +403,6 @@ def render_delivery(area):
                 f.write(signature_file.getbuffer())
             signature_path = file_name
 
-        conn = get_conn()
-        cur = conn.cursor()
-        cur.execute("INSERT INTO delivery_log (token_id, delivery_date, receiver_name, signature) VALUES (?, ?, ?, ?)",
-                   (token_id, delivery_date.strftime("%d-%m-%Y"), receiver_name, signature_path))
-        cur.execute("UPDATE tokens SET status='DELIVERED' WHERE id=?", (token_id,))
-        conn.commit()
-        conn.close()
+        mark_token_delivered(token_id, receiver_name, signature_path, delivery_date=delivery_date,
+                             office=st.session_state.get("office"))
         area.success("🚚 Delivery Updated Successfully!")
\ No newline at end of file
@@ -0,0 +1,171 @@
+# pages/router.py - PAGE REGISTRY + NAVIGATION
+import importlib
+import time
+import streamlit as st
+
+# Import shared utilities
+from auth_utils import hide_default_sidebar, record_rerun_ms, release_reservations
+from utils.perf_utils import note_page, startup_report
+
+# -------------------------
+# Page registry
+# -------------------------
+# page id -> label, roles allowed, module and render function. The module is
+# imported on first navigation to the page, so sections that are never opened
+# cost nothing. Order here is menu order; "divider" draws a line above the
+# entry in the admin sidebar. Every render function takes the render area.
+PAGES = {
+    "home":         {"label": "🏠 Home", "roles": ("ADMIN", "OPERATOR"),
+                     "module": "pages.router", "func": "render_home"},
+    "dashboard":    {"label": "📊 Dashboard", "roles": ("ADMIN",),
+                     "module": "pages.combined_all_part1", "func": "section_dashboard"},
+    "party":        {"label": "👥 Party Master", "roles": ("ADMIN",),
+                     "module": "pages.combined_all_part1", "func": "section_party"},
+    "item_rate":    {"label": "📦 Item / Rate Master", "roles": ("ADMIN",),
+                     "module": "pages.combined_all_part1", "func": "section_item_rate"},
+    "token":        {"label": "📄 Token / Bilty", "roles": ("ADMIN", "OPERATOR"),
+                     "module": "pages.combined_all_part1", "func": "section_token"},
+    "token_import": {"label": "📥 Bulk Token Import", "roles": ("ADMIN", "OPERATOR"),
+                     "module": "pages.combined_all_part1", "func": "section_token_import"},
+    "challan":      {"label": "🚛 Challan / Loading", "roles": ("ADMIN", "OPERATOR"),
+                     "module": "pages.combined_all_part1", "func": "section_challan"},
+    "payments":     {"label": "💰 Payments", "roles": ("ADMIN",), "divider": True,
+                     "module": "pages.combined_all_part2", "func": "render_payments"},
+    "billing":      {"label": "🧾 Billing", "roles": ("ADMIN",),
+                     "module": "pages.combined_all_part2", "func": "render_billing"},
+    "ledger":       {"label": "📚 Ledger", "roles": ("ADMIN",),
+                     "module": "pages.combined_all_part2", "func": "render_ledger"},
+    "reports":      {"label": "📊 Reports", "roles": ("ADMIN",),
+                     "module": "pages.combined_all_part2", "func": "render_reports"},
+    "delivery":     {"label": "📦 Delivery Entry", "roles": ("ADMIN",),
+                     "module": "pages.combined_all_part2", "func": "render_delivery"},
+}
+
+
+def pages_for(role):
+    """Page ids the role may open, in menu order."""
+    return [pid for pid, spec in PAGES.items() if role in spec["roles"]]
+
+
+def load_page(page_id):
+    """Render function of a page, importing its module on first use."""
+    spec = PAGES[page_id]
+    return getattr(importlib.import_module(spec["module"]), spec["func"])
+
+
+# -------------------------
+# Navigation handlers
+# -------------------------
+def nav_to_page(page_name):
+    """Navigate to a page (used as a button on_click, so no extra rerun is needed)"""
+    if st.session_state.get("combined_page") == "challan" and page_name != "challan":
+        release_reservations()
+    st.session_state["combined_page"] = page_name
+
+
+def _toggle_timings():
+    st.session_state["show_timings"] = st.session_state["show_timings_toggle"]
+
+
+def get_main_render():
+    """Return the right render area based on user role."""
+    if st.session_state.get("role") == "ADMIN":
+        admin_top_buttons()
+        return st  # render in main area
+    hide_default_sidebar()
+    return operator_left_panel()
+
+
+def operator_left_panel():
+    left_col, main_col = st.columns([1, 4], gap="small")
+    with left_col:
+        st.markdown("### 🚚 Operator Menu")
+        for pid in pages_for("OPERATOR"):
+            if pid == "home":
+                continue
+            st.button(PAGES[pid]["label"], key=f"op_btn_{pid}", use_container_width=True,
+                      on_click=nav_to_page, args=(pid,))
+
+        st.markdown("---")
+        st.markdown(f"**User:** {st.session_state.get('username')}")
+        st.markdown(f"**Office:** {st.session_state.get('office')}")
+
+    return main_col
+
+
+def admin_top_buttons():
+    st.sidebar.markdown("### 📋 Admin Menu")
+    for pid in pages_for("ADMIN"):
+        if PAGES[pid].get("divider"):
+            st.sidebar.markdown("---")
+        st.sidebar.button(PAGES[pid]["label"], key=f"admin_btn_{pid}", use_container_width=True,
+                          on_click=nav_to_page, args=(pid,))
+
+
+# -------------------------
+# Entry point
+# -------------------------
+def run_app():
+    """
+    Runtime entrypoint - called from app.py after login.
+    Access check and render timing for every page happen here.
+    """
+    started = time.perf_counter()
+    role = st.session_state.get("role")
+    main_render = get_main_render()
+    page = st.session_state.get("combined_page", "home")
+    if page not in PAGES:
+        page = "home"
+
+    spec = PAGES[page]
+    if role in spec["roles"]:
+        load_page(page)(main_render)
+    else:
+        title = spec["label"].split(" ", 1)[-1]
+        st.error(f"❌ Access Denied: {(role or 'guest').title()}s cannot access {title}")
+
+    record_rerun_ms(f"page:{page}", started)
+    note_page(page, started)
+
+
+# -------------------------
+# SECTION: HOME
+# -------------------------
+def render_home(main_render):
+    if st.session_state.get("role") != "ADMIN":
+        main_render.info("👉 Use the menu to navigate")
+        return
+
+    from utils.cache_utils import party_list
+
+    main_render.title("👋 Admin Dashboard — Transport Management")
+    main_render.write("Use the buttons below to open any section.")
+
+    # Quick access grid, built from the registry
+    menu = [pid for pid in pages_for("ADMIN") if pid != "home"]
+    cols_per_row = 3
+    for i in range(0, len(menu), cols_per_row):
+        cols = main_render.columns(cols_per_row, gap="large")
+        for j, pid in enumerate(menu[i:i + cols_per_row]):
+            with cols[j]:
+                main_render.button(PAGES[pid]["label"], key=f"admin_dashboard_btn_{pid}",
+                                   use_container_width=True, on_click=nav_to_page, args=(pid,))
+
+    parties = party_list()
+    if parties:
+        main_render.success(f"Total Parties: {len(parties)}")
+    else:
+        main_render.info("👉 No parties yet. Add parties using Party Master.")
+
+    with main_render.expander("⏱ Startup report"):
+        report = startup_report()
+        cold = report["cold_start_ms"]
+        main_render.write(f"Cold start: {cold:.0f} ms" if cold else "Cold start: (this is the first run)")
+        main_render.write(f"Heavy modules loaded: {', '.join(report['loaded']) or '-'}")
+        if report["first_page_ms"]:
+            main_render.table({"Page": list(report["first_page_ms"]),
+                               "First render (ms)": [round(v) for v in report["first_page_ms"].values()]})
+        main_render.caption("Import-time breakdown: python -m utils.perf_utils")
+        # plain session key (not the widget key) so the flag survives on other pages
+        main_render.checkbox("Show render timings on token / challan forms", key="show_timings_toggle",
+                             value=st.session_state.get("show_timings", False), on_change=_toggle_timings)
@@ -0,0 +1,21 @@
+# tests/conftest.py
+
+import pytest
+
+import db
+
+
+@pytest.fixture
+def db_path(tmp_path, monkeypatch):
+    """Point db at an empty database file under tmp_path (never tms.db)."""
+    path = str(tmp_path / "tms.db")
+    monkeypatch.setattr(db, "DB_PATH", path)
+    yield path
+    db._get_pool().close_all()
+
+
+@pytest.fixture
+def tms_db(db_path):
+    """A fresh database with every migration applied."""
+    db.init_db()
+    return db_path
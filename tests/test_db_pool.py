@@ -0,0 +1,46 @@
+# tests/test_db_pool.py
+
+import threading
+
+import pytest
+
+import db
+
+
+@pytest.fixture
+def small_pool(db_path):
+    profile = dict(db.DB_PROFILES["default"], pool_size=2, checkout_timeout_s=2.0)
+    pool = db.ConnectionPool(db_path, profile)
+    yield pool
+    pool.close_all()
+
+
+@pytest.fixture
+def gc_calls(monkeypatch):
+    calls = []
+    real = db.gc.collect
+    monkeypatch.setattr(db.gc, "collect", lambda *a: calls.append(a) or real(*a))
+    return calls
+
+
+def test_released_connections_are_reused_without_gc(small_pool, gc_calls):
+    held = [small_pool.acquire(), small_pool.acquire()]
+    threading.Timer(0.02, held[0].close).start()
+    conn = small_pool.acquire()  # waits for the release, well under RECLAIM_GC_AFTER_S
+    assert conn is held[0]
+    conn.close()
+    held[1].close()
+    assert gc_calls == []
+    assert small_pool.stats["opened"] == 2 and small_pool.stats["reclaimed"] == 0
+
+
+def test_leaked_connection_slot_is_reclaimed(small_pool, gc_calls):
+    keep = small_pool.acquire()
+    leaked = small_pool.acquire()
+    leaked.execute("SELECT 1")
+    del leaked  # dropped without close()
+    conn = small_pool.acquire()
+    assert len(gc_calls) <= 1
+    assert small_pool.stats["reclaimed"] == 1
+    conn.close()
+    keep.close()
@@ -0,0 +1,140 @@
+# tests/test_db_triggers.py
+#
+# party_balance, daily_route_party_summary and party_closing_balance are kept
+# up to date by triggers on tokens / payments. Each test runs on a temp
+# database and checks the verify_* helpers (full recomputation) after writes.
+
+import sqlite3
+from datetime import date, timedelta
+
+import db
+
+
+def assert_derived_tables_ok():
+    assert db.verify_party_balance() == []
+    assert db.verify_daily_summary() == []
+    assert db.verify_closing_balances() == []
+
+
+def add_token(conn, party_id, day, amount, status="PENDING", from_city="Indore", to_city="Bhopal"):
+    """Insert a token booked on `day` ('dd/mm/YYYY'); returns its id."""
+    cur = conn.execute("""
+        INSERT INTO tokens (token_no, date_time, booked_at, party_id, marka, from_city, to_city,
+                            weight, pkgs, rate, amount, status)
+        VALUES ((SELECT COALESCE(MAX(token_no), 0) + 1 FROM tokens), ?, ?, ?, 'M', ?, ?, 10, 1, ?, ?, ?)
+    """, (day, db.to_epoch(day), party_id, from_city, to_city, amount / 10, amount, status))
+    return cur.lastrowid
+
+
+def add_payment(conn, party_id, day, amount):
+    cur = conn.execute("INSERT INTO payments (party_id, date, paid_at, amount, mode) VALUES (?, ?, ?, ?, 'CASH')",
+                       (party_id, day, db.to_epoch(day), amount))
+    return cur.lastrowid
+
+
+def test_fresh_database_is_at_schema_version(tms_db):
+    assert db.get_schema_version() == db.SCHEMA_VERSION
+    with db.get_conn() as conn:
+        tables = {r[0] for r in conn.execute("SELECT name FROM sqlite_master WHERE type = 'table'")}
+    assert set(db.DERIVED_TABLES) <= tables
+    assert {"closed_period", "table_generation"} <= tables
+    assert_derived_tables_ok()
+
+
+def test_migrations_fill_derived_tables_from_existing_rows(db_path):
+    # a database from before the derived tables existed, with data in it
+    conn = sqlite3.connect(db_path)
+    cur = conn.cursor()
+    for step, migrate in enumerate(db.MIGRATIONS[:4], start=1):
+        migrate(cur)
+        cur.execute(f"PRAGMA user_version = {step}")
+    cur.execute("INSERT INTO party_master (party_name, marka) VALUES ('Ram Traders', 'RT'), ('Shyam & Co', 'SC')")
+    cur.executemany("""
+        INSERT INTO tokens (token_no, date_time, party_id, marka, from_city, to_city, weight, pkgs, rate, amount, status)
+        VALUES (?, ?, ?, 'RT', 'Indore', 'Bhopal', 10, 1, 5, ?, ?)
+    """, [(1, "2025-01-10T06:00:00", 1, 500, "PENDING"),
+          (2, "2025-02-03T06:00:00", 1, 250, "DELIVERED"),
+          (3, "2025-02-03T07:00:00", 2, 100, "CANCELLED"),
+          (4, "2025-03-15T06:00:00", 2, 400, "LOADED")])
+    cur.executemany("INSERT INTO payments (party_id, date, amount, mode) VALUES (?, ?, ?, 'CASH')",
+                    [(1, "20/01/2025", 300), (2, "01/03/2025", 150)])
+    conn.commit()
+    conn.close()
+
+    db.init_db()
+    assert db.get_schema_version() == db.SCHEMA_VERSION
+    assert_derived_tables_ok()
+    with db.get_conn() as conn:
+        balances = dict(conn.execute("SELECT party_id, token_total - payment_total FROM party_balance"))
+    assert balances == {1: 450, 2: 250}
+
+    assert db.close_periods("2025-03") == [date(2025, 1, 31), date(2025, 2, 28), date(2025, 3, 31)]
+    assert db.verify_closing_balances() == []
+    assert db.get_opening_balance(1, date(2025, 2, 1))[0] == 200
+
+
+def test_token_and_payment_writes_keep_derived_tables_in_sync(tms_db):
+    a = db.save_party("Ram Traders", marka="RT")
+    b = db.save_party("Shyam & Co", marka="SC")
+    with db.transaction() as conn:
+        t1 = add_token(conn, a, "10/01/2025", 500)
+        t2 = add_token(conn, a, "20/01/2025", 300)
+        t3 = add_token(conn, b, "05/02/2025", 200, status="LOADED")
+        t4 = add_token(conn, b, "12/03/2025", 150)
+        p1 = add_payment(conn, a, "25/01/2025", 400)
+        p2 = add_payment(conn, b, "10/03/2025", 100)
+    assert_derived_tables_ok()
+
+    assert db.close_periods("2025-02") == [date(2025, 1, 31), date(2025, 2, 28)]
+    assert_derived_tables_ok()
+
+    # every kind of edit, including ones that reach back into closed months
+    steps = [
+        ("UPDATE tokens SET amount = 550 WHERE id = ?", (t1,)),
+        ("UPDATE tokens SET party_id = ? WHERE id = ?", (b, t2)),
+        ("UPDATE tokens SET status = 'DELIVERED' WHERE id = ?", (t3,)),
+        ("UPDATE tokens SET to_city = 'Ujjain' WHERE id = ?", (t3,)),
+        ("UPDATE tokens SET booked_at = ? WHERE id = ?", (db.to_epoch("02/03/2025"), t1)),
+        ("UPDATE tokens SET booked_at = ? WHERE id = ?", (db.to_epoch("15/01/2025"), t4)),
+        ("UPDATE tokens SET status = 'CANCELLED' WHERE id = ?", (t3,)),
+        ("UPDATE tokens SET status = 'PENDING' WHERE id = ?", (t3,)),
+        ("UPDATE tokens SET party_id = NULL WHERE id = ?", (t4,)),
+        ("UPDATE payments SET amount = 450 WHERE id = ?", (p1,)),
+        ("UPDATE payments SET paid_at = ? WHERE id = ?", (db.to_epoch("28/02/2025"), p2)),
+        ("UPDATE payments SET party_id = ? WHERE id = ?", (b, p1)),
+        ("DELETE FROM tokens WHERE id = ?", (t2,)),
+        ("DELETE FROM payments WHERE id = ?", (p2,)),
+    ]
+    for sql, params in steps:
+        with db.transaction() as conn:
+            conn.execute(sql, params)
+        assert (db.verify_party_balance(), db.verify_daily_summary(), db.verify_closing_balances()) \
+            == ([], [], []), sql
+
+    # the booking form path and the cancel action
+    db.create_token_in_db("RT", None, 10, 2, 5)
+    assert_derived_tables_ok()
+    with db.get_conn() as conn:
+        token_id = conn.execute("SELECT MAX(id) FROM tokens").fetchone()[0]
+    db.cancel_token(token_id)
+    db.record_payment(a, "05/03/2025", 50, "CASH")
+    assert_derived_tables_ok()
+
+    # re-closing a month after edits stays consistent too
+    db.close_period("2025-01")
+    assert_derived_tables_ok()
+
+
+def test_close_periods_stops_at_the_last_complete_month(tms_db):
+    a = db.save_party("Ram Traders", marka="RT")
+    this_month = db._last_complete_month() + timedelta(days=1)
+    last_month = this_month - timedelta(days=1)
+    month_before = last_month.replace(day=1) - timedelta(days=1)
+    with db.transaction() as conn:
+        for day in (month_before.replace(day=1), last_month.replace(day=1), this_month):
+            add_token(conn, a, f"{day:%d/%m/%Y}", 100)
+
+    assert db.close_periods(f"{this_month:%Y-%m}") == [month_before, last_month]
+    assert [r[0] for r in db.get_closed_periods()] == [last_month.isoformat(), month_before.isoformat()]
+    assert db.close_periods(f"{this_month.year + 1}-01") == []
+    assert_derived_tables_ok()
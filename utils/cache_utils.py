@@ -0,0 +1,92 @@
+# utils/cache_utils.py
+
+import streamlit as st
+
+import db
+from utils.search_index import MarkaIndex
+
+
+# Master data (parties, markas, items, rates) changes a few times a day but is
+# read on every rerun. These wrappers keep one copy per server process; every
+# screen that writes master data calls clear_master_cache() afterwards.
+# db.DB_PATH and the generations of the tables read (db.table_generations) are
+# part of the key, so a master write from another process or a CLI job is
+# picked up on the next rerun, while token / payment / reservation commits
+# leave these entries alone.
+PARTY_TABLES = ("party_master",)
+MARKA_TABLES = ("party_master", "party_marka")
+ITEM_TABLES = ("item_master",)
+RATE_TABLES = ("rate_master", "party_master")
+
+@st.cache_data(show_spinner=False, max_entries=4)
+def _party_list(db_path, generations):
+    return db.get_party_list()
+
+
+@st.cache_resource(show_spinner=False, max_entries=2)
+def _marka_index(db_path, generations):
+    # shared read-only object, so cache_resource (no per-call copy)
+    return MarkaIndex(db.get_all_markas())
+
+
+@st.cache_data(show_spinner=False, max_entries=4)
+def _party_table(db_path, generations):
+    import pandas as pd
+
+    with db.get_conn() as conn:
+        return pd.read_sql_query(
+            "SELECT party_name, mobile, marka, default_rate_per_kg FROM party_master ORDER BY party_name", conn)
+
+
+@st.cache_data(show_spinner=False, max_entries=4)
+def _item_table(db_path, generations):
+    import pandas as pd
+
+    with db.get_conn() as conn:
+        return pd.read_sql_query("SELECT item_name, description FROM item_master ORDER BY item_name", conn)
+
+
+@st.cache_data(show_spinner=False, max_entries=4)
+def _rate_table(db_path, generations):
+    import pandas as pd
+
+    with db.get_conn() as conn:
+        return pd.read_sql_query("""
+            SELECT
+              COALESCE((SELECT party_name FROM party_master p WHERE p.id = r.party_id), 'ALL') AS party,
+              from_city, to_city, rate_type, rate
+            FROM rate_master r
+            ORDER BY party, from_city, to_city
+        """, conn)
+
+
+def party_list():
+    """Cached get_party_list(): [(id, party_name, marka), ...]."""
+    return _party_list(db.DB_PATH, db.table_generations(*PARTY_TABLES))
+
+
+def marka_index():
+    """Prefix search index over markas and party names (see utils.search_index)."""
+    return _marka_index(db.DB_PATH, db.table_generations(*MARKA_TABLES))
+
+
+def party_table():
+    """Party Master list as a DataFrame."""
+    return _party_table(db.DB_PATH, db.table_generations(*PARTY_TABLES))
+
+
+def item_table():
+    """Item Master list as a DataFrame."""
+    return _item_table(db.DB_PATH, db.table_generations(*ITEM_TABLES))
+
+
+def rate_table():
+    """Rate Master list as a DataFrame (party name or 'ALL')."""
+    return _rate_table(db.DB_PATH, db.table_generations(*RATE_TABLES))
+
+
+def clear_master_cache():
+    """Drop every cached master lookup; call after any party / marka / item / rate / route write."""
+    for fn in (_party_list, _marka_index, _party_table, _item_table, _rate_table):
+        fn.clear()
+    db.invalidate_route_cache()
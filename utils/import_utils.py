@@ -0,0 +1,93 @@
+# utils/import_utils.py
+
+import csv
+import io
+
+
+# Header spellings accepted in uploaded sheets -> create_tokens_bulk() keys
+TOKEN_COLUMN_ALIASES = {
+    "marka": "marka",
+    "mark": "marka",
+    "weight": "weight",
+    "weight (kg)": "weight",
+    "weight_kg": "weight",
+    "pkgs": "pkgs",
+    "packages": "pkgs",
+    "parcel": "pkgs",
+    "rate": "rate",
+    "rate_type": "rate_type",
+    "rate type": "rate_type",
+    "from_city": "from_city",
+    "from": "from_city",
+    "to_city": "to_city",
+    "to": "to_city",
+    "consignor": "consignor",
+    "consignee": "consignee",
+    "driver_mobile": "driver_mobile",
+    "driver mobile": "driver_mobile",
+}
+
+TOKEN_TEMPLATE_COLUMNS = ["marka", "weight", "pkgs", "rate", "rate_type",
+                          "from_city", "to_city", "consignor", "consignee", "driver_mobile"]
+
+
+def _map_header(header):
+    return [TOKEN_COLUMN_ALIASES.get(str(h or "").strip().lower()) for h in header]
+
+
+def _rows_from_values(values):
+    """values: iterator of row tuples, first one the header. Yields (row_no, dict)."""
+    header = None
+    for row_no, values_row in enumerate(values, start=1):
+        if header is None:
+            header = _map_header(values_row)
+            if "marka" not in header:
+                raise ValueError("Header row must include a 'marka' column")
+            continue
+        if not any(v not in (None, "") for v in values_row):
+            continue
+        yield row_no, {key: val for key, val in zip(header, values_row) if key}
+
+
+def iter_csv_rows(file_obj):
+    """Stream (row_no, dict) from a CSV upload (bytes or text file object)."""
+    if isinstance(file_obj.read(0), bytes):
+        file_obj = io.TextIOWrapper(file_obj, encoding="utf-8-sig", newline="")
+    yield from _rows_from_values(csv.reader(file_obj))
+
+
+def iter_xlsx_rows(file_obj):
+    """
+    Stream (row_no, dict) from the first sheet of an xlsx upload (openpyxl read-only mode).
+    A corrupt or mislabelled file raises ValueError, like a bad header does.
+    """
+    from zipfile import BadZipFile
+    from openpyxl import load_workbook
+    from openpyxl.utils.exceptions import InvalidFileException
+
+    # KeyError: a zip that is missing the workbook parts openpyxl expects
+    bad_file = (BadZipFile, InvalidFileException, KeyError)
+    try:
+        wb = load_workbook(file_obj, read_only=True, data_only=True)
+    except bad_file as e:
+        raise ValueError(f"Not a valid .xlsx file: {e}") from e
+    try:
+        yield from _rows_from_values(wb.worksheets[0].iter_rows(values_only=True))
+    except bad_file as e:
+        raise ValueError(f"Could not read the .xlsx file: {e}") from e
+    finally:
+        wb.close()
+
+
+def iter_token_rows(file_obj, filename: str):
+    """Pick the CSV or xlsx reader from the file name."""
+    if filename.lower().endswith((".xlsx", ".xlsm")):
+        return iter_xlsx_rows(file_obj)
+    return iter_csv_rows(file_obj)
+
+
+def token_template_csv():
+    """Empty CSV with the expected header, for the import screen's download button."""
+    buf = io.StringIO()
+    csv.writer(buf).writerow(TOKEN_TEMPLATE_COLUMNS)
+    return buf.getvalue().encode("utf-8")
@@ -8,6 +8,33 @@ from reportlab.lib.units import mm
 import io
 
 
+# ---------------------------------------------------
+# 0️⃣ TOKEN / BILTY PDF
+# ---------------------------------------------------
+def token_pdf(token_no, rows):
+    """
+    token_no = int
+    rows = [ (label, value), ... ]   # printed one per line
+    """
+    buf = io.BytesIO()
+    c = canvas.Canvas(buf, pagesize=A4)
+    c.setFont("Helvetica-Bold", 18)
+    c.drawCentredString(300, 800, "TOKEN / BILTY")
+    c.setFont("Helvetica-Bold", 14)
+    c.drawString(40, 760, f"Token No: {token_no}")
+    c.setFont("Helvetica", 12)
+    y = 730
+    for label, val in rows:
+        c.drawString(50, y, f"{label}: {val}")
+        y -= 20
+    c.setFont("Helvetica-Bold", 12)
+    c.drawString(50, y - 10, "Thank you")
+    c.showPage()
+    c.save()
+    buf.seek(0)
+    return buf
+
+
 # ---------------------------------------------------
 # 1️⃣ CHALLAN PDF  (simple, usable)
 # ---------------------------------------------------
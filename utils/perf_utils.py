@@ -0,0 +1,80 @@
+# utils/perf_utils.py
+#
+# Startup timings for the Streamlit app: cold start (first script run in this
+# server process), first render of each page, and which heavy libraries are
+# loaded. Standard library only, so importing it costs nothing.
+#
+#   python -m utils.perf_utils    -> import-time breakdown in fresh interpreters
+
+import re
+import subprocess
+import sys
+import time
+
+PROCESS_STARTED = time.perf_counter()
+
+HEAVY_MODULES = ["streamlit", "pandas", "reportlab.platypus", "openpyxl", "matplotlib.pyplot"]
+
+_startup = {"cold_start_ms": None, "first_page_ms": {}}
+
+
+def note_app_run():
+    """Call at the end of each full app run; the first one is the cold start."""
+    if _startup["cold_start_ms"] is None:
+        _startup["cold_start_ms"] = (time.perf_counter() - PROCESS_STARTED) * 1000
+
+
+def note_page(page, started):
+    """Record how long the first render of `page` took in this process."""
+    _startup["first_page_ms"].setdefault(page, (time.perf_counter() - started) * 1000)
+
+
+def startup_report():
+    """Cold start, first-page latencies (ms) and heavy modules loaded so far."""
+    return {
+        "cold_start_ms": _startup["cold_start_ms"],
+        "first_page_ms": dict(_startup["first_page_ms"]),
+        "loaded": [m for m in HEAVY_MODULES if m in sys.modules],
+    }
+
+
+_IMPORTTIME_LINE = re.compile(r"import time:\s+\d+ \|\s+(\d+) \| (\S.*)$")
+
+
+def import_breakdown(modules=HEAVY_MODULES):
+    """
+    Cold import cost (ms) of each module, measured with `python -X importtime`
+    in a fresh interpreter. None if the module is not installed.
+    """
+    out = {}
+    for mod in modules:
+        proc = subprocess.run([sys.executable, "-X", "importtime", "-c", f"import {mod}"],
+                              capture_output=True, text=True)
+        if proc.returncode:
+            out[mod] = None
+            continue
+        # top-level entries (single space before the name) add up to the total
+        total_us = sum(int(m.group(1)) for m in map(_IMPORTTIME_LINE.match, proc.stderr.splitlines()) if m)
+        out[mod] = total_us / 1000
+    return out
+
+
+def login_path_modules():
+    """Heavy modules pulled in by what app.py imports before any page renders."""
+    # same modules app.py imports before it hands over to the page router
+    code = ("import sys, streamlit, db, auth_utils, utils.perf_utils, pages.router; "
+            f"print(','.join(m for m in {HEAVY_MODULES!r} if m in sys.modules))")
+    proc = subprocess.run([sys.executable, "-c", code], capture_output=True, text=True)
+    return [m for m in proc.stdout.strip().split(",") if m]
+
+
+def main():
+    print("Cold import time (ms):")
+    for mod, ms in import_breakdown().items():
+        print(f"  {mod:<20} {'not installed' if ms is None else f'{ms:8.1f}'}")
+    print("Loaded by app.py before the first page:", ", ".join(login_path_modules()) or "-")
+    return 0
+
+
+if __name__ == "__main__":
+    raise SystemExit(main())
@@ -0,0 +1,44 @@
+# utils/search_index.py
+
+from bisect import bisect_left
+
+
+class MarkaIndex:
+    """
+    Prefix index over markas and party names (sorted array + bisect).
+
+    Built once from get_all_markas(); search() returns the top-N entries whose
+    marka, party name, or any word of the party name starts with the query.
+    Marka matches come first, then party matches, each alphabetically; the
+    scan stops as soon as N are found, so a search costs O(log n + N).
+    """
+
+    def __init__(self, markas):
+        self.markas = list(markas)
+        marka_keys, party_keys = [], []
+        for i, m in enumerate(self.markas):
+            marka_keys.append(((m["marka"] or "").upper(), i))
+            party = (m["party_name"] or "").upper()
+            party_keys.append((party, i))
+            for word in party.split()[1:]:
+                party_keys.append((word, i))
+        marka_keys.sort()
+        party_keys.sort()
+        self._tiers = [([k for k, _ in keys], [i for _, i in keys]) for keys in (marka_keys, party_keys)]
+
+    def __len__(self):
+        return len(self.markas)
+
+    def search(self, query: str, limit: int = 20):
+        """Top `limit` markas (dicts from get_all_markas) matching the prefix `query`."""
+        query = (query or "").strip().upper()
+        if not query:
+            return self.markas[:limit]
+
+        found = {}   # insertion-ordered, doubles as the result list
+        for keys, ids in self._tiers:
+            pos = bisect_left(keys, query)
+            while pos < len(keys) and len(found) < limit and keys[pos].startswith(query):
+                found.setdefault(ids[pos], None)
+                pos += 1
+        return [self.markas[i] for i in found]